@@ -0,0 +1,120 @@
+from itertools import islice, izip, starmap
+import lists
+import machine
+import sexp
+from typeterms import INVALID
+
+# Running one compiled function over many inputs.
+#
+#   scorer = Batch("(define (score a b) (add (mul a 10) b))")
+#   for result in scorer.map('score', rows): ...
+#
+# The program is read, typed and compiled once.  map() then calls the
+# function's compiled code straight from starmap, so a row costs one call of
+# the compiled function and nothing else.  Arguments and results are plain
+# python values: ints, bools and, for list types, python lists.  Rows are
+# not type checked.
+#
+# With processes, rows are sent to a multiprocessing pool in chunks; every
+# worker compiles the source itself, since compiled code cannot be pickled,
+# and results come back in the order of the rows.
+
+BACKENDS = ['closure', 'stack', 'vm']
+
+def is_list(t):
+    return t.arg is not None
+
+def to_raw(value, vtype):
+    if not is_list(vtype):
+        return value
+    return lists.from_items(to_raw(item, vtype.arg) for item in value)
+
+def from_raw(value, vtype):
+    if not is_list(vtype):
+        return value
+    return [from_raw(item, vtype.arg) for item in lists.items(value)]
+
+class Batch(object):
+    def __init__(self, source, backend='closure'):
+        if backend not in BACKENDS:
+            raise ValueError("Batch runs on one of %s, not %s" % (", ".join(BACKENDS), backend))
+        self.source = source
+        self.backend = backend
+        # results of the program's own top-level forms
+        self.results = []
+        self.funcstack = None
+        for ast, funcstack in sexp.execute(source, backend):
+            self.results.append(ast)
+            self.funcstack = funcstack
+        self.functions = {}
+
+    # the compiled function name, as a python function of raw values
+    def raw(self, name):
+        if self.funcstack is None or name not in self.funcstack.table:
+            raise KeyError("No function named "+name)
+        funcdef = self.funcstack[name]
+        if funcdef['vtype'] is INVALID:
+            raise ValueError("Function %s is invalid: %s" % (name, funcdef['error']))
+        if self.backend == 'closure':
+            return funcdef['call']
+        elif self.backend == 'stack':
+            body, pad = funcdef['machine']
+            return lambda *args: machine.execute(body, list(args) + pad)
+        program = self.funcstack.program
+        func = program.functions[funcdef['bytecode']]
+        return lambda *args: program.execute(func, args)
+
+    # the function name of python values, converting lists if it takes or
+    # returns any
+    def function(self, name):
+        if name in self.functions:
+            return self.functions[name]
+        raw = self.raw(name)
+        funcdef = self.funcstack[name]
+        intypes = funcdef['intypes']
+        outtype = funcdef['outtype']
+        if any(is_list(t) for t in intypes) or is_list(outtype):
+            f = lambda *args: from_raw(raw(*[to_raw(a, t) for a, t in zip(args, intypes)]), outtype)
+        else:
+            f = raw
+        self.functions[name] = f
+        return f
+
+    # name applied to every tuple of arguments in rows, in order
+    def map(self, name, rows, processes=None, chunksize=1024):
+        f = self.function(name)
+        if processes is None:
+            return starmap(f, rows)
+        return self.pooled(name, rows, processes, chunksize)
+
+    # name applied across columns, one iterable per argument
+    def map_columns(self, name, columns, processes=None, chunksize=1024):
+        return self.map(name, izip(*columns), processes, chunksize)
+
+    def pooled(self, name, rows, processes, chunksize):
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, init_worker, (self.source, self.backend, name))
+        try:
+            for results in pool.imap(run_chunk, chunks(rows, chunksize)):
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+# the function a pool worker runs, compiled once per worker
+_worker = None
+
+def init_worker(source, backend, name):
+    global _worker
+    _worker = Batch(source, backend).function(name)
+
+def run_chunk(chunk):
+    return list(starmap(_worker, chunk))
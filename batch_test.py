@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import unittest
+import batch
+
+PROGRAM = """
+(define (score a b) (if (gt a b) (add (mul a 10) b) (sub b a)))
+(define (total xs) (sum xs))
+(define (pair a) (cons a (cons (neg a) (nil))))
+(score 3 1)
+"""
+
+ROWS = [(3, 1), (1, 3), (5, 5), (10, -2)]
+EXPECTED = [31, 2, 0, 98]
+
+class TestBatch(unittest.TestCase):
+
+    def test_map(self):
+        for backend in batch.BACKENDS:
+            b = batch.Batch(PROGRAM, backend)
+            self.assertEqual(31, b.results[-1]['value'])
+            self.assertEqual(EXPECTED, list(b.map('score', ROWS)))
+            self.assertEqual(EXPECTED, list(b.map_columns('score', zip(*ROWS))))
+
+    def test_lists(self):
+        b = batch.Batch(PROGRAM)
+        self.assertEqual([6, 0], list(b.map('total', [([1, 2, 3],), ([],)])))
+        self.assertEqual([[4, -4]], list(b.map('pair', [(4,)])))
+
+    def test_errors(self):
+        b = batch.Batch(PROGRAM + "(define (bad x) (add x #t))")
+        self.assertRaises(KeyError, b.function, 'nope')
+        self.assertRaises(ValueError, b.function, 'bad')
+        self.assertRaises(ValueError, batch.Batch, PROGRAM, 'interpret')
+
+    def test_pool(self):
+        b = batch.Batch(PROGRAM)
+        rows = ROWS * 50
+        self.assertEqual(EXPECTED * 50, list(b.map('score', iter(rows), processes=2, chunksize=7)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import sexp
+import compiler
+import machine
+import matcher
+import resolve
+import vm
+from memo import Memo
+from stypes import Node
+
+# Front end only: parse, astify, expand and type each form
+def front(prog_str, funcstack):
+    for nested in sexp.nest(sexp.tokenize(prog_str)):
+        ast = sexp.condexpand(sexp.astify(nested), funcstack)
+        yield sexp.vtype(ast, funcstack)
+
+def timeit(f, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# A balanced expression tree of the given depth over a let-bound x, whose
+# leaves call a user function, so evaluation exercises calls, lets and
+# builtins at every level.
+def expr_tree(depth, i=0):
+    if depth == 0:
+        return ["(sq %d)" % (i % 5), "x", str(i % 7)][i % 3]
+    op = ["add", "sub", "mul"][depth % 3]
+    return "(%s %s %s)" % (op, expr_tree(depth-1, 2*i), expr_tree(depth-1, 2*i+1))
+
+def expr_tree_program(depth):
+    return "(define (sq n) (mul n n))\n(let ((x 3)) %s)" % expr_tree(depth)
+
+FIB = "(define (fib n) (if (lt n 2) n (add (fib (sub n 1)) (fib (sub n 2)))))\n(fib %d)"
+
+def fib_calls(n):
+    return 1 if n < 2 else 1 + fib_calls(n-1) + fib_calls(n-2)
+
+def compare_backends(label, prog, calls):
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    typed = [sexp.specialize_ast(resolve.resolve_ast(ast, funcstack), funcstack) for ast in front(prog, funcstack)]
+    for ast in typed:
+        sexp.interpret_ast(ast, funcstack)
+    walk = timeit(lambda: sexp.interpret_ast(typed[-1], funcstack))
+    expected = sexp.interpret_ast(typed[-1], funcstack)['value']
+
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    typed = [compiler.compile_ast(ast, funcstack) for ast in front(prog, funcstack)]
+    closed = timeit(lambda: compiler.run(typed[-1], funcstack))
+
+    assert compiler.run(typed[-1], funcstack)['value'] == expected
+
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    typed = [machine.lower_ast(ast, funcstack) for ast in front(prog, funcstack)]
+    stacked = timeit(lambda: machine.run(typed[-1], funcstack))
+
+    assert machine.run(typed[-1], funcstack)['value'] == expected
+
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    typed = [vm.compile_ast(ast, funcstack) for ast in front(prog, funcstack)]
+    bytecode = timeit(lambda: vm.run(typed[-1], funcstack))
+
+    assert vm.run(typed[-1], funcstack)['value'] == expected
+    print "%s (%d calls)" % (label, calls)
+    print "  interpret: %.4fs (%.0f calls/s)" % (walk, calls / walk)
+    print "  closures:  %.4fs (%.0f calls/s)" % (closed, calls / closed)
+    print "  stack:     %.4fs (%.0f calls/s)" % (stacked, calls / stacked)
+    print "  vm:        %.4fs (%.0f calls/s)" % (bytecode, calls / bytecode)
+    print "  speedup:   %.1fx closures, %.1fx stack, %.1fx vm" % (walk / closed, walk / stacked, walk / bytecode)
+
+def bench_closures(depth=12, n=18, m=300):
+    sys.setrecursionlimit(20000)
+    calls = 2**depth - 1 + len([i for i in xrange(2**depth) if i % 3 == 0])
+    compare_backends("expression tree depth %d" % depth, expr_tree_program(depth), calls)
+    compare_backends("fib %d" % n, FIB % n, fib_calls(n))
+    compare_backends("fact %d" % m, "(define (fact n) (if (eq n 0) 1 (mul n (fact (sub n 1)))))\n(fact %d)" % m, m + 1)
+
+def bench_memo(n=24, size=64):
+    prog = FIB % n
+    plain = timeit(lambda: list(sexp.execute(prog)), repeat=1)
+    memo = Memo(size=size)
+    memoized = timeit(lambda: list(sexp.execute(prog, memo=memo)), repeat=1)
+    stats = memo.stats()['fib']
+    print "fib %d, memo size %d" % (n, size)
+    print "  plain:    %.4fs" % plain
+    print "  memoized: %.4fs (%.0fx, %d hits, %d misses)" % (memoized, plain / memoized, stats['hits'], stats['misses'])
+
+# rules comparing an input against thresholds built from constant
+# subexpressions and small helper functions, evaluated over many inputs
+def rules_program(rules, inputs):
+    lines = ["(define (scale x) (mul x 10))", "(define (within x lo hi) (and (gte x lo) (lte x hi)))"]
+    body = "0"
+    for i in xrange(rules):
+        lo = "(add (scale %d) (mul 2 3))" % i
+        hi = "(sub (scale (add %d 1)) (div 12 4))" % i
+        body = "(if (within v %s %s) (let ((w (mul %d 100))) (add w v)) %s)" % (lo, hi, i, body)
+    lines.append("(define (rule v) %s)" % body)
+    lines.append("(define (run n acc) (if (eq n 0) acc (run (sub n 1) (add acc (rule n)))))")
+    lines.append("(run %d 0)" % inputs)
+    return "\n".join(lines)
+
+def bench_fold(rules=20, inputs=500):
+    sys.setrecursionlimit(20000)
+    prog = rules_program(rules, inputs)
+    print "%d rules over %d inputs" % (rules, inputs)
+    for backend in ['closure', 'stack']:
+        plain = timeit(lambda: list(sexp.execute(prog, backend, optimize=False)))
+        folded = timeit(lambda: list(sexp.execute(prog, backend)))
+        print "  %-8s %.4fs unfolded, %.4fs folded (%.1fx)" % (backend+":", plain, folded, plain / folded)
+
+# a large rule file: many helpers and rules, a few of them evaluated
+def rule_file(rules):
+    lines = ["(define (scale x) (mul x 10))", "(define (within x lo hi) (and (gte x lo) (lte x hi)))"]
+    for i in xrange(rules):
+        lines.append("(define (rule%d v) (if (within v (add (scale %d) 6) (sub (scale %d) 3)) (mul v %d) (neg v)))" % (i, i, i + 1, i))
+    for i in xrange(0, rules, 10):
+        lines.append("(rule%d %d)" % (i, i * 10 + 7))
+    return "\n".join(lines)
+
+def bench_cache(rules=2000):
+    import shutil
+    import tempfile
+    import cache
+    source = rule_file(rules)
+    directory = tempfile.mkdtemp()
+    try:
+        def cold():
+            shutil.rmtree(directory)
+            return list(cache.Cache(directory).program(source).run())
+        def warm():
+            return list(cache.Cache(directory).program(source).run())
+        expected = [sexp.show(res) for res, _ in sexp.execute(source)]
+        assert [sexp.show(res) for res in cold()] == expected
+        cold_time = timeit(cold)
+        warm_time = timeit(warm)
+        assert [sexp.show(res) for res in warm()] == expected
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    finally:
+        shutil.rmtree(directory, True)
+    print "rule file with %d rules (%d bytes, %d bytes cached)" % (rules, len(source), size)
+    print "  cold: %.4fs" % cold_time
+    print "  warm: %.4fs (%.1fx)" % (warm_time, cold_time / warm_time)
+
+def bench_batch(rows=200000, processes=4):
+    import batch
+    source = "(define (score a b) (if (gt a b) (add (mul a 10) b) (sub b (mul a 2))))"
+    data = [(i % 97, i % 89) for i in xrange(rows)]
+    per_form = 2000
+    each = timeit(lambda: [res for i in xrange(per_form) for res, _ in sexp.execute(source + "(score %d %d)" % data[i])], repeat=1)
+    print "score over %d rows" % rows
+    print "  execute per row: %.2f us/row" % (each / per_form * 1e6)
+    for backend in batch.BACKENDS:
+        b = batch.Batch(source, backend)
+        elapsed = timeit(lambda: sum(1 for r in b.map('score', data)), repeat=1)
+        print "  %-8s %.4fs (%.2f us/row)" % (backend+":", elapsed, elapsed / rows * 1e6)
+    b = batch.Batch(source)
+    elapsed = timeit(lambda: sum(1 for r in b.map('score', data, processes=processes, chunksize=4096)), repeat=1)
+    print "  %d procs: %.4fs (%.2f us/row)" % (processes, elapsed, elapsed / rows * 1e6)
+
+def bench_vectorize(rows=10**6):
+    import batch
+    import vectorize
+    if vectorize.numpy is None:
+        print "vectorize: numpy is not installed"
+        return
+    numpy = vectorize.numpy
+    source = """
+        (define (clamp x lo hi) (if (lt x lo) lo (if (gt x hi) hi x)))
+        (define (score a b) (if (gt a b) (add (mul a 10) (clamp b 0 50)) (sub b (div a 3))))
+    """
+    a = numpy.arange(rows, dtype=numpy.int64) % 97
+    b = numpy.arange(rows, dtype=numpy.int64) % 89
+    vectorized = vectorize.Vectorized(source, 'score')
+    columns = (a.tolist(), b.tolist())
+    scalar = batch.Batch(source)
+    expected = list(scalar.map_columns('score', columns))
+    assert vectorized(a, b).tolist() == expected
+    each = timeit(lambda: sum(1 for r in scalar.map_columns('score', columns)), repeat=1)
+    whole = timeit(lambda: vectorized(a, b))
+    print "score over %d rows" % rows
+    print "  closure rows: %.4fs (%.3f us/row)" % (each, each / rows * 1e6)
+    print "  vectorized:   %.4fs (%.3f us/row, %.0fx)" % (whole, whole / rows * 1e6, each / whole)
+
+def bench_lists(n=200000):
+    import lists
+    build = "(define (build n acc) (if (eq n 0) acc (build (sub n 1) (cons n acc))))"
+    # the (head, tail) tuples lists used to be, for comparison
+    cells = reduce(lambda tail, i: (i, tail), xrange(n, 0, -1), None)
+    cell_bytes = n * (sys.getsizeof((0, None)) + sys.getsizeof(n))
+    cell_sum = timeit(lambda: sum_cells(cells))
+    xs = lists.from_items(xrange(1, n + 1))
+    list_bytes = sys.getsizeof(xs[0])
+    list_sum = timeit(lambda: lists.total(xs))
+    print "list of %d numbers" % n
+    print "  cons cells: %d bytes, sum %.4fs" % (cell_bytes, cell_sum)
+    print "  array:      %d bytes, sum %.4fs (%.0fx)" % (list_bytes, list_sum, cell_sum / list_sum)
+    for backend in ['vm', 'stack']:
+        prog = "%s (sum (build %d (nil)))" % (build, n)
+        elapsed = timeit(lambda: list(sexp.execute(prog, backend)), repeat=1)
+        print "  %-6s build by cons and sum: %.4fs" % (backend+":", elapsed)
+    prog = "(sum (map-mul 2 (range %d)))" % n
+    elapsed = timeit(lambda: list(sexp.execute(prog)))
+    print "  (sum (map-mul 2 (range %d))): %.4fs" % (n, elapsed)
+
+def sum_cells(cell):
+    s = 0
+    while cell is not None:
+        s += cell[0]
+        cell = cell[1]
+    return s
+
+# a define summing terms multiples of its argument, as nested binary adds or
+# one variadic add, called n times
+def sum_program(terms, n, variadic):
+    products = ["(mul x %d)" % i for i in xrange(terms)]
+    if variadic:
+        body = "(add %s)" % " ".join(products)
+    else:
+        body = reduce(lambda acc, p: "(add %s %s)" % (acc, p), products)
+    run = "(define (run n acc) (if (eq n 0) acc (run (sub n 1) (add acc (f n)))))"
+    return "(define (f x) %s) %s (run %d 0)" % (body, run, n)
+
+def bench_parallel(rules=200, forms=4000, processes=4):
+    import parallel
+    lines = [rule_file(rules)]
+    lines += ["(rule%d %d)" % (i % rules, i) for i in xrange(forms)]
+    source = "\n".join(lines)
+    expected = [sexp.show(res) for res, _ in sexp.execute(source)]
+    assert list(parallel.execute(source, processes)) == expected
+    serial = timeit(lambda: list(sexp.execute(source)), repeat=1)
+    pooled = timeit(lambda: list(parallel.execute(source, processes)), repeat=1)
+    print "%d rules and %d calls" % (rules, forms)
+    print "  sequential:  %.4fs" % serial
+    print "  %d processes: %.4fs (%.1fx)" % (processes, pooled, serial / pooled)
+
+def bench_server(requests=200):
+    import shutil
+    import subprocess
+    import tempfile
+    import threading
+    import server
+    prog = "(define (sq x) (mul x x))\n(sq 3)"
+    cli = timeit(lambda: subprocess.check_output([sys.executable, "sexp.py", "-c", prog]))
+    print "one small program, %d requests" % requests
+    print "  cli process:        %.2fms" % (cli * 1000)
+    tmp = tempfile.mkdtemp()
+    try:
+        for processes in [0, 1]:
+            path = os.path.join(tmp, "socket%d" % processes)
+            evaluator = server.Server(processes)
+            unix = server.UnixServer(path, evaluator)
+            thread = threading.Thread(target=unix.serve_forever)
+            thread.start()
+            client = server.Client(path)
+            program = client.request(op='load', source=prog)['program']
+            def run():
+                for i in xrange(requests):
+                    client.request(op='eval', program=program, source="(sq %d)" % i)
+            each = timeit(run) / requests
+            client.close()
+            unix.shutdown()
+            thread.join()
+            unix.server_close()
+            evaluator.close()
+            print "  server, -j %d:       %.3fms (%.0fx)" % (processes, each * 1000, cli / each)
+    finally:
+        shutil.rmtree(tmp)
+
+STARTUP = """
+import time
+start = time.time()
+import sexp
+imported = time.time()
+for ast, funcstack in sexp.execute("(add 1 2)"):
+    sexp.show(ast)
+print imported - start, time.time() - start
+"""
+
+def bench_startup(runs=10):
+    import subprocess
+    bare = timeit(lambda: subprocess.check_output([sys.executable, "-c", "pass"]), repeat=runs)
+    cli = timeit(lambda: subprocess.check_output([sys.executable, "sexp.py", "-c", "(add 1 2)"]), repeat=runs)
+    inner = [map(float, subprocess.check_output([sys.executable, "-c", STARTUP]).split()) for i in xrange(runs)]
+    print "startup, best of %d" % runs
+    print "  python -c pass:         %.2fms" % (bare * 1000)
+    print "  sexp.py -c:             %.2fms" % (cli * 1000)
+    print "  import sexp:            %.2fms" % (min(i for i, f in inner) * 1000)
+    print "  import to first result: %.2fms" % (min(f for i, f in inner) * 1000)
+
+def bench_session(rules=5000):
+    import session
+    source = rule_file(rules) + "\n" + "\n".join("(rule%d %d)" % (i, i) for i in xrange(0, rules, 2))
+    edited = source.replace("(define (rule100 v) (if", "(define (rule100 v) (if (lt v 0) 0 (if", 1).replace(
+        "(neg v)))\n(define (rule101", "(neg v))))\n(define (rule101", 1)
+    s = session.Session()
+    first = timeit(lambda: s.load(source), repeat=1)
+    same = timeit(lambda: s.load(source))
+    def edit():
+        s.load(edited)
+        s.load(source)
+    changed = timeit(edit) / 2
+    forms = len(source.split("\n"))
+    print "session over %d forms" % forms
+    print "  first load:         %.4fs" % first
+    print "  unchanged reload:   %.4fs" % same
+    print "  one define changed: %.4fs" % changed
+
+def bench_variadic(terms=50, n=2000):
+    sys.setrecursionlimit(20000)
+    print "%d-term sums over %d calls" % (terms, n)
+    for backend in ['interpret', 'closure', 'vm']:
+        nested = timeit(lambda: list(sexp.execute(sum_program(terms, n, False), backend, optimize=False)), repeat=1)
+        flat = timeit(lambda: list(sexp.execute(sum_program(terms, n, True), backend, optimize=False)), repeat=1)
+        print "  %-10s nested %.4fs, variadic %.4fs (%.1fx)" % (backend+":", nested, flat, nested / flat)
+
+def bench_limits(n=22):
+    from limits import Limits
+    sys.setrecursionlimit(20000)
+    prog = FIB % n
+    print "fib %d (%d calls) with and without limits" % (n, fib_calls(n))
+    for backend in ['interpret', 'closure', 'stack', 'vm']:
+        free = timeit(lambda: list(sexp.execute(prog, backend)))
+        limits = Limits(fuel=10**9, seconds=3600, cells=10**9)
+        limited = timeit(lambda: list(sexp.execute(prog, backend, limits=limits)))
+        print "  %-10s %.4fs, limited %.4fs (%.2fx)" % (backend+":", free, limited, limited / free)
+
+def nested_program(depth):
+    # (cons (id 1) (cons (id (id 2)) ... (nil)))
+    expr = "(nil)"
+    for i in xrange(depth):
+        expr = "(cons %s %s)" % ("(id " * (i % 3 + 1) + str(i) + ")" * (i % 3 + 1), expr)
+    return expr
+
+# let-bound variables nested depth deep, all read in the innermost body
+def nested_lets_program(depth):
+    expr = "(sum (%s))" % reduce(lambda rest, i: "cons v%d %s" % (i, "(" + rest + ")"), reversed(xrange(depth)), "nil")
+    for i in reversed(xrange(depth)):
+        expr = "(let ((v%d %d)) %s)" % (i, i, expr)
+    return "(define (f n) %s)\n(f 0)" % expr
+
+def bench_env(sizes=(50, 100, 200, 400)):
+    sys.setrecursionlimit(20000)
+    print "tree walker over nested lets"
+    for depth in sizes:
+        funcstack = sexp.FuncStack(sexp.BUILTINS)
+        typed = [sexp.specialize_ast(resolve.resolve_ast(ast, funcstack), funcstack) for ast in front(nested_lets_program(depth), funcstack)]
+        for ast in typed:
+            sexp.interpret_ast(ast, funcstack)
+        elapsed = timeit(lambda: sexp.interpret_ast(typed[-1], funcstack))
+        print "  depth %4d: %.4fs (%.1f us/binding)" % (depth, elapsed, elapsed / depth * 1e6)
+    print "funcstack lookups under nested scopes"
+    for depth in sizes:
+        funcstack = sexp.FuncStack(sexp.BUILTINS)
+        for i in xrange(depth):
+            funcstack.push()
+            funcstack.define("f%d" % i, {})
+        elapsed = timeit(lambda: [funcstack["add"] for i in xrange(10000)])
+        print "  %4d scopes: %.3f us/lookup" % (depth, elapsed / 10000 * 1e6)
+    print "top-level defines"
+    for count in (2000, 4000, 8000):
+        names = ["f%d" % i for i in xrange(count)]
+        def define():
+            funcstack = sexp.FuncStack(sexp.BUILTINS)
+            for name in names:
+                funcstack.define(name, {})
+        elapsed = timeit(define)
+        print "  %5d defines: %.3f us/define" % (count, elapsed / count * 1e6)
+
+def bench_infer(sizes=(100, 200, 400, 800)):
+    sys.setrecursionlimit(20000)
+    print "type inference over nested cons/id"
+    for depth in sizes:
+        ast = sexp.astify(list(sexp.nest(sexp.tokenize(nested_program(depth))))[0])
+        elapsed = timeit(lambda: sexp.vtype(ast, sexp.FuncStack(sexp.BUILTINS)))
+        print "  depth %4d: %.4fs (%.1f us/level)" % (depth, elapsed, elapsed / depth * 1e6)
+
+# collect the distinct nodes reachable from x
+def collect_nodes(x, seen):
+    if isinstance(x, Node):
+        if id(x) in seen:
+            return
+        seen[id(x)] = x
+        children = [v for k, v in x.iteritems()]
+    elif type(x) in (list, tuple):
+        children = x
+    else:
+        return
+    for child in children:
+        collect_nodes(child, seen)
+
+def bench_nodes(depth=12):
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    typed = list(front(expr_tree_program(depth), funcstack))
+    nodes = {}
+    collect_nodes(typed, nodes)
+    # the same keys in the dict representation every node used to have
+    dict_size = sum(sys.getsizeof(dict(n.iteritems())) for n in nodes.itervalues())
+    slotted_size = sum(sys.getsizeof(n) for n in nodes.itervalues())
+    count = len(nodes)
+    print "typed expression tree depth %d (%d nodes)" % (depth, count)
+    print "  dict nodes:    %d bytes, %.1f bytes/node" % (dict_size, float(dict_size) / count)
+    print "  slotted nodes: %d bytes, %.1f bytes/node" % (slotted_size, float(slotted_size) / count)
+
+def bench_reader(forms=20000):
+    prog = "\n".join("(add (mul %d 2) ; form %d\n  [sub %d (neg 1)])" % (i, i, i) for i in xrange(forms))
+    start = time.time()
+    sexp.read(prog).next()
+    first = time.time() - start
+    total = timeit(lambda: sum(1 for form in sexp.read(prog)))
+    print "reader over %d forms (%d bytes)" % (forms, len(prog))
+    print "  first form: %.6fs" % first
+    print "  all forms:  %.4fs (%.1f MB/s, %.0f forms/s)" % (total, len(prog) / total / 1e6, forms / total)
+
+def bench_modes(forms=2000):
+    prog = "(define (sq n) (mul n n))\n" + "\n".join("(let ((x %d)) (add (sq x) (sub x 1)))" % i for i in xrange(forms))
+    print "execute over %d forms" % forms
+    stdout = sys.stdout
+    for mode in sexp.MODES:
+        sys.stdout = open(os.devnull, "w")
+        try:
+            elapsed = timeit(lambda: sum(1 for res in sexp.execute(prog, mode=mode)), repeat=1 if mode == "trace" else 3)
+        finally:
+            sys.stdout = stdout
+        print "  %-10s %.4fs (%.1f us/form)" % (mode+":", elapsed, elapsed / forms * 1e6)
+
+def bench_matchers(forms=2000):
+    prog = "(define (sq n) (mul n n))\n" + "\n".join("(let ((x %d)) (add (sq x) (if (lt x 3) x 1)))" % i for i in xrange(forms))
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    astified = [sexp.astify(form) for form, line, col in sexp.read(prog)]
+    typed = [sexp.vtype(ast, funcstack) for ast in astified]
+    m = matcher.ASTMatchers.vtyped
+    predicate = m.compile()
+    assert all(predicate(ast) for ast in typed)
+    infer = timeit(lambda: [sexp.vtype(ast, funcstack) for ast in astified[1:]])
+    combinators = timeit(lambda: [m.matches(ast, 0) for ast in typed])
+    compiled = timeit(lambda: [predicate(ast) for ast in typed])
+    print "vtyped matcher over %d forms" % forms
+    print "  VTYPE pass:  %.4fs (%.1f us/form)" % (infer, infer / forms * 1e6)
+    print "  combinators: %.4fs (%.1f us/form)" % (combinators, combinators / forms * 1e6)
+    print "  compiled:    %.4fs (%.1f us/form, %.1fx)" % (compiled, compiled / forms * 1e6, combinators / compiled)
+
+BENCHMARKS = {
+    'batch': bench_batch,
+    'cache': bench_cache,
+    'closures': bench_closures,
+    'env': bench_env,
+    'fold': bench_fold,
+    'infer': bench_infer,
+    'limits': bench_limits,
+    'lists': bench_lists,
+    'matchers': bench_matchers,
+    'memo': bench_memo,
+    'modes': bench_modes,
+    'nodes': bench_nodes,
+    'parallel': bench_parallel,
+    'reader': bench_reader,
+    'server': bench_server,
+    'session': bench_session,
+    'startup': bench_startup,
+    'variadic': bench_variadic,
+    'vectorize': bench_vectorize,
+}
+
+if __name__ == "__main__":
+    import sys
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import sexp
+from resolve import resolve_ast
+from specialize import specialize_ast
+
+# Benchmarks of each stage of the pipeline over generated workloads, for
+# catching performance regressions.
+#
+#   python benchsuite.py --save baseline.json
+#   python benchsuite.py --baseline baseline.json --tolerance 0.25
+#
+# Every workload is a program generated at a few sizes, and every stage runs
+# on it separately: reading, astify (with cond expansion), vtype, the tree
+# walker (resolve, specialize and interpret) and the whole of execute.  Each stage's
+# input is prepared before it is timed, and the best of a few repeats is
+# kept.  Every measurement runs in a forked child, and its peak memory is how
+# far the child's resident set grew over the first run.
+#
+# A run can be saved as json and later runs compared against it: a stage is
+# a regression if it is more than tolerance slower than in the baseline, and
+# any regression makes the exit status 1.
+
+def nested(depth):
+    expr = "0"
+    for i in xrange(depth):
+        expr = "(%s %d %s)" % (["add", "sub", "mul"][i % 3], i % 7 + 1, expr)
+    return expr
+
+def defines(count):
+    lines = ["(define (f%d x) (add (mul x %d) 1))" % (i, i) for i in xrange(count)]
+    lines.append("(f%d 3)" % (count - 1))
+    return "\n".join(lines)
+
+def fib(n):
+    return "(define (fib n) (if (lt n 2) n (add (fib (sub n 1)) (fib (sub n 2))))) (fib %d)" % n
+
+def fact(n):
+    return "(define (fact n) (if (lt n 2) 1 (mul n (fact (sub n 1))))) (fact %d)" % n
+
+def conses(n):
+    return "(define (build n acc) (if (eq n 0) acc (build (sub n 1) (cons n acc)))) (sum (build %d (nil)))" % n
+
+def lets(width):
+    expr = "v%d" % (width - 1)
+    for i in reversed(xrange(width)):
+        expr = "(let ((v%d %s)) %s)" % (i, "(add v%d 1)" % (i - 1) if i else "0", expr)
+    return expr
+
+def forms(count):
+    return "\n".join("(add (mul %d 2) (sub %d (neg 1)))" % (i, i) for i in xrange(count))
+
+# name -> (generator, sizes)
+WORKLOADS = {
+    'nested': (nested, [100, 200, 400]),
+    'defines': (defines, [250, 500, 1000]),
+    'fib': (fib, [10, 13, 16]),
+    'fact': (fact, [100, 200, 400]),
+    'conses': (conses, [250, 500, 1000]),
+    'lets': (lets, [50, 100, 200]),
+    'forms': (forms, [1000, 2000, 4000]),
+}
+
+def read(source):
+    return list(sexp.nest(sexp.tokenize(source)))
+
+def astify(nested):
+    return [sexp.condexpand(sexp.astify(form), None) for form in nested]
+
+def typed(asts):
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    return [sexp.vtype(ast, funcstack) for ast in asts]
+
+def walk(asts):
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    return [sexp.interpret_ast(specialize_ast(resolve_ast(ast, funcstack), funcstack), funcstack) for ast in asts]
+
+# name -> (setup, run): setup makes the stage's input from the source, fresh
+# for every repeat since some stages change their input in place
+STAGES = [
+    ('read', (lambda source: source, read)),
+    ('astify', (read, astify)),
+    ('vtype', (lambda source: astify(read(source)), typed)),
+    ('interpret', (lambda source: typed(astify(read(source))), walk)),
+    ('execute', (lambda source: source, lambda source: list(sexp.execute(source)))),
+]
+
+def timed(run, data):
+    start = time.time()
+    run(data)
+    return time.time() - start
+
+# resident set size in kB, or None where /proc is missing
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (IOError, OSError, ValueError):
+        return None
+
+def peak_rss():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# run f in a forked child and return what it returns, which must be json
+def forked(f):
+    if not hasattr(os, 'fork'):
+        return f()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            out = json.dumps(f())
+        except BaseException as e:
+            out = json.dumps({'error': "%s: %s" % (type(e).__name__, e)})
+        with os.fdopen(w, "w") as pipe:
+            pipe.write(out)
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as pipe:
+        data = pipe.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+def measure(workload, size, stage, repeat=3):
+    generate, sizes = WORKLOADS[workload]
+    setup, run = dict(STAGES)[stage]
+    source = generate(size)
+    def child():
+        # the first run measures memory, over the input it was given
+        data = setup(source)
+        before = rss()
+        times = [timed(run, data)]
+        peak = max(0, peak_rss() - before) if before is not None else None
+        for i in xrange(repeat - 1):
+            times.append(timed(run, setup(source)))
+        return {'seconds': min(times), 'peak_kb': peak}
+    result = forked(child)
+    result.update({'workload': workload, 'size': size, 'stage': stage, 'bytes': len(source)})
+    if 'seconds' in result:
+        result['bytes_per_second'] = len(source) / max(result['seconds'], 1e-9)
+    return result
+
+def key(result):
+    return "%s/%d/%s" % (result['workload'], result['size'], result['stage'])
+
+def run_suite(workloads=None, stages=None, scale=1.0, repeat=3):
+    sys.setrecursionlimit(100000)
+    results = []
+    for workload in workloads or sorted(WORKLOADS):
+        for size in WORKLOADS[workload][1]:
+            for stage in stages or [name for name, fns in STAGES]:
+                results.append(measure(workload, max(1, int(size * scale)), stage, repeat))
+    return results
+
+# (key, baseline seconds, seconds, ratio) for every result more than
+# tolerance slower than in baseline
+def regressions(baseline, results, tolerance):
+    before = dict((key(r), r['seconds']) for r in baseline if 'seconds' in r)
+    out = []
+    for r in results:
+        k = key(r)
+        if k in before and 'seconds' in r and r['seconds'] > before[k] * (1 + tolerance):
+            out.append((k, before[k], r['seconds'], r['seconds'] / before[k]))
+    return out
+
+def show(result):
+    if 'error' in result:
+        return "%-24s error: %s" % (key(result), result['error'])
+    peak = "%8d kB" % result['peak_kb'] if result['peak_kb'] is not None else "       ? kB"
+    return "%-24s %9.4fs %9.2f MB/s %s" % (key(result), result['seconds'], result['bytes_per_second'] / 1e6, peak)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages over generated workloads.")
+    parser.add_argument("--workloads", help="comma-separated workloads (default: all of %s)" % ", ".join(sorted(WORKLOADS)))
+    parser.add_argument("--stages", help="comma-separated stages (default: all of %s)" % ", ".join(n for n, f in STAGES))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every workload size by SCALE")
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of REPEAT runs")
+    parser.add_argument("--save", metavar="FILE", help="write the results as json to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against results saved in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown over the baseline that counts as a regression (default: 0.25)")
+    args = parser.parse_args()
+
+    results = run_suite(args.workloads and args.workloads.split(","), args.stages and args.stages.split(","),
+                        args.scale, args.repeat)
+    for result in results:
+        print show(result)
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump({'python': sys.version.split()[0], 'results': results}, f, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slower = regressions(baseline, results, args.tolerance)
+        for k, before, after, ratio in slower:
+            print "REGRESSION %s: %.4fs -> %.4fs (%.2fx)" % (k, before, after, ratio)
+        if slower:
+            sys.exit(1)
+        print "no regressions against %s" % args.baseline
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+import unittest
+import sexp
+import benchsuite
+
+class TestBenchsuite(unittest.TestCase):
+
+    def test_workloads(self):
+        # every generated program runs without errors at a small size
+        for name, (generate, sizes) in benchsuite.WORKLOADS.items():
+            results = [sexp.show(res) for res, _ in sexp.execute(generate(5))]
+            self.assertFalse(any(r is not None and r.startswith("error") for r in results), name)
+
+    def test_measure(self):
+        result = benchsuite.measure('fact', 10, 'interpret', repeat=1)
+        self.assertTrue(result['seconds'] >= 0)
+        self.assertEqual('fact/10/interpret', benchsuite.key(result))
+
+    def test_regressions(self):
+        baseline = [{'workload': 'fib', 'size': 10, 'stage': 'vtype', 'seconds': 1.0},
+                    {'workload': 'fib', 'size': 10, 'stage': 'read', 'seconds': 1.0}]
+        results = [{'workload': 'fib', 'size': 10, 'stage': 'vtype', 'seconds': 1.2},
+                   {'workload': 'fib', 'size': 10, 'stage': 'read', 'seconds': 1.5},
+                   {'workload': 'fib', 'size': 20, 'stage': 'read', 'seconds': 9.0}]
+        self.assertEqual([('fib/10/read', 1.0, 1.5, 1.5)], benchsuite.regressions(baseline, results, 0.25))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import time
+import zlib
+import hashlib
+import tempfile
+import cPickle as pickle
+import sexp
+
+# A directory of compiled programs, so a program that has been run before
+# skips reading, typing and compiling and goes straight to the vm.
+#
+# Entries are vm.Programs, pickled and compressed, in files named by the
+# hash of VERSION, the source and whether it was optimized.  VERSION changes
+# whenever the compiler or the bytecode does, which turns every older entry
+# into a miss.  A hit touches its file, so the oldest modification times
+# belong to the least recently used entries; evict() removes entries older
+# than max_age and then the least recently used ones until the directory
+# fits in max_bytes.
+
+VERSION = "sascheme2-vm-4"
+SUFFIX = ".prog"
+
+class Cache(object):
+    def __init__(self, directory, max_bytes=64 << 20, max_age=30 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, source, optimize=True):
+        digest = hashlib.sha1("%s\0%d\0%s" % (VERSION, optimize, source)).hexdigest()
+        return os.path.join(self.directory, digest + SUFFIX)
+
+    # the cached vm.Program for source, or None
+    def load(self, source, optimize=True):
+        path = self.path(source, optimize)
+        try:
+            with open(path, "rb") as f:
+                program = pickle.loads(zlib.decompress(f.read()))
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # unreadable, so treat it as stale
+            self.remove(path)
+            return None
+        os.utime(path, None)
+        return program
+
+    def store(self, source, program, optimize=True):
+        data = zlib.compress(pickle.dumps(program, pickle.HIGHEST_PROTOCOL))
+        # write and rename, so a concurrent load never sees half an entry
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp, self.path(source, optimize))
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # (mtime, size, path) of every entry, least recently used first
+    def entries(self):
+        out = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, path))
+        out.sort()
+        return out
+
+    def evict(self, now=None):
+        if now is None:
+            now = time.time()
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    # the program for source, compiled and stored if it was not cached
+    def program(self, source, optimize=True):
+        program = self.load(source, optimize)
+        if program is None:
+            program = sexp.compile_program(source, optimize)
+            self.store(source, program, optimize)
+        return program
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import cache
+import sexp
+
+PROGRAM = "(define (sq n) (mul n n)) (sq 7) (cons #t (nil))"
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hit(self):
+        c = cache.Cache(self.directory)
+        self.assertEqual(None, c.load(PROGRAM))
+        first = [sexp.show(res) for res in c.program(PROGRAM).run()]
+        loaded = c.load(PROGRAM)
+        self.assertNotEqual(None, loaded)
+        self.assertEqual(first, [sexp.show(res) for res in loaded.run()])
+        self.assertEqual([None, "49", "(#t)"], first)
+        self.assertEqual(None, c.load(PROGRAM + " (sq 2)"))
+        self.assertEqual(None, c.load(PROGRAM, optimize=False))
+
+    def test_evict(self):
+        c = cache.Cache(self.directory)
+        sources = ["(add 1 %d)" % i for i in xrange(4)]
+        for source in sources:
+            c.program(source)
+        paths = [c.path(source) for source in sources]
+        now = time.time()
+        for i in xrange(4):
+            os.utime(paths[i], (now - 100 * (4 - i), now - 100 * (4 - i)))
+        # too old
+        c.max_age = 350
+        c.evict(now)
+        self.assertEqual([False, True, True, True], [os.path.exists(p) for p in paths])
+        # too big, so the least recently used goes first
+        c.max_bytes = sum(os.path.getsize(p) for p in paths[2:])
+        c.evict(now)
+        self.assertEqual([False, False, True, True], [os.path.exists(p) for p in paths])
+
+    def test_corrupt(self):
+        c = cache.Cache(self.directory)
+        with open(c.path(PROGRAM), "wb") as f:
+            f.write("not a program")
+        self.assertEqual(None, c.load(PROGRAM))
+        self.assertFalse(os.path.exists(c.path(PROGRAM)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+from operator import itemgetter
+from stypes import *
+from typeterms import NUM, BOOL, VOID, INVALID
+
+# Compiles a vtyped AST into nested python closures.  Every closure takes a
+# frame (a list of slots) and returns a raw python value: ints for NumType,
+# bools for BoolType and lists as in lists for ListType.  box() in stypes
+# turns them back into nodes.  Variables are resolved to slot indices and
+# builtins to their 'raw' implementation once, at compile time.
+#
+# A define below the top level of a form, in a let or a function body, binds
+# its function every time it is run, to the values of the variables it can
+# see there.  Its frame holds those values after the arguments, and calls go
+# through a function that stays the same, so they reach the latest binding.
+
+def is_invalid(ast):
+    return ast['ntype'] == Nodes.INVALID or ast['vtype'] is INVALID
+
+# raw implementation of funcdef for a call with nargs arguments; a variadic
+# builtin called with more than its fixed arity folds the whole argument list
+# in one call
+def raw_for(funcdef, nargs):
+    if 'variadic' in funcdef and nargs != len(funcdef['intypes']):
+        return funcdef['variadic']
+    return funcdef['raw']
+
+# node for the raw value of a typed form; a form with no value, such as a
+# let around a define, is its own node
+def result(value, ast):
+    if ast['vtype'] is VOID:
+        return ast
+    return box(value, ast['vtype'])
+
+# the raw implementation of the identity builtins, which the SPECIALIZE pass
+# drops from the tree
+def raw_id(a): return a
+
+class Slots(object):
+    def __init__(self, nparams=0):
+        self.size = nparams
+    def alloc(self):
+        self.size += 1
+        return self.size - 1
+
+def compile_call(fn, args):
+    if len(args) == 0:
+        return lambda frame: fn()
+    elif len(args) == 1:
+        a, = args
+        return lambda frame: fn(a(frame))
+    elif len(args) == 2:
+        a, b = args
+        return lambda frame: fn(a(frame), b(frame))
+    elif len(args) == 3:
+        a, b, c = args
+        return lambda frame: fn(a(frame), b(frame), c(frame))
+    else:
+        return lambda frame: fn(*[arg(frame) for arg in args])
+
+def compile_late_call(funcdef, args):
+    # the callee has not been compiled yet, so look it up on every call
+    return lambda frame: funcdef['call'](*[arg(frame) for arg in args])
+
+def compile_node(ast, funcstack, scope, slots):
+    ntype = ast['ntype']
+    if ntype == Nodes.NUM or ntype == Nodes.BOOL:
+        value = ast['value']
+        return lambda frame: value
+    elif ntype == Nodes.IDENT:
+        return itemgetter(scope[ast['value']])
+    elif ntype == Nodes.LET:
+        scope = dict(scope)
+        stores = []
+        for ident, expr in ast['bindings']:
+            code = compile_node(expr, funcstack, scope, slots)
+            scope[ident['value']] = slot = slots.alloc()
+            stores.append((slot, code))
+        expr = compile_node(ast['expr'], funcstack, scope, slots)
+        def let(frame):
+            for slot, code in stores:
+                frame[slot] = code(frame)
+            return expr(frame)
+        return let
+    elif ntype == Nodes.IF:
+        test = compile_node(ast['testexpr'], funcstack, scope, slots)
+        true = compile_node(ast['trueexpr'], funcstack, scope, slots)
+        false = compile_node(ast['falseexpr'], funcstack, scope, slots)
+        return lambda frame: true(frame) if test(frame) else false(frame)
+    elif ntype == Nodes.FUNC:
+        name = ast['func']['value']
+        if name not in funcstack:
+            raise Exception("Cannot compile call to unknown func "+name)
+        funcdef = funcstack[name]
+        args = [compile_node(arg, funcstack, scope, slots) for arg in ast['args']]
+        if 'raw' in funcdef:
+            fn = raw_for(funcdef, len(args))
+            if funcstack.limits is not None:
+                fn = funcstack.limits.builtin(name, fn)
+            if funcstack.profile is not None:
+                fn = funcstack.profile.wrap(name, fn)
+            return compile_call(fn, args)
+        elif 'call' in funcdef:
+            return compile_call(funcdef['call'], args)
+        else:
+            return compile_late_call(funcdef, args)
+    elif ntype == Nodes.DEFINE:
+        return compile_nested_define(ast, funcstack, scope)
+    raise Exception("Cannot compile node type "+ntype)
+
+# the function of a define, which runs body on a frame of its arguments
+# followed by rest, the captured values and let slots
+def compile_call_of(ast, funcstack, body, rest):
+    limits = funcstack.limits
+    if limits is not None:
+        # the step is taken inline, to keep the call to a single frame
+        def call(*args):
+            limits.steps += 1
+            if limits.steps >= limits.next_check:
+                limits.check()
+            return body(list(args) + rest if rest else args)
+    elif not rest:
+        # no lets, so the argument tuple is the frame
+        call = lambda *args: body(args)
+    else:
+        call = lambda *args: body(list(args) + rest)
+    memo = funcstack.memo
+    if memo is not None and memo.wanted(ast['func']['value']):
+        call = memo.wrap_call(ast, call)
+    if funcstack.profile is not None:
+        call = funcstack.profile.wrap(ast['func']['value'], call)
+    return call
+
+def compile_define(ast, funcstack):
+    funcdef = funcstack[ast['func']['value']]
+    params = ast['params']
+    scope = dict((params[i]['value'], i) for i in xrange(len(params)))
+    slots = Slots(len(params))
+    body = compile_node(ast['expr'], funcstack, scope, slots)
+    funcdef['call'] = compile_call_of(ast, funcstack, body, [None] * (slots.size - len(params)))
+
+# the variables of scope a nested define captures, as (slot, name) in slot
+# order, and the scope of its body: the parameters, then the captured names
+def nested_scope(ast, scope):
+    params = [param['value'] for param in ast['params']]
+    captured = sorted((slot, name) for name, slot in scope.iteritems() if name not in params)
+    inner = dict((params[i], i) for i in xrange(len(params)))
+    for slot, name in captured:
+        inner[name] = len(inner)
+    return captured, inner
+
+# the function of a nested define until the define is run
+def unbound(name):
+    def call(*args):
+        raise Exception(name + " called before its define was reached")
+    return call
+
+# code for a define nested in a form, which binds the function when run.
+# The define is its own funcdef, as calls to it were typed against it.
+def compile_nested_define(ast, funcstack, scope):
+    captured, inner = nested_scope(ast, scope)
+    current = [unbound(ast['func']['value'])]
+    ast['call'] = lambda *args: current[0](*args)
+    slots = Slots(len(inner))
+    body = compile_node(ast['expr'], funcstack, inner, slots)
+    outer = [slot for slot, ident in captured]
+    pad = [None] * (slots.size - len(inner))
+    def define(frame):
+        current[0] = compile_call_of(ast, funcstack, body, [frame[slot] for slot in outer] + pad)
+    return define
+
+# COMPILE pass: annotate valid expressions with a 'code' thunk
+def compile_ast(ast, funcstack):
+    if is_invalid(ast):
+        return ast
+    elif ast['ntype'] == Nodes.DEFINE:
+        compile_define(ast, funcstack)
+        return ast
+    slots = Slots()
+    body = compile_node(ast, funcstack, {}, slots)
+    size = slots.size
+    return ast.replace(code=lambda: body([None] * size))
+
+# RUN pass: run the compiled thunk and box the result
+def run(ast, funcstack):
+    if 'code' not in ast:
+        return ast
+    return result(ast['code'](), ast)
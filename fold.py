@@ -0,0 +1,256 @@
+from stypes import *
+from typeterms import NUM, BOOL, INVALID
+from compiler import box, is_invalid, raw_for
+
+# Constant folding and inlining on the typed tree.
+#
+# - builtin calls whose arguments are all literals are replaced by their
+#   value, unless the builtin raises (like a division by zero)
+# - nested calls to the same variadic builtin become one call
+# - an if with a literal test is replaced by the branch it takes
+# - let bindings to literals are substituted into the body, as are bindings
+#   to other variables and bindings used exactly once, and bindings that are
+#   never used are dropped
+# - calls to small, monomorphic, non-recursive defines are replaced by their
+#   body, with the parameters bound by a let, which is then folded as above,
+#   unless the body uses variables of a let or function the define is in
+#
+# Substitution goes through env, a dict of name -> replacement node that is
+# applied while the body is folded, so newly constant expressions fold in the
+# same walk.  Every expression is pure, so moving or dropping one only changes
+# how often it is evaluated.  Defines are folded in place, so later calls see
+# and inline the folded body.
+
+INLINE_SIZE = 20
+
+def is_literal(ast):
+    return ast['ntype'] == Nodes.NUM or ast['ntype'] == Nodes.BOOL
+
+# every identifier in ast, bound or not
+def names(ast, out=None):
+    if out is None:
+        out = set()
+    ntype = ast['ntype']
+    if ntype == Nodes.IDENT:
+        out.add(ast['value'])
+    elif ntype == Nodes.FUNC:
+        for arg in ast['args']:
+            names(arg, out)
+    elif ntype == Nodes.LET:
+        for ident, expr in ast['bindings']:
+            names(expr, out)
+        names(ast['expr'], out)
+    elif ntype == Nodes.IF:
+        names(ast['testexpr'], out)
+        names(ast['trueexpr'], out)
+        names(ast['falseexpr'], out)
+    elif ntype == Nodes.DEFINE:
+        names(ast['expr'], out)
+    return out
+
+# (count, safe) for the free uses of name in ast: safe is False if a use
+# comes after a binding of one of the names in danger, or inside a define,
+# either of which would change what substituting an expression means
+def uses(ast, name, danger, shadowed=False):
+    ntype = ast['ntype']
+    if ntype == Nodes.IDENT:
+        if ast['value'] == name:
+            return 1, not shadowed
+        return 0, True
+    elif ntype == Nodes.LET:
+        count, safe = 0, True
+        for ident, expr in ast['bindings']:
+            c, s = uses(expr, name, danger, shadowed)
+            count, safe = count + c, safe and s
+            if ident['value'] == name:
+                return count, safe
+            shadowed = shadowed or ident['value'] in danger
+        c, s = uses(ast['expr'], name, danger, shadowed)
+        return count + c, safe and s
+    elif ntype == Nodes.DEFINE:
+        if any(param['value'] == name for param in ast['params']):
+            return 0, True
+        count, safe = uses(ast['expr'], name, danger, shadowed)
+        return count, count == 0
+    elif ntype == Nodes.FUNC:
+        children = ast['args']
+    elif ntype == Nodes.IF:
+        children = [ast['testexpr'], ast['trueexpr'], ast['falseexpr']]
+    else:
+        return 0, True
+    count, safe = 0, True
+    for child in children:
+        c, s = uses(child, name, danger, shadowed)
+        count, safe = count + c, safe and s
+    return count, safe
+
+# number of nodes in ast, counting no further than limit
+def size(ast, limit):
+    ntype = ast['ntype']
+    if ntype == Nodes.FUNC:
+        children = ast['args']
+    elif ntype == Nodes.LET:
+        children = [expr for ident, expr in ast['bindings']] + [ast['expr']]
+    elif ntype == Nodes.IF:
+        children = [ast['testexpr'], ast['trueexpr'], ast['falseexpr']]
+    else:
+        return 1
+    total = 1
+    for child in children:
+        if total > limit:
+            break
+        total += size(child, limit - total)
+    return total
+
+# whether every variable ast uses is in bound or bound in ast, which is not
+# so for the body of a define that uses variables of the let or function it
+# is nested in
+def closed(ast, bound):
+    ntype = ast['ntype']
+    if ntype == Nodes.IDENT:
+        return ast['value'] in bound
+    elif ntype == Nodes.FUNC:
+        return all(closed(arg, bound) for arg in ast['args'])
+    elif ntype == Nodes.LET:
+        bound = set(bound)
+        for ident, expr in ast['bindings']:
+            if not closed(expr, bound):
+                return False
+            bound.add(ident['value'])
+        return closed(ast['expr'], bound)
+    elif ntype == Nodes.IF:
+        return closed(ast['testexpr'], bound) and closed(ast['trueexpr'], bound) and closed(ast['falseexpr'], bound)
+    elif ntype == Nodes.DEFINE:
+        return closed(ast['expr'], bound | set(param['value'] for param in ast['params']))
+    return True
+
+def calls(ast, name):
+    ntype = ast['ntype']
+    if ntype == Nodes.FUNC:
+        return ast['func']['value'] == name or any(calls(arg, name) for arg in ast['args'])
+    elif ntype == Nodes.LET:
+        return any(calls(expr, name) for ident, expr in ast['bindings']) or calls(ast['expr'], name)
+    elif ntype == Nodes.IF:
+        return calls(ast['testexpr'], name) or calls(ast['trueexpr'], name) or calls(ast['falseexpr'], name)
+    return ntype == Nodes.DEFINE
+
+def inlinable(funcdef):
+    if funcdef.get('ntype') != Nodes.DEFINE or funcdef['vtype'] is INVALID:
+        return False
+    elif funcdef['outtype'].has_vars or any(t.has_vars for t in funcdef['intypes']):
+        return False
+    # calls() is also true for a body with a nested define
+    return size(funcdef['expr'], INLINE_SIZE) <= INLINE_SIZE and not calls(funcdef['expr'], funcdef['func']['value']) \
+        and closed(funcdef['expr'], set(param['value'] for param in funcdef['params']))
+
+# the arguments of a call to a variadic builtin, with the arguments of the
+# calls among them to the same builtin spliced in: (add (add a b) c) is
+# (add a b c)
+def flatten(funcdef, args, funcstack):
+    out = []
+    for arg in args:
+        if arg['ntype'] == Nodes.FUNC and not is_invalid(arg) and funcstack[arg['func']['value']] is funcdef:
+            out.extend(arg['args'])
+        else:
+            out.append(arg)
+    return out
+
+class Folder(object):
+    def __init__(self, funcstack):
+        self.funcstack = funcstack
+        self.fresh = 0
+
+    def fold(self, ast, env):
+        if is_invalid(ast):
+            return ast
+        ntype = ast['ntype']
+        if ntype == Nodes.NUM or ntype == Nodes.BOOL:
+            return ast
+        elif ntype == Nodes.IDENT:
+            return env.get(ast['value'], ast)
+        elif ntype == Nodes.LET:
+            return self.fold_let(ast, env)
+        elif ntype == Nodes.IF:
+            test = self.fold(ast['testexpr'], env)
+            if test['ntype'] == Nodes.BOOL:
+                return self.fold(ast['trueexpr'] if test['value'] else ast['falseexpr'], env)
+            return ast.replace(testexpr=test, trueexpr=self.fold(ast['trueexpr'], env),
+                               falseexpr=self.fold(ast['falseexpr'], env))
+        elif ntype == Nodes.FUNC:
+            return self.fold_func(ast, env)
+        elif ntype == Nodes.DEFINE:
+            self.fold_define(ast, env)
+            return ast
+        raise Exception("Cannot fold node type "+ntype)
+
+    def fold_let(self, ast, env):
+        env = dict(env)
+        bindings = ast['bindings']
+        kept = []
+        for i in xrange(len(bindings)):
+            ident, expr = bindings[i]
+            self.funcstack.push()
+            expr = self.fold(expr, env)
+            self.funcstack.pop()
+            name = ident['value']
+            env.pop(name, None)
+            if is_literal(expr):
+                env[name] = expr
+                continue
+            count, safe = uses(ast.replace(bindings=bindings[i+1:]), name, names(expr))
+            if safe and (count == 1 or expr['ntype'] == Nodes.IDENT):
+                env[name] = expr
+            elif count > 0:
+                kept.append((ident, expr))
+        expr = self.fold(ast['expr'], env)
+        if not kept:
+            return expr
+        return ast.replace(bindings=kept, expr=expr)
+
+    def fold_func(self, ast, env):
+        scoped = any(arg['ntype'] == Nodes.DEFINE for arg in ast['args'])
+        if scoped: self.funcstack.push()
+        args = [self.fold(arg, env) for arg in ast['args']]
+        funcdef = self.funcstack[ast['func']['value']]
+        if scoped: self.funcstack.pop()
+        vtype = ast['vtype']
+        if 'variadic' in funcdef:
+            args = flatten(funcdef, args, self.funcstack)
+        if 'raw' in funcdef and (vtype is NUM or vtype is BOOL) and all(is_literal(arg) for arg in args):
+            try:
+                value = raw_for(funcdef, len(args))(*[arg['value'] for arg in args])
+            except Exception:
+                pass
+            else:
+                if (type(value) is bool) == (vtype is BOOL):
+                    return box(value, vtype)
+        elif inlinable(funcdef):
+            return self.inline(funcdef, args, vtype)
+        return ast.replace(args=args)
+
+    def fold_define(self, ast, env):
+        self.funcstack.define(ast['func']['value'], ast)
+        env = dict(env)
+        for param in ast['params']:
+            env.pop(param['value'], None)
+        ast['expr'] = self.fold(ast['expr'], env)
+
+    # the body of funcdef applied to args, as a let binding fresh names for
+    # the parameters so the arguments cannot capture each other's variables
+    def inline(self, funcdef, args, vtype):
+        renames = {}
+        bindings = []
+        for param, intype, arg in zip(funcdef['params'], funcdef['intypes'], args):
+            self.fresh += 1
+            # ';' starts a comment, so no identifier in a program has one
+            fresh = ident_node("%s;%d" % (param['value'], self.fresh))
+            renames[param['value']] = fresh.replace(vtype=intype)
+            bindings.append((fresh, arg))
+        body = self.fold(funcdef['expr'], renames)
+        return self.fold_let(let_node(bindings, body).replace(vtype=vtype), {})
+
+# FOLD pass: fold constants and inline small functions in valid expressions
+def fold_ast(ast, funcstack):
+    if is_invalid(ast):
+        return ast
+    return Folder(funcstack).fold(ast, {})
@@ -0,0 +1,233 @@
+from stypes import *
+from typeterms import NUM, BOOL, VOID, INVALID, List, Var
+
+# Hindley-Milner style type inference over union-find.
+#
+# While a form is being inferred, node vtypes may hold TVars (union-find
+# cells) and TLists of them next to ordinary interned terms.  Unifying two
+# types links their representatives (with path compression and union by
+# rank), so every constraint costs near-constant time.  Once the form is
+# done, zonk() replaces every inference type with its interned term, and type
+# variables that were never bound become generalized T_n variables.
+#
+# Builtins and defines are type schemes: the T_n variables in their intypes
+# and outtype are instantiated with fresh TVars at each call site.  A define
+# that is still being inferred is monomorphic in its own body, which is what
+# lets recursive defines type check.
+
+class TVar(object):
+    __slots__ = ('parent', 'rank')
+    def __init__(self):
+        self.parent = None
+        self.rank = 0
+
+class TList(object):
+    __slots__ = ('elem',)
+    def __init__(self, elem):
+        self.elem = elem
+
+def find(t):
+    if type(t) is not TVar:
+        return t
+    root = t
+    while type(root) is TVar and root.parent is not None:
+        root = root.parent
+    # path compression
+    while t is not root:
+        t.parent, t = root, t.parent
+    return root
+
+def list_elem(t):
+    if type(t) is TList:
+        return t.elem
+    elif t.arg is not None:
+        return t.arg
+    return None
+
+def occurs(v, t):
+    t = find(t)
+    if t is v:
+        return True
+    elif type(t) is TList:
+        return occurs(v, t.elem)
+    return type(t) is not TVar and t.has_vars and t.arg is not None and occurs(v, t.arg)
+
+def bind(v, t):
+    if type(t) is TVar:
+        # union by rank
+        if v.rank > t.rank:
+            v, t = t, v
+        elif v.rank == t.rank:
+            t.rank += 1
+    elif occurs(v, t):
+        return False
+    v.parent = t
+    return True
+
+def unify(a, b):
+    a = find(a)
+    b = find(b)
+    if a is b:
+        return True
+    elif type(a) is TVar:
+        return bind(a, b)
+    elif type(b) is TVar:
+        return bind(b, a)
+    ea = list_elem(a)
+    eb = list_elem(b)
+    if ea is None or eb is None:
+        return False
+    return unify(ea, eb)
+
+# copy of a type scheme with fresh TVars for its T_n variables
+def instantiate(t, fresh):
+    if type(t) is TVar or type(t) is TList:
+        # a define nested in call arguments, monomorphic until its form is done
+        return t
+    elif not t.has_vars:
+        return t
+    elif t.arg is not None:
+        return TList(instantiate(t.arg, fresh))
+    v = fresh.get(t)
+    if v is None:
+        v = fresh[t] = TVar()
+    return v
+
+class Inference(object):
+    def __init__(self, funcstack):
+        self.funcstack = funcstack
+        # defines currently being inferred: name -> (param types, result type)
+        self.recursive = {}
+        # generalized variables handed out by zonk
+        self.generalized = {}
+
+    def invalid(self, ast, error, **changes):
+        return ast.replace(vtype=INVALID, error=error, **changes)
+
+    def infer(self, ast, env):
+        ntype = ast['ntype']
+        if ntype == Nodes.NUM:
+            return ast.replace(vtype=NUM)
+        elif ntype == Nodes.BOOL:
+            return ast.replace(vtype=BOOL)
+        elif ntype == Nodes.IDENT:
+            if ast['value'] not in env:
+                return self.invalid(ast, 'unknown identifier')
+            return ast.replace(vtype=env[ast['value']])
+        elif ntype == Nodes.FUNC:
+            return self.infer_func(ast, env)
+        elif ntype == Nodes.LET:
+            env = dict(env)
+            bindings = []
+            for ident, expr in ast['bindings']:
+                # do not allow effective defines in lets. create a new scope and pop it immediately
+                self.funcstack.push()
+                typed = self.infer(expr, env)
+                self.funcstack.pop()
+                bindings.append((ident, typed))
+                env[ident['value']] = typed['vtype']
+            expr = self.infer(ast['expr'], env)
+            return ast.replace(vtype=expr['vtype'], bindings=bindings, expr=expr)
+        elif ntype == Nodes.IF:
+            test = self.infer(ast['testexpr'], env)
+            true = self.infer(ast['trueexpr'], env)
+            false = self.infer(ast['falseexpr'], env)
+            typed = {'testexpr': test, 'trueexpr': true, 'falseexpr': false}
+            if find(test['vtype']) is INVALID or not unify(test['vtype'], BOOL):
+                return self.invalid(ast, 'test not boolean', **typed)
+            elif find(true['vtype']) is INVALID or find(false['vtype']) is INVALID or not unify(true['vtype'], false['vtype']):
+                return self.invalid(ast, 'branch type mismatch', **typed)
+            return ast.replace(vtype=true['vtype'], **typed)
+        elif ntype == Nodes.DEFINE:
+            return self.infer_define(ast, env)
+        return self.invalid(ast, 'unknown node type')
+
+    def infer_func(self, ast, env):
+        name = ast['func']['value']
+        if name in self.recursive:
+            intypes, outtype = self.recursive[name]
+        elif name in self.funcstack:
+            funcdef = self.funcstack[name]
+            if funcdef.get('vtype') is INVALID:
+                return self.invalid(ast, 'invalid func')
+            fresh = {}
+            intypes = [instantiate(t, fresh) for t in funcdef['intypes']]
+            outtype = instantiate(funcdef['outtype'], fresh)
+            if 'variadic' in funcdef and len(ast['args']) > len(intypes):
+                # every further argument has the type of the last
+                intypes += [intypes[-1]] * (len(ast['args']) - len(intypes))
+        else:
+            return self.invalid(ast, 'unknown func')
+        if len(ast['args']) != len(intypes):
+            return self.invalid(ast, 'arity mismatch')
+
+        # allow same-level defines in func args to allow for seq
+        scoped = any(arg['ntype'] == Nodes.DEFINE for arg in ast['args'])
+        if scoped: self.funcstack.push()
+        args = [self.infer(arg, env) for arg in ast['args']]
+        if scoped: self.funcstack.pop()
+
+        for arg, intype in zip(args, intypes):
+            if find(arg['vtype']) is INVALID:
+                return self.invalid(ast, 'invalid argument', args=args)
+            if not unify(intype, arg['vtype']):
+                return self.invalid(ast, 'type mismatch', args=args)
+        return ast.replace(vtype=outtype, args=args)
+
+    def infer_define(self, ast, env):
+        name = ast['func']['value']
+        intypes = [TVar() for param in ast['params']]
+        outtype = TVar()
+        env = dict(env)
+        for param, intype in zip(ast['params'], intypes):
+            env[param['value']] = intype
+        self.recursive[name] = (intypes, outtype)
+        expr = self.infer(ast['expr'], env)
+        del self.recursive[name]
+        if find(expr['vtype']) is INVALID:
+            typed = self.invalid(ast, 'invalid body', expr=expr, intypes=intypes, outtype=outtype)
+        else:
+            unify(outtype, expr['vtype'])
+            typed = ast.replace(vtype=VOID, expr=expr, intypes=intypes, outtype=outtype)
+        self.funcstack.define(name, typed)
+        return typed
+
+    # interned term for an inference type
+    def resolve(self, t):
+        t = find(t)
+        if type(t) is TVar:
+            v = self.generalized.get(t)
+            if v is None:
+                v = self.generalized[t] = Var(len(self.generalized) + 1)
+            return v
+        elif type(t) is TList:
+            return List(self.resolve(t.elem))
+        return t
+
+    # replace inference types in a freshly inferred tree, in place
+    def zonk(self, ast):
+        if 'vtype' in ast:
+            ast['vtype'] = self.resolve(ast['vtype'])
+        ntype = ast['ntype']
+        if ntype == Nodes.FUNC:
+            for arg in ast['args']:
+                self.zonk(arg)
+        elif ntype == Nodes.LET:
+            for ident, expr in ast['bindings']:
+                self.zonk(expr)
+            self.zonk(ast['expr'])
+        elif ntype == Nodes.IF:
+            self.zonk(ast['testexpr'])
+            self.zonk(ast['trueexpr'])
+            self.zonk(ast['falseexpr'])
+        elif ntype == Nodes.DEFINE:
+            ast['intypes'] = [self.resolve(t) for t in ast['intypes']]
+            ast['outtype'] = self.resolve(ast['outtype'])
+            self.zonk(ast['expr'])
+        return ast
+
+# return ast typed with 'vtype' (a new copy of it)
+# funcstack may be modified with top-level defs
+def vtype(ast, funcstack):
+    inference = Inference(funcstack)
+    return inference.zonk(inference.infer(ast, {}))
@@ -0,0 +1,103 @@
+from timeit import default_timer as timer
+
+# Opt-in limits on evaluation, for running programs that cannot be trusted
+# to finish.  A Limits given to execute() bounds
+#
+# - fuel: how many steps a run may take, where a step is a call of a user
+#   function (tail calls included), so every loop takes at least one per turn
+# - seconds: wall time from the start of the run, checked every CLOCK steps
+# - cells: how many list cells cons, range and the element-wise builtins may
+#   allocate, counted before they allocate them
+#
+# Backends only compile these checks in when limits are given: every user
+# function takes a step on entry, inlined into the function the closure and
+# interpret backends call and as an instruction of its own on the stack
+# machine and the vm, and list builtins are called through a wrapper that
+# counts their cells.  A step is a counter increment and a comparison, with
+# the clock and the fuel left both folded into the step count at which
+# check() next needs to look.
+#
+# Going over a limit raises LimitExceeded, which the pipeline turns into an
+# invalid node for the form with the error as its message; so does running
+# out of python stack in the recursive backends.
+
+# steps between looks at the clock
+CLOCK = 256
+
+class LimitExceeded(Exception):
+    pass
+
+# cells a list builtin allocates, from its raw arguments; cons never copies
+# its tail, even one another cons shares (see lists), so the cells counted
+# bound the memory lists take
+def one(args):
+    return 1
+
+def count(args):
+    return max(0, args[0])
+
+def mapped(args):
+    return args[1][1]
+
+CELLS = {'cons': one, 'range': count, 'map-add': mapped, 'map-mul': mapped}
+
+class Limits(object):
+    def __init__(self, fuel=None, seconds=None, cells=None):
+        self.fuel = fuel
+        self.seconds = seconds
+        self.cells = cells
+        self.start()
+
+    # start a run: no steps or cells used yet, and the clock running
+    def start(self):
+        self.steps = 0
+        self.allocated = 0
+        self.deadline = timer() + self.seconds if self.seconds is not None else None
+        self.plan()
+
+    # the step count at which step() next calls check()
+    def plan(self):
+        limit = self.fuel + 1 if self.fuel is not None else float('inf')
+        if self.deadline is not None:
+            limit = min(limit, self.steps + CLOCK)
+        self.next_check = limit
+
+    def step(self):
+        self.steps += 1
+        if self.steps >= self.next_check:
+            self.check()
+
+    def check(self):
+        if self.fuel is not None and self.steps > self.fuel:
+            raise LimitExceeded("out of fuel after %d steps" % self.fuel)
+        if self.deadline is not None and timer() > self.deadline:
+            raise LimitExceeded("deadline of %g seconds exceeded" % self.seconds)
+        self.plan()
+
+    def allocate(self, n):
+        self.allocated += n
+        if self.cells is not None and self.allocated > self.cells:
+            raise LimitExceeded("list cell limit of %d exceeded" % self.cells)
+
+    def counts(self, name):
+        return name in CELLS
+
+    # raw builtin fn of name, counting the cells it allocates if it is a
+    # list builtin
+    def builtin(self, name, fn):
+        cost = CELLS.get(name)
+        if cost is None:
+            return fn
+        allocate = self.allocate
+        def counted(*args):
+            allocate(cost(args))
+            return fn(*args)
+        return counted
+
+# the error of a failed evaluation that limits explain, or None
+def exceeded(e):
+    if isinstance(e, LimitExceeded):
+        return str(e)
+    elif isinstance(e, RuntimeError) and 'recursion' in str(e):
+        return "recursion too deep"
+    return None
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import unittest
+import sexp
+from limits import Limits, LimitExceeded
+
+LOOP = "(define (loop n) (if (eq n 0) 0 (loop (sub n 1))))"
+BUILD = "(define (build n acc) (if (eq n 0) acc (build (sub n 1) (cons n acc))))"
+SPIN = "(define (spin n) (spin (add n 1)))"
+
+BACKENDS = sorted(sexp.BACKENDS)
+
+class TestLimits(unittest.TestCase):
+
+    def results(self, prog, backend, limits):
+        return [sexp.show(res) for res, _ in sexp.execute(prog, backend, limits=limits)]
+
+    def test_fuel(self):
+        for backend in BACKENDS:
+            # a step per call, so (loop n) takes n + 1
+            limits = Limits(fuel=30)
+            self.assertEqual([None, "0", "0", "error: out of fuel after 30 steps"],
+                             self.results(LOOP + " (loop 10) (loop 18) (loop 0)", backend, limits), backend)
+            self.assertEqual(31, limits.steps, backend)
+
+    def test_fuel_restarts(self):
+        limits = Limits(fuel=5)
+        for i in xrange(2):
+            self.assertEqual([None, "0"], self.results(LOOP + " (loop 4)", 'vm', limits))
+
+    def test_deadline(self):
+        for backend in ['stack', 'vm']:
+            self.assertEqual([None, "error: deadline of 0.05 seconds exceeded"],
+                             self.results(SPIN + " (spin 0)", backend, Limits(seconds=0.05)), backend)
+
+    def test_cells(self):
+        for backend in BACKENDS:
+            prog = BUILD + " (length (build 20 (nil))) (length (range 80)) (length (map-add 1 (range 10)))"
+            self.assertEqual([None, "20", "80", "error: list cell limit of 110 exceeded"],
+                             self.results(prog, backend, Limits(cells=110)), backend)
+
+    def test_shared_cells(self):
+        # every cons onto xs shares it, and is charged only the cell it adds
+        prog = ("(define (g n xs acc) (if (eq n 0) (length acc) (g (sub n 1) xs (cons (cons 0 xs) acc))))"
+                " (g 2000 (range 200000) (nil))")
+        for backend in ['vm', 'stack']:
+            limits = Limits(cells=204000)
+            self.assertEqual([None, "2000"], self.results(prog, backend, limits), backend)
+            self.assertEqual(204000, limits.allocated)
+            self.assertEqual([None, "error: list cell limit of 203999 exceeded"],
+                             self.results(prog, backend, Limits(cells=203999)), backend)
+
+    def test_recursion(self):
+        for backend in ['closure', 'interpret']:
+            self.assertEqual([None, "error: recursion too deep"],
+                             self.results(SPIN + " (spin 0)", backend, Limits()), backend)
+
+    def test_step(self):
+        limits = Limits(fuel=2)
+        limits.step()
+        limits.step()
+        self.assertRaises(LimitExceeded, limits.step)
+
+if __name__ == '__main__':
+    unittest.main()
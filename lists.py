@@ -0,0 +1,114 @@
+from array import array
+from itertools import chain, islice, repeat
+import operator
+
+# Raw list values, shared by every backend.
+#
+# A list is a triple (buf, size, rest) of size elements: buf[n-1], buf[n-2],
+# ..., buf[0], where n is size less the size of rest, followed by the
+# elements of rest, so the head is at the end of the buffer and the empty
+# list has size 0.  Lists of numbers keep their buffers in arrays of 64-bit
+# integers and everything else in python lists, so a long list costs a word
+# per element rather than a cons cell and a node or two.
+#
+# cons appends its head to the tail's buffer when the tail owns the end of it,
+# that is when nothing has been consed onto the same tail before, and starts
+# a buffer of its own, with the tail as its rest, otherwise.  Either way
+# every older list still sees only its own elements, so lists stay
+# immutable, every cons takes constant time and allocates one element, and
+# tails share storage.  A list built by repeated cons is a single buffer.
+#
+# Bulk builtins (length, sum, range and the element-wise arithmetic) run over
+# whole buffers in C loops.
+
+NIL = (None, 0, None)
+
+# python 2's array has no 'q', but 'l' is 64 bits wide on 64-bit unix
+try:
+    INTS = array('q').typecode
+except ValueError:
+    INTS = 'l'
+
+# a buffer for elements in buffer order, as an array if they are all machine
+# integers; bools are ints too, so their type is checked first
+def buffer(values):
+    if values and type(values[0]) is not bool and type(values[0]) in (int, long):
+        try:
+            return array(INTS, values)
+        except (OverflowError, TypeError):
+            pass
+    return list(values)
+
+def cons(x, l):
+    buf, size, rest = l
+    if size == 0:
+        return (buffer([x]), 1, NIL)
+    elif len(buf) == size - rest[1]:
+        try:
+            buf.append(x)
+            return (buf, size + 1, rest)
+        except (OverflowError, TypeError):
+            # past the range of the array, so x goes in a buffer of its own
+            pass
+    return (buffer([x]), size + 1, l)
+
+def head(l):
+    buf, size, rest = l
+    return buf[size - rest[1] - 1]
+
+def tail(l):
+    buf, size, rest = l
+    return (buf, size - 1, rest) if size - 1 > rest[1] else rest
+
+def length(l):
+    return l[1]
+
+# (buf, n) for the buffer of l and of every rest after it
+def chunks(l):
+    out = []
+    while l[1]:
+        buf, size, rest = l
+        out.append((buf, size - rest[1]))
+        l = rest
+    return out
+
+# the elements of l, first to last
+def items(l):
+    for buf, n in chunks(l):
+        for i in xrange(n - 1, -1, -1):
+            yield buf[i]
+
+def from_items(values):
+    values = list(values)
+    if not values:
+        return NIL
+    values.reverse()
+    return (buffer(values), len(values), NIL)
+
+def total(l):
+    return sum(sum(buf) if len(buf) == n else sum(islice(buf, n)) for buf, n in chunks(l))
+
+# (range n) is the list 0, 1, ..., n-1
+def numbers(n):
+    if n <= 0:
+        return NIL
+    return (array(INTS, xrange(n - 1, -1, -1)), n, NIL)
+
+def elementwise(op):
+    def apply(k, l):
+        size = l[1]
+        if size == 0:
+            return NIL
+        # the elements in buffer order, last to first
+        values = chain.from_iterable(islice(buf, n) for buf, n in reversed(chunks(l)))
+        return (buffer(map(op, values, repeat(k, size))), size, NIL)
+    return apply
+
+map_add = elementwise(operator.add)
+map_mul = elementwise(operator.mul)
+
+# hashable copy of a raw value that may be a list, for memo keys
+def freeze(value):
+    if type(value) is tuple:
+        return tuple(freeze(x) for x in items(value))
+    return value
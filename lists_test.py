@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import unittest
+from array import array
+from itertools import islice
+import lists
+import sexp
+
+class TestLists(unittest.TestCase):
+
+    def test_cons(self):
+        xs = lists.cons(1, lists.cons(2, lists.NIL))
+        self.assertEqual([1, 2], list(lists.items(xs)))
+        self.assertTrue(isinstance(xs[0], array))
+        # both conses onto xs see their own head; the second links to xs
+        ys = lists.cons(3, xs)
+        zs = lists.cons(4, xs)
+        self.assertTrue(ys[0] is xs[0])
+        self.assertTrue(zs[2] is xs)
+        self.assertEqual(1, len(zs[0]))
+        self.assertEqual([3, 1, 2], list(lists.items(ys)))
+        self.assertEqual([4, 1, 2], list(lists.items(zs)))
+        self.assertEqual([1, 2], list(lists.items(xs)))
+        self.assertEqual(2, lists.head(lists.tail(xs)))
+
+    def test_shared_tail(self):
+        xs = lists.numbers(100000)
+        heads = [lists.cons(k, xs) for k in xrange(3)] + [lists.cons(True, xs)]
+        # no cons copies the tail
+        for l in heads[1:]:
+            self.assertEqual(1, len(l[0]))
+        self.assertEqual(100001, len(xs[0]))
+        for k, l in enumerate(heads[:3]):
+            self.assertEqual(k, lists.head(l))
+            self.assertEqual(100001, lists.length(l))
+            self.assertEqual(k + 100000 * 99999 / 2, lists.total(l))
+            self.assertEqual(xs, lists.tail(l))
+            self.assertEqual([k, 0, 1], list(islice(lists.items(l), 3)))
+        self.assertEqual([True, 0, 1], list(islice(lists.items(heads[3]), 3)))
+        doubled = lists.map_mul(2, lists.cons(7, heads[1]))
+        self.assertEqual([14, 2, 0, 2, 4], list(islice(lists.items(doubled), 5)))
+        self.assertEqual(100002, lists.length(doubled))
+        prog = "(define (f xs) (cons (sum (cons 20 xs)) (cons 10 xs))) (f (range 5))"
+        for backend in ['vm', 'stack', 'closure']:
+            results = [sexp.show(res) for res, _ in sexp.execute(prog, backend)]
+            self.assertEqual([None, "(30 10 0 1 2 3 4)"], results)
+
+    def test_types(self):
+        bools = lists.from_items([True, False])
+        self.assertEqual([True, False], list(lists.items(bools)))
+        self.assertTrue(type(bools[0]) is list)
+        big = lists.cons(2 ** 70, lists.from_items([1, 2]))
+        self.assertEqual([2 ** 70, 1, 2], list(lists.items(big)))
+        self.assertEqual(2 ** 70 + 3, lists.total(big))
+        nested = lists.from_items([lists.from_items([1]), lists.NIL])
+        self.assertEqual(((1,), ()), lists.freeze(nested))
+
+    def test_bulk(self):
+        xs = lists.numbers(5)
+        self.assertEqual([0, 1, 2, 3, 4], list(lists.items(xs)))
+        self.assertEqual(10, lists.total(xs))
+        self.assertEqual(5, lists.length(xs))
+        self.assertEqual([0, 3, 6, 9, 12], list(lists.items(lists.map_mul(3, xs))))
+        self.assertEqual([1, 2, 3, 4, 5], list(lists.items(lists.map_add(1, xs))))
+        # sums only the elements of the list, not ones consed onto its buffer
+        lists.cons(100, xs)
+        self.assertEqual(10, lists.total(xs))
+        self.assertEqual(lists.NIL, lists.numbers(0))
+
+    def test_long(self):
+        prog = "(define (build n acc) (if (eq n 0) acc (build (sub n 1) (cons n acc)))) (sum (build 100000 (nil)))"
+        for backend in ['vm', 'stack']:
+            results = [sexp.show(res) for res, _ in sexp.execute(prog, backend)]
+            self.assertEqual([None, str(100000 * 100001 / 2)], results)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+from stypes import *
+from compiler import Slots, is_invalid, nested_scope, raw_for, result, unbound
+
+# An evaluator that keeps its own continuation stack instead of recursing on
+# the python stack, so recursion depth is limited only by the heap.
+#
+# Typed ASTs are lowered to nested instruction tuples with slot-indexed
+# locals, as in compiler.  The machine loop evaluates an instruction until it
+# has a value, then pops continuations to decide what to do with it.  Every
+# continuation carries the frame it resumes in, so calling a user function
+# only swaps the current code and frame: a call in tail position pushes
+# nothing and runs in constant space.
+#
+# With limits, every function body starts with a CHECK that takes a step
+# before running the rest of it, see limits.
+#
+# A define nested in a form is a PRIM over the variables it captures, which
+# binds the function to a frame that starts with them after the arguments,
+# as in compiler.
+
+CONST, LOCAL, IF, LET, PRIM, CALL, CHECK = range(7)
+K_IF, K_LET, K_ARGS = range(3)
+
+def lower(ast, funcstack, scope, slots):
+    ntype = ast['ntype']
+    if ntype == Nodes.NUM or ntype == Nodes.BOOL:
+        return (CONST, ast['value'])
+    elif ntype == Nodes.IDENT:
+        return (LOCAL, scope[ast['value']])
+    elif ntype == Nodes.LET:
+        scope = dict(scope)
+        stores = []
+        for ident, expr in ast['bindings']:
+            code = lower(expr, funcstack, scope, slots)
+            scope[ident['value']] = slot = slots.alloc()
+            stores.append((slot, code))
+        return (LET, stores, lower(ast['expr'], funcstack, scope, slots))
+    elif ntype == Nodes.IF:
+        return (IF, lower(ast['testexpr'], funcstack, scope, slots),
+                    lower(ast['trueexpr'], funcstack, scope, slots),
+                    lower(ast['falseexpr'], funcstack, scope, slots))
+    elif ntype == Nodes.FUNC:
+        funcdef = funcstack[ast['func']['value']]
+        args = [lower(arg, funcstack, scope, slots) for arg in ast['args']]
+        if 'raw' in funcdef:
+            fn = raw_for(funcdef, len(args))
+            if funcstack.limits is not None:
+                fn = funcstack.limits.builtin(ast['func']['value'], fn)
+            return (PRIM, fn, args)
+        return (CALL, funcdef, args)
+    elif ntype == Nodes.DEFINE:
+        return lower_nested_define(ast, funcstack, scope)
+    raise Exception("Cannot lower node type "+ntype)
+
+# the body of a define in scope, and the size of its frame
+def lower_body(ast, funcstack, scope):
+    slots = Slots(len(scope))
+    body = lower(ast['expr'], funcstack, scope, slots)
+    if funcstack.limits is not None:
+        body = (CHECK, funcstack.limits.step, body)
+    return body, slots.size
+
+def lower_define(ast, funcstack):
+    funcdef = funcstack[ast['func']['value']]
+    params = ast['params']
+    body, size = lower_body(ast, funcstack, dict((params[i]['value'], i) for i in xrange(len(params))))
+    funcdef['machine'] = (body, [None] * (size - len(params)))
+
+def lower_nested_define(ast, funcstack, scope):
+    captured, inner = nested_scope(ast, scope)
+    ast['machine'] = ((PRIM, unbound(ast['func']['value']), []), [])
+    body, size = lower_body(ast, funcstack, inner)
+    pad = [None] * (size - len(inner))
+    def bind(*values):
+        ast['machine'] = (body, list(values) + pad)
+    return (PRIM, bind, [(LOCAL, slot) for slot, ident in captured])
+
+def execute(code, frame):
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    while True:
+        # evaluate code until there is a value or a continuation to follow
+        op = code[0]
+        if op == CONST:
+            value = code[1]
+        elif op == LOCAL:
+            value = frame[code[1]]
+        elif op == IF:
+            push((K_IF, code, frame))
+            code = code[1]
+            continue
+        elif op == LET:
+            stores = code[1]
+            push((K_LET, code, frame, 0))
+            code = stores[0][1]
+            continue
+        elif op == CHECK:
+            code[1]()
+            code = code[2]
+            continue
+        else:
+            args = code[2]
+            if args:
+                push((K_ARGS, code, frame, []))
+                code = args[0]
+                continue
+            elif op == PRIM:
+                value = code[1]()
+            else:
+                body, pad = code[1]['machine']
+                code, frame = body, list(pad)
+                continue
+
+        # pass the value to continuations until one has more code to run
+        while True:
+            if not stack:
+                return value
+            k = pop()
+            kind = k[0]
+            if kind == K_IF:
+                frame = k[2]
+                code = k[1][2] if value else k[1][3]
+                break
+            elif kind == K_LET:
+                frame = k[2]
+                stores = k[1][1]
+                i = k[3]
+                frame[stores[i][0]] = value
+                i += 1
+                if i < len(stores):
+                    push((K_LET, k[1], frame, i))
+                    code = stores[i][1]
+                else:
+                    code = k[1][2]
+                break
+            else:
+                values = k[3]
+                values.append(value)
+                instr = k[1]
+                args = instr[2]
+                if len(values) < len(args):
+                    push(k)
+                    frame = k[2]
+                    code = args[len(values)]
+                    break
+                elif instr[0] == PRIM:
+                    value = instr[1](*values)
+                else:
+                    # the call replaces the current code and frame, so a
+                    # tail call leaves nothing behind on the stack
+                    body, pad = instr[1]['machine']
+                    code, frame = body, values + pad
+                    break
+
+# LOWER pass: annotate valid expressions with their instructions
+def lower_ast(ast, funcstack):
+    if is_invalid(ast):
+        return ast
+    elif ast['ntype'] == Nodes.DEFINE:
+        lower_define(ast, funcstack)
+        return ast
+    slots = Slots()
+    code = lower(ast, funcstack, {}, slots)
+    return ast.replace(code=(code, slots.size))
+
+# MACHINE pass: run the instructions and box the result
+def run(ast, funcstack):
+    if 'code' not in ast:
+        return ast
+    code, size = ast['code']
+    return result(execute(code, [None] * size), ast)
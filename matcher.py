@@ -1,12 +1,17 @@
-
+from itertools import imap
 import stypes
 
 class Matcher:
     VERBOSE = False
 
-    def __init__(self, name, matchf):
+    # kind and args describe the combinator so compile() can flatten it; a
+    # matcher built directly from a matchf has kind None and stays opaque
+    def __init__(self, name, matchf, kind=None, args=()):
         self.name = name
         self.matchf = matchf
+        self.kind = kind
+        self.args = args
+        self.predicate = None
     def _return(self, val, depth=0):
         if self.VERBOSE:
             result = "SUCCEEDED" if val else "FAILED"
@@ -18,22 +23,213 @@ class Matcher:
             return self._return(self.matchf(other, depth), depth)
         except Exception:
             return self._return(False, depth)
+    # a plain predicate with the same result as matches(other, 0), minus the
+    # tracing and per-combinator overhead
+    def compile(self):
+        if self.predicate is None:
+            self.predicate = _compiler.compile(self)
+        return self.predicate
     def __eq__(self, other):
         return self.matches(other, 0)
     def __and__(self, second):
-        return Matcher("("+self.name+" and "+second.name+")", lambda o, d: self.matches(o, d+1) and second.matches(o, d+1))
+        return Matcher("("+self.name+" and "+second.name+")", lambda o, d: self.matches(o, d+1) and second.matches(o, d+1), 'and', (self, second))
     def __or__(self, second):
-        return Matcher("("+self.name+" or "+second.name+")", lambda o, d: self.matches(o, d+1) or second.matches(o, d+1))
+        return Matcher("("+self.name+" or "+second.name+")", lambda o, d: self.matches(o, d+1) or second.matches(o, d+1), 'or', (self, second))
     def __invert__(self):
-        return Matcher("(not "+self.name+")", lambda o, d: not self.matches(o, d+1))
+        return Matcher("(not "+self.name+")", lambda o, d: not self.matches(o, d+1), 'not', (self,))
+
+
+has_ = lambda x: Matcher("has "+str(x), lambda o, d: x in o, 'has', (x,))
+equals_ = lambda x, y: Matcher("equals "+str(x)+" "+str(y), lambda o, d: o[x] == y, 'equals', (x, y))
+matches_ = lambda x, m: Matcher("matches "+str(x), lambda o, d: m.matches(o[x], d+1), 'matches', (x, m))
+typed_ = lambda x, t: Matcher("typed "+str(x), lambda o, d: type(o[x]) == t, 'typed', (x, t))
+all_ = lambda x, m: Matcher("all "+str(x), lambda o, d: all(m.matches(c, d+1) for c in o[x]), 'all', (x, m))
+any_ = lambda x, m: Matcher("any "+str(x), lambda o, d: any(m.matches(c, d+1) for c in o[x]), 'any', (x, m))
+
+# Compiles matcher trees into python source.  Each matcher becomes one
+# function over the matched object: 'and'/'or' chains are flattened into a
+# single short-circuiting expression with repeated conjuncts dropped, an
+# 'or' whose alternatives test different ntypes becomes a dict lookup on
+# ntype, and a matcher that is reached twice (ntyped, primitive, ...) is
+# compiled once and called by name.  Every generated function catches
+# exceptions and returns False, like matches(); negations and child objects
+# go through their own function so an exception only fails the matcher that
+# raised it.
+
+def _all(f, o, x):
+    try:
+        return all(imap(f, o[x]))
+    except Exception:
+        return False
+
+def _any(f, o, x):
+    try:
+        return any(imap(f, o[x]))
+    except Exception:
+        return False
+
+def _false(o):
+    return False
+
+def key(m):
+    if not isinstance(m, Matcher):
+        # not a matcher at all, so matching anything against it fails
+        return ('opaque', None)
+    elif m.kind is None:
+        return ('opaque', id(m))
+    elif m.kind in ('and', 'or'):
+        return (m.kind, tuple(key(c) for c in flatten(m, m.kind)))
+    elif m.kind in ('matches', 'all', 'any'):
+        return (m.kind, m.args[0], key(m.args[1]))
+    elif m.kind == 'not':
+        return ('not', key(m.args[0]))
+    return (m.kind,) + m.args
+
+# operands of a chain of 'and' or 'or', without repeats
+def flatten(m, kind):
+    if not isinstance(m, Matcher) or m.kind != kind:
+        return [m]
+    out = []
+    seen = set()
+    for child in m.args:
+        for c in flatten(child, kind):
+            k = key(c)
+            if k not in seen:
+                seen.add(k)
+                out.append(c)
+    return out
+
+# the ntype an 'and' chain requires, if any
+def required_ntype(m):
+    for c in flatten(m, 'and'):
+        if isinstance(c, Matcher) and c.kind == 'equals' and c.args[0] == 'ntype':
+            return c.args[1]
+    return None
+
+class Compiler(object):
+    def __init__(self):
+        self.env = {'_all': _all, '_any': _any, '_false': _false}
+        self.names = {}
+        self.consts = {}
+        self.lines = []
+
+    def compile(self, m):
+        name = self.func(m)
+        if self.lines:
+            source = "\n".join(self.lines)
+            self.lines = []
+            exec compile(source, "<matcher>", "exec") in self.env
+        return self.env[name]
+
+    def const(self, value):
+        k = (type(value), value)
+        if k not in self.consts:
+            self.consts[k] = "c%d" % len(self.consts)
+            self.env[self.consts[k]] = value
+        return self.consts[k]
+
+    # name of the generated function for m
+    def func(self, m, exclude=()):
+        k = (key(m), exclude)
+        if k in self.names:
+            return self.names[k]
+        if not isinstance(m, Matcher):
+            return '_false'
+        name = self.names[k] = "m%d" % len(self.names)
+        if m.kind is None:
+            self.env[name] = lambda o: m.matches(o, 0)
+            return name
+        body = self.expr(m, exclude)
+        self.lines.append("def %s(o):\n    try:\n        return %s\n    except Exception:\n        return False\n" % (name, body))
+        return name
+
+    # exclude holds keys of conjuncts already known to hold, present the
+    # keys an earlier conjunct has shown to be in o
+    def expr(self, m, exclude=(), present=()):
+        if not isinstance(m, Matcher):
+            return 'False'
+        kind = m.kind
+        if kind == 'and':
+            present = set(present)
+            present.update(k[1] for k in exclude if k[0] == 'has')
+            parts = []
+            for c in flatten(m, 'and'):
+                if key(c) in exclude:
+                    continue
+                parts.append(self.expr(c, (), present))
+                if c.kind in ('has', 'equals', 'typed', 'matches'):
+                    present.add(c.args[0])
+            return "(" + " and ".join(parts) + ")" if parts else 'True'
+        elif kind == 'or':
+            return self.alternatives(flatten(m, 'or'))
+        elif kind == 'not':
+            return "not %s(o)" % self.func(m.args[0])
+        elif kind is None:
+            return "%s(o)" % self.func(m)
+        x = m.args[0]
+        # a missing key fails the leaf without raising; integer keys index
+        # sequences such as let bindings, where 'in' would test for a value
+        guard = "%r in o and " % x if isinstance(x, basestring) and x not in present else ""
+        if kind == 'has':
+            return "%r in o" % x
+        elif kind == 'equals':
+            return "(%so[%r] == %s)" % (guard, x, self.const(m.args[1]))
+        elif kind == 'typed':
+            return "(%stype(o[%r]) is %s)" % (guard, x, self.const(m.args[1]))
+        elif kind == 'matches':
+            return "(%s%s(o[%r]))" % (guard, self.func(m.args[1]), x)
+        elif kind == 'all':
+            return "_all(%s, o, %r)" % (self.func(m.args[1]), x)
+        elif kind == 'any':
+            return "_any(%s, o, %r)" % (self.func(m.args[1]), x)
+        raise Exception("Cannot compile matcher kind "+kind)
+
+    def alternatives(self, alts):
+        groups = {}
+        order = []
+        rest = []
+        for alt in alts:
+            ntype = required_ntype(alt)
+            if ntype is None:
+                rest.append(alt)
+            else:
+                if ntype not in groups:
+                    groups[ntype] = []
+                    order.append(ntype)
+                groups[ntype].append(alt)
+        if len(order) < 2:
+            parts = [self.expr(alt) for alt in alts]
+            return "(" + " or ".join(parts) + ")" if parts else 'False'
+        # branch on ntype; each branch already knows the ntype test holds
+        table = {}
+        for ntype in order:
+            known = (('has', 'ntype'), ('equals', 'ntype', ntype))
+            names = [self.func(alt, known) for alt in groups[ntype]] + [self.func(alt) for alt in rest]
+            table[ntype] = self.branch(names)
+        default = self.branch([self.func(alt) for alt in rest])
+        return "%s.get(o['ntype'] if 'ntype' in o else None, %s)(o)" % (self.const_table(table), default)
+
+    # one function or-ing the named functions
+    def branch(self, names):
+        if not names:
+            return '_false'
+        elif len(names) == 1:
+            return names[0]
+        k = ('branch', tuple(names))
+        if k not in self.names:
+            name = self.names[k] = "m%d" % len(self.names)
+            calls = " or ".join("%s(o)" % n for n in names)
+            self.lines.append("def %s(o):\n    return %s\n" % (name, calls))
+        return self.names[k]
 
+    def const_table(self, table):
+        name = "t%d" % len(self.consts)
+        self.consts[('table', name)] = name
+        source = ", ".join("%r: %s" % (ntype, f) for ntype, f in sorted(table.items()))
+        self.lines.append("%s = {%s}\n" % (name, source))
+        return name
 
-has_ = lambda x: Matcher("has "+x, lambda o, d: x in o)
-equals_ = lambda x, y: Matcher("equals "+x+" "+str(y), lambda o, d: o[x] == y)
-matches_ = lambda x, m: Matcher("matches "+x, lambda o, d: m.matches(o[x], d+1))
-typed_ = lambda x, t: Matcher("typed "+x, lambda o, d: type(o[x]) == t)
-all_ = lambda x, m: Matcher("all "+x, lambda o, d: all(m.matches(c, d+1) for c in o[x]))
-any_ = lambda x, m: Matcher("any "+x, lambda o, d: any(m.matches(c, d+1) for c in o[x]))
+_compiler = Compiler()
 
 class ASTMatchers:
     # basic matches
@@ -43,7 +239,7 @@ class ASTMatchers:
     mbool = primitive & equals_('ntype', stypes.Nodes.BOOL) & typed_('value', bool)
     ident = primitive & equals_('ntype', stypes.Nodes.IDENT) & typed_('value', str)
     func = ~primitive & equals_('ntype', stypes.Nodes.FUNC) & all_('args', ntyped) & matches_('func', ident)
-    let = ~primitive & equals_('ntype', stypes.Nodes.LET) & all_('bindings', lambda o, d: ident.matches(o[0], d+1) and ntyped.matches(o[1], d+1)) and matches_('expr', ntyped)
+    let = ~primitive & equals_('ntype', stypes.Nodes.LET) & all_('bindings', matches_(0, ident) & matches_(1, ntyped)) & matches_('expr', ntyped)
     define = ~primitive & equals_('ntype', stypes.Nodes.DEFINE) & all_('params', ident) & matches_('func', ident) & matches_('expr', ntyped)
     mif = ~primitive & equals_('ntype', stypes.Nodes.IF) & matches_('testexpr', ntyped) & matches_('trueexpr', ntyped) & matches_('falseexpr', ntyped)
     mlist = ~primitive & equals_('ntype', stypes.Nodes.LIST) & has_('next') & has_('current')
@@ -52,11 +248,15 @@ class ASTMatchers:
     invalid_vtype = invalid_base & equals_('vtype', stypes.type_node(stypes.Types.INVALID))
     invalid = invalid_ntype | invalid_vtype
     void = equals_('vtype', stypes.type_node(stypes.Types.VOID))
-    vtyped_basic = has_('vtype') and matches_('vtype', ntyped) and matches_('vtype', Matcher('etypes', lambda o, d: len(o['etypes']) > 0))
+    literal = num | mbool
+    foldable = (mif & matches_('testexpr', mbool)) | (let & any_('bindings', matches_(1, literal)))
+    vtyped_basic = has_('vtype') & matches_('vtype', ntyped) & matches_('vtype', Matcher('etypes', lambda o, d: len(o['etypes']) > 0))
 
     # pass matchers
     astified = num | mbool | ident | func | let | define | mif | mlist
     vtyped = astified & vtyped_basic
+    folded = vtyped & ~foldable
+    compiled = vtyped & (invalid | void | has_('code'))
     interpreted = vtyped & (invalid | primitive | void | mlist)
 
 
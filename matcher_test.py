@@ -26,6 +26,17 @@ class TestSexp(unittest.TestCase):
             actual, expected = case
             self.assertEqual(expected, actual)
 
+    def test_compiled(self):
+        objects = [case[0] for case in self.CASES] + [None, 3, 'value', (1, 2), {'ntype': stypes.Nodes.NUM}]
+        for prog in ["(define (f x) (add x 1))", "(let ((a (f 2))) (if a 1 2))", "(cons 1 (nil))"]:
+            for ast, funcstack in sexp.execute(prog):
+                objects.append(ast)
+        matchers = [m for m in vars(M).values() if isinstance(m, matcher.Matcher)]
+        for m in matchers + [M.num | M.func, ~M.num, ~(M.num | M.mif) & M.ntyped]:
+            predicate = m.compile()
+            for o in objects:
+                self.assertEqual(m.matches(o, 0), predicate(o), m.name)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from stypes import *
+import lists
+
+# Opt-in memoization of user functions.  Every define is pure over its
+# arguments, so a call can be answered from a cache keyed on the argument
+# values.  Each memoized function gets its own bounded LRU cache; hit, miss
+# and eviction counts are kept per function and reported by Memo.stats().
+#
+# The closure backend and the tree walker both memoize functions of raw
+# values.  The stack machine never returns through a call site and the vm
+# keeps its calls in a loop of its own, so neither memoizes, and the command
+# line rejects --memo with them.
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        # (found, value); a hit moves the entry to the recent end
+        entries = self.entries
+        if key in entries:
+            self.hits += 1
+            value = entries.pop(key)
+            entries[key] = value
+            return True, value
+        self.misses += 1
+        return False, None
+
+    def store(self, key, value):
+        entries = self.entries
+        entries[key] = value
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries)}
+
+# hashable key for raw values; lists are frozen into tuples of their
+# elements, and bools hash like ints, so a polymorphic function that may see
+# both keys on their repr
+def raw_key(args, polymorphic, has_lists=False):
+    if has_lists:
+        args = tuple(lists.freeze(a) for a in args)
+    return repr(args) if polymorphic else args
+
+def takes_lists(ast):
+    return any(t.arg is not None or t.has_vars for t in ast['intypes'])
+
+class Memo(object):
+    # names is the collection of functions to memoize, or None for all
+    def __init__(self, names=None, size=1024):
+        self.names = names
+        self.size = size
+        self.caches = {}
+
+    def wanted(self, name):
+        return self.names is None or name in self.names
+
+    def cache(self, ast):
+        # a redefinition starts over with an empty cache
+        name = ast['func']['value']
+        cache = self.caches[name] = LRUCache(self.size)
+        return cache
+
+    # memoized version of call, a function of raw values
+    def wrap_call(self, ast, call):
+        cache = self.cache(ast)
+        polymorphic = any(t.has_vars for t in ast['intypes'])
+        has_lists = takes_lists(ast)
+        def memoized(*args):
+            key = raw_key(args, polymorphic, has_lists)
+            found, value = cache.lookup(key)
+            if not found:
+                value = call(*args)
+                cache.store(key, value)
+            return value
+        return memoized
+
+    # counters for every memoized function, by name
+    def stats(self):
+        return dict((name, cache.stats()) for name, cache in self.caches.iteritems())
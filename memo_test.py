@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import subprocess
+import unittest
+import sexp
+import memo
+
+FIB = "(define (fib n) (if (lt n 2) n (add (fib (sub n 1)) (fib (sub n 2))))) (fib 30)"
+
+class TestMemo(unittest.TestCase):
+
+    def test_lru(self):
+        cache = memo.LRUCache(2)
+        cache.store(1, 'a')
+        cache.store(2, 'b')
+        self.assertEqual((True, 'a'), cache.lookup(1))
+        cache.store(3, 'c')
+        self.assertEqual((False, None), cache.lookup(2))
+        self.assertEqual((True, 'a'), cache.lookup(1))
+        self.assertEqual({'hits': 2, 'misses': 1, 'evictions': 1, 'entries': 2}, cache.stats())
+
+    def test_execute(self):
+        for backend in ['closure', 'interpret']:
+            m = memo.Memo(['fib'], 100)
+            results = [res for res, _ in sexp.execute(FIB, backend, memo=m)]
+            self.assertEqual(832040, results[-1]['value'])
+            self.assertEqual({'fib': {'hits': 28, 'misses': 31, 'evictions': 0, 'entries': 31}}, m.stats())
+
+    def test_cli(self):
+        for flags in (["-b", "stack"], ["-b", "vm"], ["--cache", "/nonexistent"]):
+            run = subprocess.Popen([sys.executable, "sexp.py", "--memo", "8", "-c", "(add 1 2)"] + flags,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(sexp.__file__)))
+            out, err = run.communicate()
+            self.assertEqual(2, run.returncode, flags)
+            self.assertTrue("--memo" in err, flags)
+        run = subprocess.Popen([sys.executable, "sexp.py", "--memo", "8", "-c", "(add 1 2)"], stdout=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.abspath(sexp.__file__)))
+        self.assertEqual("3\n", run.communicate()[0])
+
+    def test_polymorphic(self):
+        m = memo.Memo()
+        results = [res for res, _ in sexp.execute("(define (same x) x) (same 1) (same #t)", memo=m)]
+        self.assertEqual([1, True], [res['value'] for res in results[1:]])
+        self.assertTrue(results[2]['value'] is True)
+
+if __name__ == '__main__':
+    unittest.main()
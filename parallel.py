@@ -0,0 +1,142 @@
+import sexp
+
+# Evaluating the top-level forms of a program on a process pool.
+#
+#   for shown in parallel.execute(open("rules.scm"), processes=8): ...
+#
+# Every form is type checked and evaluated on its own, in a scope that holds
+# only its environment: for each function name the form calls, the latest
+# define of that name before the form.  Those are exactly the definitions the
+# form would see in a sequential run, so it gets the same result, and forms
+# that only depend on earlier defines can run in any order.  Names are found
+# on the read forms without typing them, so a local variable named like a
+# function pulls that function in too, which is harmless.
+#
+# A define inside a let, a function body or any other form binds its
+# function where it runs, for every later form to call, which environments
+# do not track; a program with one anywhere is run in order in this process
+# instead, as sexp.execute would.
+#
+# Each worker compiles a define the first time a form needs it, in the
+# define's own environment, and keeps the compiled funcdef, which goes on
+# calling the functions it was compiled against wherever it is used.
+# Results come back as show() strings, None for a define, in the order of
+# the forms.
+
+# the name a top-level form defines, or None
+def defined(form):
+    if type(form) is list and len(form) == 3 and form[0] == 'define' and type(form[1]) is list and form[1]:
+        return form[1][0]
+    return None
+
+# whether form has a define anywhere inside it
+def nests_define(form, top=True):
+    if type(form) is not list or not form:
+        return False
+    if form[0] == 'define' and not top:
+        return True
+    return any(nests_define(item, False) for item in form)
+
+# every name in head position of a list in form, which includes every
+# function the form calls
+def called(form, out=None):
+    if out is None:
+        out = set()
+    if type(form) is not list or not form:
+        return out
+    items = form
+    if form[0] == 'define' and len(form) == 3:
+        # skip the (name params...) signature
+        items = [form[2]]
+    elif type(form[0]) is str:
+        out.add(form[0])
+        items = form[1:]
+    for item in items:
+        called(item, out)
+    return out
+
+# for every form, the function names it calls that an earlier form defines,
+# mapped to the index of the latest such define
+def environments(forms):
+    latest = {}
+    envs = []
+    for form in forms:
+        envs.append(dict((name, latest[name]) for name in called(form) if name in latest))
+        name = defined(form)
+        if name is not None:
+            latest[name] = len(envs) - 1
+    return envs
+
+class Worker(object):
+    def __init__(self, forms, backend='closure', optimize=True):
+        self.forms = forms
+        self.envs = environments(forms)
+        self.passes = sexp.FRONTEND + (sexp.OPTIMIZE if optimize else []) + sexp.BACKENDS[backend]
+        self.funcstack = sexp.FuncStack(sexp.BUILTINS)
+        # index -> (funcdef, shown) for every define compiled so far
+        self.defines = {}
+
+    # show() of form index, run in a scope holding just its environment
+    def run(self, index):
+        env = [(name, self.define(i)[0]) for name, i in sorted(self.envs[index].iteritems())]
+        funcstack = self.funcstack
+        funcstack.push()
+        try:
+            for name, funcdef in env:
+                funcstack.define(name, funcdef)
+            ast = sexp.Pipeline(self.passes).run(self.forms[index], funcstack, "form %d" % (index + 1))
+            name = defined(self.forms[index])
+            return (funcstack[name] if name is not None else None), sexp.show(ast)
+        finally:
+            funcstack.pop()
+
+    # (funcdef, shown) for the define at index, compiled once; funcdefs keep
+    # what they were compiled against, so they can be used in any scope
+    def define(self, index):
+        if index not in self.defines:
+            self.defines[index] = self.run(index)
+        return self.defines[index]
+
+    def __call__(self, index):
+        if defined(self.forms[index]) is not None:
+            return self.define(index)[1]
+        return self.run(index)[1]
+
+# the worker of a pool process
+_worker = None
+
+def init_worker(forms, backend, optimize):
+    global _worker
+    _worker = Worker(forms, backend, optimize)
+
+def run_task(task):
+    return _worker(task)
+
+# show() of every form, run in order in one scope
+def sequential(forms, backend='closure', optimize=True):
+    pipeline = sexp.Pipeline(sexp.FRONTEND + (sexp.OPTIMIZE if optimize else []) + sexp.BACKENDS[backend])
+    funcstack = sexp.FuncStack(sexp.BUILTINS)
+    for index, form in enumerate(forms):
+        yield sexp.show(pipeline.run(form, funcstack, "form %d" % (index + 1)))
+
+# prog may be a string or an iterable of lines; it is read in full before
+# anything is evaluated.  processes of 1 runs every form in this process.
+def execute(prog, processes=None, backend='closure', optimize=True, chunksize=16):
+    forms = [form for form, line, col in sexp.read(prog)]
+    if any(nests_define(form) for form in forms):
+        for shown in sequential(forms, backend, optimize):
+            yield shown
+        return
+    tasks = xrange(len(forms))
+    if processes == 1:
+        worker = Worker(forms, backend, optimize)
+        for task in tasks:
+            yield worker(task)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, init_worker, (forms, backend, optimize))
+    try:
+        for shown in pool.imap(run_task, tasks, chunksize):
+            yield shown
+    finally:
+        pool.terminate()
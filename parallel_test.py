@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import unittest
+import sexp
+import parallel
+
+PROGRAM = """
+(g 1)
+(define (f x) (add x 1))
+(define (g x) (mul (f x) 2))
+(g 3)
+(define (f x) (sub x 1))
+(g 3)
+(define (g x) (f (f x)))
+(g 3)
+(define (h x) (if (lt x 1) 0 (add x (h (sub x 1)))))
+(h 4)
+(let ((f 2)) (add f (h 2)))
+(define (bad x) (add x #t))
+(bad 1)
+(cons (f 10) (nil))
+"""
+
+# defines inside other forms bind functions later forms call
+NESTED = """
+(define (g x) (add x 100))
+(let ((x 1)) (define (f y) (add x y)))
+(f 2)
+(g (f 3))
+(add (define (k) 5) (k))
+(k)
+(define (make n) (let ((m (mul n 2))) (define (h y) (add m y))))
+(make 5)
+(h 1)
+(make 7)
+(h 1)
+"""
+
+class TestParallel(unittest.TestCase):
+
+    def expected(self, backend='closure', prog=PROGRAM):
+        return [sexp.show(res) for res, _ in sexp.execute(prog, backend)]
+
+    def test_environments(self):
+        forms = [form for form, line, col in sexp.read(PROGRAM)]
+        envs = parallel.environments(forms)
+        self.assertEqual({}, envs[0])
+        self.assertEqual({'g': 2}, envs[3])
+        # a redefined f does not change which f g calls
+        self.assertEqual({'g': 2}, envs[5])
+        self.assertEqual({'g': 6}, envs[7])
+        self.assertEqual({'f': 4}, envs[6])
+        self.assertEqual({'h': 8}, envs[9])
+        # the let variable f pulls in the define of f too
+        self.assertEqual({'f': 4, 'h': 8}, envs[10])
+
+    def test_in_process(self):
+        for backend in ['closure', 'vm', 'interpret']:
+            self.assertEqual(self.expected(backend), list(parallel.execute(PROGRAM, 1, backend)), backend)
+
+    def test_pool(self):
+        self.assertEqual(self.expected(), list(parallel.execute(PROGRAM, 2, chunksize=3)))
+
+    def test_nested_defines(self):
+        forms = [form for form, line, col in sexp.read(NESTED)]
+        self.assertEqual([False, True, False, False, True, False, True],
+                         [parallel.nests_define(form) for form in forms[:7]])
+        expected = self.expected('closure', NESTED)
+        self.assertEqual([None, None, "3", "104", "error: type mismatch", "error: unknown func",
+                          None, None, "11", None, "15"], expected)
+        for processes in [1, 2]:
+            for backend in ['closure', 'vm']:
+                self.assertEqual(self.expected(backend, NESTED), list(parallel.execute(NESTED, processes, backend)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import gc
+import json
+from collections import OrderedDict, defaultdict
+from timeit import default_timer as timer
+
+# Opt-in profiling of a run.  A Profile given to execute() records
+#
+# - wall time and allocations for every pass, summed over the forms
+# - wall time for every form, through all of its passes
+# - calls, cumulative time and self time for every define and builtin, as
+#   the closure and interpret backends call them; the stack machine and the
+#   vm run calls inside their own loops, so they only get pass and form times
+#
+# Allocations are the net number of objects the garbage collector tracks,
+# from gc.get_count(); the collector is paused while a pass runs so the count
+# is not reset under it.  Cumulative time counts a recursive function once,
+# from its outermost call.
+#
+# Nothing is wrapped unless a profile is given, so an unprofiled run costs
+# the same as before.  report() is the results as plain data for json, and
+# folded() the self time of every stack of passes and calls in the folded
+# format flamegraph.pl reads, in microseconds.
+
+class Profile(object):
+    def __init__(self):
+        # name -> [runs, seconds, allocations]
+        self.passes = OrderedDict()
+        # (where, seconds)
+        self.forms = []
+        # name -> [calls, cumulative seconds, self seconds]
+        self.functions = {}
+        # folded stack -> self seconds
+        self.stacks = defaultdict(float)
+        # [path, seconds spent in callees] for every pass or call in progress
+        self.frames = []
+        self.active = defaultdict(int)
+
+    def enter(self, name):
+        path = self.frames[-1][0] + ";" + name if self.frames else name
+        self.frames.append([path, 0.0])
+
+    # seconds of the innermost frame not spent in its callees
+    def leave(self, elapsed):
+        path, inner = self.frames.pop()
+        own = elapsed - inner
+        if self.frames:
+            self.frames[-1][1] += elapsed
+        self.stacks[path] += own
+        return own
+
+    def run_pass(self, name, func, ast, funcstack):
+        stats = self.passes.get(name)
+        if stats is None:
+            stats = self.passes[name] = [0, 0.0, 0]
+        enabled = gc.isenabled()
+        gc.disable()
+        before = gc.get_count()[0]
+        self.enter(name)
+        start = timer()
+        try:
+            return func(ast, funcstack)
+        finally:
+            elapsed = timer() - start
+            self.leave(elapsed)
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += gc.get_count()[0] - before
+            if enabled:
+                gc.enable()
+
+    def form(self, where, elapsed):
+        self.forms.append((where, elapsed))
+
+    # profiled version of fn, a compiled function or raw builtin
+    def wrap(self, name, fn):
+        stats = self.functions.get(name)
+        if stats is None:
+            stats = self.functions[name] = [0, 0.0, 0.0]
+        active = self.active
+        def profiled(*args):
+            self.enter(name)
+            active[name] += 1
+            start = timer()
+            try:
+                return fn(*args)
+            finally:
+                elapsed = timer() - start
+                stats[0] += 1
+                stats[2] += self.leave(elapsed)
+                active[name] -= 1
+                if not active[name]:
+                    stats[1] += elapsed
+        return profiled
+
+    def report(self):
+        return {
+            'passes': [{'name': name, 'runs': runs, 'seconds': seconds, 'allocations': allocations}
+                       for name, (runs, seconds, allocations) in self.passes.iteritems()],
+            'forms': [{'where': where, 'seconds': seconds} for where, seconds in self.forms],
+            'functions': [{'name': name, 'calls': calls, 'cumulative': cumulative, 'self': own}
+                          for name, (calls, cumulative, own)
+                          in sorted(self.functions.iteritems(), key=lambda item: -item[1][2])],
+        }
+
+    def json(self):
+        return json.dumps(self.report(), indent=2, sort_keys=True)
+
+    def folded(self):
+        lines = []
+        for path, seconds in sorted(self.stacks.iteritems()):
+            micros = int(round(seconds * 1e6))
+            if micros > 0:
+                lines.append("%s %d" % (path, micros))
+        return "\n".join(lines)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+import sexp
+from profiler import Profile
+
+PROGRAM = "(define (sq n) (mul n n)) (define (fact n) (if (lt n 2) 1 (mul n (fact (sub n 1))))) (add (sq 3) (fact 5))"
+
+class TestProfiler(unittest.TestCase):
+
+    def run_profiled(self, backend):
+        profile = Profile()
+        results = [sexp.show(res) for res, _ in sexp.execute(PROGRAM, backend, profile=profile, optimize=False)]
+        self.assertEqual([None, None, "129"], results)
+        return profile
+
+    def test_functions(self):
+        for backend in ['closure', 'interpret']:
+            report = json.loads(self.run_profiled(backend).json())
+            functions = dict((f['name'], f) for f in report['functions'])
+            self.assertEqual(1, functions['sq']['calls'], backend)
+            self.assertEqual(5, functions['fact']['calls'], backend)
+            self.assertEqual(5, functions['lt']['calls'], backend)
+            # the recursion is counted once in the cumulative time
+            fact = functions['fact']
+            self.assertTrue(fact['self'] <= fact['cumulative'] + 1e-9, backend)
+
+    def test_passes(self):
+        profile = self.run_profiled('vm')
+        report = profile.report()
+        self.assertEqual(["ASTIFY", "COND", "VTYPE", "BYTECODE", "VM"], [p['name'] for p in report['passes']])
+        self.assertTrue(all(p['runs'] == 3 for p in report['passes']))
+        self.assertEqual(3, len(report['forms']))
+        self.assertEqual([], report['functions'])
+
+    def test_folded(self):
+        profile = self.run_profiled('closure')
+        lines = profile.folded().split("\n")
+        stacks = [line.rsplit(" ", 1)[0] for line in lines]
+        self.assertTrue(all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines))
+        self.assertTrue(all(stack.split(";")[0] in ["ASTIFY", "COND", "VTYPE", "COMPILE", "RUN"] for stack in stacks))
+        self.assertTrue("RUN;fact;fact;mul" in profile.stacks)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+from stypes import *
+from compiler import Slots, is_invalid, unbound
+
+# Lexical addressing for the tree walker.
+#
+# Every top-level form and every call of a user function runs in its own
+# frame, a list whose first item is the frame it was created in (the form's,
+# for top-level defines) and whose other items are the parameters followed by
+# one slot per let binding.  The resolver replaces variable names with their
+# (depth, index) address: how many frames to go up and which slot to read
+# there.  Depth is only non-zero when a define refers to a variable of the
+# function it is nested in, so lookups are a list index and calls build one
+# short list instead of copying every visible binding.
+#
+# Calls are resolved to their funcdef in 'target', following the same
+# funcstack scoping as inference.  Defines are resolved in place, since the
+# node in the tree is the funcdef that calls to it were resolved to.
+
+class Resolver(object):
+    def __init__(self, funcstack):
+        self.funcstack = funcstack
+
+    # scopes holds a dict of name -> index per enclosing frame, innermost last
+    def resolve(self, ast, scopes, slots):
+        if is_invalid(ast):
+            return ast
+        ntype = ast['ntype']
+        if ntype == Nodes.NUM or ntype == Nodes.BOOL:
+            return ast
+        elif ntype == Nodes.IDENT:
+            name = ast['value']
+            depth = 0
+            for scope in reversed(scopes):
+                if name in scope:
+                    return ast.replace(address=(depth, scope[name]))
+                depth += 1
+            raise Exception("Cannot resolve identifier "+name)
+        elif ntype == Nodes.LET:
+            scope = dict(scopes[-1])
+            scopes = scopes[:-1] + [scope]
+            bindings = []
+            for ident, expr in ast['bindings']:
+                self.funcstack.push()
+                expr = self.resolve(expr, scopes, slots)
+                self.funcstack.pop()
+                scope[ident['value']] = slot = slots.alloc()
+                bindings.append((ident.replace(address=(0, slot)), expr))
+            return ast.replace(bindings=bindings, expr=self.resolve(ast['expr'], scopes, slots))
+        elif ntype == Nodes.IF:
+            return ast.replace(testexpr=self.resolve(ast['testexpr'], scopes, slots),
+                               trueexpr=self.resolve(ast['trueexpr'], scopes, slots),
+                               falseexpr=self.resolve(ast['falseexpr'], scopes, slots))
+        elif ntype == Nodes.FUNC:
+            scoped = any(arg['ntype'] == Nodes.DEFINE for arg in ast['args'])
+            if scoped: self.funcstack.push()
+            args = [self.resolve(arg, scopes, slots) for arg in ast['args']]
+            name = ast['func']['value']
+            target = self.funcstack[name]
+            if scoped: self.funcstack.pop()
+            return ast.replace(args=args, target=target)
+        elif ntype == Nodes.DEFINE:
+            # a nested define only has a function once it has been run
+            ast['call'] = unbound(ast['func']['value'])
+            self.resolve_define(ast, scopes)
+            return ast
+        raise Exception("Cannot resolve node type "+ntype)
+
+    def resolve_define(self, ast, scopes):
+        self.funcstack.define(ast['func']['value'], ast)
+        params = ast['params']
+        # slot 0 of every frame links to its parent
+        scope = dict((params[i]['value'], i + 1) for i in xrange(len(params)))
+        slots = Slots(len(params) + 1)
+        ast['expr'] = self.resolve(ast['expr'], scopes + [scope], slots)
+        ast['size'] = slots.size
+
+# RESOLVE pass: address the variables of valid expressions, with the size of
+# the form's frame in 'code'
+def resolve_ast(ast, funcstack):
+    if is_invalid(ast):
+        return ast
+    resolver = Resolver(funcstack)
+    if ast['ntype'] == Nodes.DEFINE:
+        resolver.resolve_define(ast, [{}])
+        return ast
+    slots = Slots(1)
+    resolved = resolver.resolve(ast, [{}], slots)
+    return resolved.replace(code=slots.size)
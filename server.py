@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import math
+import hashlib
+import Queue
+import threading
+import multiprocessing
+import SocketServer
+import sexp
+import vm
+from memo import LRUCache
+from limits import Limits
+
+# A local evaluation server, so a client pays neither interpreter startup nor
+# compilation for every program it runs.
+#
+#   python server.py --socket /tmp/sascheme.sock -j 4
+#
+# Clients connect to a unix socket and send one json request per line; every
+# request gets one json response line, in order, carrying the request's "id"
+# if it had one:
+#
+#   {"op": "load", "source": "(define (f x) ...) (f 1)"}
+#       -> {"program": "<sha1 of source>", "results": ["2"]}
+#   {"op": "eval", "program": "<sha1>", "source": "(f 2) (f 3)"}
+#       -> {"results": ["3", "4"]}
+#   {"op": "ping"} -> {"ok": true}
+#
+# eval runs its forms after the program's, without changing the program, and
+# without "program" after an empty one, so one request can evaluate a batch
+# of expressions against a warm program.  Results are show() strings, null
+# for a define, and evaluation errors come back as "error: ..." results; a
+# request that cannot be run gets {"error": ...} instead.
+#
+# Evaluation runs on a pool of worker processes, each answering tasks on a
+# pipe of its own, or in the server with -j 0.  Every worker keeps the
+# funcstacks of the programs it has loaded in an LRU cache, so a program is
+# compiled once per worker and requests only compile their own forms.
+# Programs are compiled with limits, and every request runs under a deadline
+# of its "timeout" (or the server's), no later than the server's maximum,
+# and "fuel" and "cells" if it gives them, see limits; a worker that does not answer a second after that is
+# killed and replaced, and the request reported as timed out.  At most a
+# fixed number of requests are evaluated at once, and requests past that are
+# answered {"error": "busy"} straight away rather than queued.
+#
+# There is no asyncio in python 2, so connections are served by threads that
+# each wait on an idle worker.
+
+class Program(object):
+    # limits are the keyword arguments of limit() to load source under
+    def __init__(self, source, backend, optimize, limits):
+        self.passes = sexp.FRONTEND + (sexp.OPTIMIZE if optimize else []) + sexp.BACKENDS[backend]
+        self.limits = Limits()
+        self.funcstack = sexp.FuncStack(sexp.BUILTINS, limits=self.limits)
+        self.limit(**limits)
+        self.results = self.run(source)
+
+    # show() of every form of source; an exception of a form, such as a
+    # division by zero, is its result
+    def run(self, source):
+        pipeline = sexp.Pipeline(self.passes)
+        results = []
+        for form, line, col in sexp.read(source):
+            try:
+                ast = pipeline.run(form, self.funcstack, "form at line %d, column %d" % (line, col))
+                results.append(sexp.show(ast))
+            except Exception as e:
+                results.append("error: %s" % e)
+        return results
+
+    # run source after the program, in a scope that is dropped afterwards
+    # along with anything it compiled into the vm's program
+    def evaluate(self, source):
+        funcstack = self.funcstack
+        program = vm.program_of(funcstack)
+        program.release()
+        mark = program.mark()
+        funcstack.push()
+        try:
+            return self.run(source)
+        finally:
+            funcstack.pop()
+            program.truncate(mark)
+
+    # set the limits every later form runs under, until the next call
+    def limit(self, seconds=None, fuel=None, cells=None):
+        limits = self.limits
+        limits.seconds, limits.fuel, limits.cells = seconds, fuel, cells
+        limits.start()
+
+class Worker(object):
+    def __init__(self, backend='closure', optimize=True, size=64):
+        self.backend = backend
+        self.optimize = optimize
+        self.programs = LRUCache(size)
+
+    # the program of source, loaded under limits unless it already was
+    def program(self, source, limits):
+        key = hashlib.sha1(source).hexdigest()
+        found, program = self.programs.lookup(key)
+        if not found:
+            program = Program(source, self.backend, self.optimize, limits)
+            self.programs.store(key, program)
+        return program
+
+    # task is (program source, source to eval or None to load, limits); a
+    # load answers with the results of the program's first load
+    def __call__(self, task):
+        program_source, source, limits = task
+        program = self.program(program_source, limits)
+        if source is None:
+            return program.results
+        program.limit(**limits)
+        return program.evaluate(source)
+
+# answer tasks from conn until it is closed
+def serve_worker(conn, backend, optimize, size):
+    worker = Worker(backend, optimize, size)
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            # the server closed the pipe, or ^C reached its process group
+            return
+        try:
+            conn.send((True, worker(task)))
+        except Exception as e:
+            conn.send((False, "%s: %s" % (type(e).__name__, e)))
+
+class Process(object):
+    def __init__(self, backend, optimize, size):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve_worker, args=(child, backend, optimize, size))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.join()
+
+class Server(object):
+    # processes is the size of the pool, 0 to evaluate in the server;
+    # pending how many requests may be evaluated at once; timeout the
+    # default deadline of a request and max_timeout the latest one a request
+    # may ask for, in seconds
+    def __init__(self, processes=None, backend='closure', optimize=True, pending=None, timeout=10.0, size=64,
+                 max_timeout=60.0):
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+        # sha1 -> source of the programs loaded, past which a client has to
+        # load its program again
+        self.sources = LRUCache(size)
+        self.sources_lock = threading.Lock()
+        if processes == 0:
+            self.pool = None
+            self.worker = Worker(backend, optimize, size)
+            # the worker's funcstacks are not thread safe
+            self.lock = threading.Lock()
+            pending = pending or 1
+        else:
+            self.spawn = lambda: Process(backend, optimize, size)
+            self.pool = [self.spawn() for i in xrange(processes or multiprocessing.cpu_count())]
+            self.idle = Queue.Queue()
+            for process in self.pool:
+                self.idle.put(process)
+            # requests past the number of workers wait for one to be idle
+            pending = pending or 2 * len(self.pool)
+        self.slots = threading.Semaphore(pending)
+
+    def close(self):
+        for process in self.pool or []:
+            process.stop()
+
+    def dispatch(self, task, timeout):
+        if self.pool is None:
+            with self.lock:
+                return self.worker(task)
+        process = self.idle.get()
+        try:
+            process.conn.send(task)
+            # the worker stops at the deadline itself unless a builtin is
+            # stuck, so this only gives up on workers that cannot answer
+            if not process.conn.poll(timeout + 1.0):
+                raise multiprocessing.TimeoutError()
+            ok, value = process.conn.recv()
+        except:
+            # a stuck or dead worker is replaced, and so is any other whose
+            # pipe may still hold the reply to this task
+            process.stop()
+            self.pool[self.pool.index(process)] = process = self.spawn()
+            raise
+        finally:
+            self.idle.put(process)
+        if not ok:
+            raise Exception(value)
+        return value
+
+    # the response to one request, a dict decoded from json
+    def handle(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True}
+        elif op not in ('load', 'eval'):
+            return {'error': "unknown op %r" % op}
+        source = request.get('source')
+        if not isinstance(source, basestring):
+            return {'error': "source must be a string"}
+        source = source.encode('utf-8') if isinstance(source, unicode) else source
+        limits = {}
+        for name, key in (('seconds', 'timeout'), ('fuel', 'fuel'), ('cells', 'cells')):
+            value = request.get(key)
+            if value is not None and (type(value) not in (int, long, float) or value <= 0 or
+                                      math.isinf(value) or math.isnan(value)):
+                return {'error': "%s must be a positive number" % key}
+            limits[name] = value
+        if limits['seconds'] is None:
+            limits['seconds'] = self.timeout
+        limits['seconds'] = timeout = min(limits['seconds'], self.max_timeout)
+        if op == 'load':
+            key = hashlib.sha1(source).hexdigest()
+            with self.sources_lock:
+                self.sources.store(key, source)
+            task = (source, None, limits)
+        else:
+            key = request.get('program')
+            program_source = ""
+            if key is not None:
+                with self.sources_lock:
+                    found, program_source = self.sources.lookup(key)
+                if not found:
+                    return {'error': "unknown program %s" % key}
+            task = (program_source, source, limits)
+        if not self.slots.acquire(False):
+            return {'error': "busy"}
+        try:
+            results = self.dispatch(task, timeout)
+        except multiprocessing.TimeoutError:
+            return {'error': "timed out after %g seconds" % timeout}
+        except (EOFError, IOError):
+            return {'error': "worker died"}
+        except Exception as e:
+            return {'error': str(e)}
+        finally:
+            self.slots.release()
+        if op == 'load':
+            return {'program': key, 'results': results}
+        return {'results': results}
+
+class Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'error': "bad json: %s" % e}
+            else:
+                if type(request) is dict:
+                    response = self.server.evaluator.handle(request)
+                    if 'id' in request:
+                        response['id'] = request['id']
+                else:
+                    response = {'error': "request must be an object"}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class UnixServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, evaluator):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.ThreadingUnixStreamServer.__init__(self, path, Handler)
+        self.evaluator = evaluator
+
+# a client for one connection to the server at path
+class Client(object):
+    def __init__(self, path):
+        import socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile("r+b")
+
+    def request(self, **request):
+        self.file.write(json.dumps(request) + "\n")
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve evaluation requests on a unix socket.")
+    parser.add_argument("--socket", dest="path", required=True, help="path of the unix socket")
+    parser.add_argument("-j", dest="processes", type=int, metavar="N",
+                        help="evaluate on N processes, or in the server with 0 (default: one per cpu)")
+    parser.add_argument("-b", dest="backend", default="closure", choices=sorted(sexp.BACKENDS.keys()),
+                        help="evaluation backend (default: closure)")
+    parser.add_argument("--no-optimize", dest="optimize", action="store_false",
+                        help="skip constant folding and inlining")
+    parser.add_argument("--pending", type=int, metavar="N",
+                        help="requests evaluated at once before answering busy (default: twice the processes)")
+    parser.add_argument("--timeout", type=float, default=10.0, metavar="SECONDS",
+                        help="default deadline of a request (default: 10)")
+    parser.add_argument("--max-timeout", type=float, default=60.0, metavar="SECONDS",
+                        help="latest deadline a request may ask for (default: 60)")
+    parser.add_argument("--programs", type=int, default=64, metavar="N",
+                        help="programs every worker keeps compiled (default: 64)")
+    args = parser.parse_args()
+
+    evaluator = Server(args.processes, args.backend, args.optimize, args.pending, args.timeout, args.programs,
+                       args.max_timeout)
+    server = UnixServer(args.path, evaluator)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        evaluator.close()
+        os.unlink(args.path)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import sexp
+import server
+
+PROGRAM = """
+(define (sq x) (mul x x))
+(define (loop n) (if (eq n 0) 0 (loop (sub n 1))))
+(sq 3)
+"""
+
+class TestServer(unittest.TestCase):
+
+    def test_load_and_eval(self):
+        for backend in sorted(sexp.BACKENDS):
+            s = server.Server(0, backend)
+            loaded = s.handle({'op': 'load', 'source': PROGRAM})
+            self.assertEqual([None, None, "9"], loaded['results'], backend)
+            program = loaded['program']
+            self.assertEqual({'results': ["16", None, "5", "error: out of fuel after 3 steps"]},
+                             s.handle({'op': 'eval', 'program': program, 'fuel': 3,
+                                       'source': "(sq 4) (define (sq x) x) (sq 5) (loop 5)"}), backend)
+            # the define of the eval was dropped with it
+            self.assertEqual({'results': ["36"]}, s.handle({'op': 'eval', 'program': program, 'source': "(sq 6)"}))
+            self.assertEqual({'results': ["3"]}, s.handle({'op': 'eval', 'source': "(add 1 2)"}))
+
+    def test_warm(self):
+        s = server.Server(0, 'vm')
+        program = s.handle({'op': 'load', 'source': PROGRAM})['program']
+        compiled = s.worker.programs.entries.values()[0].funcstack.program
+        compiled.release()
+        mark = compiled.mark()
+        for i in xrange(3):
+            s.handle({'op': 'eval', 'program': program, 'source': "(define (f y) (sq y)) (f %d)" % i})
+        self.assertEqual(mark, compiled.mark())
+        self.assertEqual(1, s.worker.programs.misses)
+
+    def test_errors(self):
+        s = server.Server(0)
+        self.assertEqual({'ok': True}, s.handle({'op': 'ping'}))
+        self.assertTrue('error' in s.handle({'op': 'run'}))
+        self.assertTrue('error' in s.handle({'op': 'eval', 'source': 5}))
+        self.assertEqual({'error': "unknown program abc"}, s.handle({'op': 'eval', 'program': "abc", 'source': ""}))
+        self.assertEqual({'results': ["error: integer division or modulo by zero"]},
+                         s.handle({'op': 'eval', 'source': "(div 1 0)"}))
+        # the vm has proper tail calls, so the loop only stops at the deadline
+        s = server.Server(0, 'vm')
+        self.assertEqual({'results': [None, "error: deadline of 0.05 seconds exceeded"]},
+                         s.handle({'op': 'eval', 'timeout': 0.05, 'source': "(define (spin n) (spin n)) (spin 0)"}))
+
+    def test_bad_limits(self):
+        s = server.Server(1)
+        try:
+            for bad in ({'timeout': "5"}, {'fuel': -1}, {'cells': True}, {'timeout': 0},
+                        {'timeout': float('nan')}, {'timeout': float('inf')}, {'fuel': float('inf')},
+                        {'cells': float('nan')}):
+                request = dict(bad, op='eval', source="(add 1 2)")
+                self.assertEqual("error", s.handle(request).keys()[0], bad)
+                self.assertEqual({'results': ["30"]}, s.handle({'op': 'eval', 'source': "(add 10 20)"}))
+            # a worker whose task failed after it was sent is replaced, so
+            # the next request does not get its reply
+            process = s.pool[0]
+            self.assertRaises(TypeError, s.dispatch, ("", "(add 1 2)", {}), "5")
+            self.assertFalse(process is s.pool[0])
+            self.assertEqual({'results': ["300"]}, s.handle({'op': 'eval', 'source': "(add 100 200)"}))
+        finally:
+            s.close()
+
+    def test_max_timeout(self):
+        s = server.Server(0, 'vm', max_timeout=0.05)
+        self.assertEqual({'results': [None, "error: deadline of 0.05 seconds exceeded"]},
+                         s.handle({'op': 'eval', 'timeout': 1e9, 'source': "(define (spin n) (spin n)) (spin 0)"}))
+
+    def test_busy(self):
+        s = server.Server(0, pending=1)
+        s.slots.acquire()
+        self.assertEqual({'error': "busy"}, s.handle({'op': 'eval', 'source': "1"}))
+        s.slots.release()
+        self.assertEqual({'results': ["1"]}, s.handle({'op': 'eval', 'source': "1"}))
+
+    def test_socket(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, "socket")
+        evaluator = server.Server(1)
+        unix = server.UnixServer(path, evaluator)
+        thread = threading.Thread(target=unix.serve_forever)
+        thread.start()
+        try:
+            client = server.Client(path)
+            loaded = client.request(op='load', source=PROGRAM, id=1)
+            self.assertEqual(1, loaded['id'])
+            self.assertEqual({'results': ["49"]}, client.request(op='eval', program=loaded['program'], source="(sq 7)"))
+            # every line gets an answer of its own, even one that is not an object
+            for line in ("null", "[1]", "{", "5"):
+                client.file.write(line + "\n")
+                client.file.flush()
+                self.assertTrue('error' in json.loads(client.file.readline()), line)
+            self.assertEqual({'ok': True}, client.request(op='ping'))
+            client.close()
+        finally:
+            unix.shutdown()
+            thread.join()
+            unix.server_close()
+            evaluator.close()
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import sys
+import sexp
+from parallel import called, defined, nests_define
+
+# A long-lived session that keeps the typed and compiled result of every
+# form, so reloading an edited program only re-types what the edit changed.
+#
+#   session = Session()
+#   session.load(source)       # show() of every form
+#   session.load(edited)       # the same, reusing every unchanged form
+#   session.run(form)          # one more form, as in a REPL
+#
+# A form's result depends on its text and on the defines it calls, see
+# parallel.  Every form gets an id from its text and the ids of the latest
+# defines of the names it calls, so replacing a define gives it a new id,
+# which gives new ids to the forms that call it, and so on; every other form
+# keeps its id and its cached result.  Forms run in a scope holding just the
+# defines they call, and a compiled define keeps calling the functions it
+# was compiled against, so cached funcdefs can be reused in any later load.
+#
+# A define inside another form binds where it runs, which ids do not track,
+# so from the first form with one up to the next load, forms run in order in
+# one scope holding the defines before it, and are not cached.
+
+# how deep inside forms the reader is after line, starting at depth; an
+# unmatched close is ignored, as sexp.read does
+def nesting(line, depth):
+    for token in sexp.TOKEN.findall(line):
+        if token == "(" or token == "[":
+            depth += 1
+        elif token == ")" or token == "]":
+            if depth:
+                depth -= 1
+        elif token == ";":
+            break
+    return depth
+
+class Session(object):
+    def __init__(self, backend='closure', optimize=True):
+        self.passes = sexp.FRONTEND + (sexp.OPTIMIZE if optimize else []) + sexp.BACKENDS[backend]
+        self.funcstack = sexp.FuncStack(sexp.BUILTINS)
+        # (form text, ((name, id), ...)) -> id
+        self.ids = {}
+        self.next_id = 0
+        # id -> (funcdef or None, shown)
+        self.results = {}
+        # name -> id of the latest define of every top-level name
+        self.env = {}
+        # ids of the forms loaded or run, in order
+        self.forms = []
+        # chunk of lines -> what read() found in it, for the last load
+        self.chunks = {}
+        # whether forms run in order, in a scope pushed onto funcstack
+        self.in_order = False
+        # forms typed and compiled, and forms served from the cache
+        self.misses = 0
+        self.hits = 0
+
+    def id(self, form, env, text=None, names=None):
+        if text is None:
+            text, names = repr(form), sorted(called(form))
+        key = (text, tuple([(name, env[name]) for name in names if name in env]))
+        ident = self.ids.get(key)
+        if ident is None:
+            ident = self.ids[key] = self.next_id
+            self.next_id += 1
+        if ident in self.results:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.results[ident] = self.compile(form, key[1])
+        return ident
+
+    def compile(self, form, deps):
+        funcstack = self.funcstack
+        funcstack.push()
+        try:
+            for name, ident in deps:
+                funcstack.define(name, self.results[ident][0])
+            ast = sexp.Pipeline(self.passes).run(form, funcstack, "form %d" % (len(self.forms) + 1))
+            name = defined(form)
+            return (funcstack[name] if name is not None else None), sexp.show(ast)
+        finally:
+            funcstack.pop()
+
+    # show() of form, run after everything loaded or run so far
+    def run(self, form, text=None, names=None, name=None, nested=None):
+        if text is None:
+            nested = nests_define(form)
+        if nested or self.in_order:
+            return self.run_in_order(form)
+        ident = self.id(form, self.env, text, names)
+        self.forms.append(ident)
+        if text is None:
+            name = defined(form)
+        if name is not None:
+            self.env[name] = ident
+        return self.results[ident][1]
+
+    # show() of form, run in the scope of the forms run in order before it
+    def run_in_order(self, form):
+        funcstack = self.funcstack
+        if not self.in_order:
+            self.in_order = True
+            funcstack.push()
+            for name, ident in sorted(self.env.iteritems()):
+                funcstack.define(name, self.results[ident][0])
+        self.misses += 1
+        self.forms.append(None)
+        ast = sexp.Pipeline(self.passes).run(form, funcstack, "form %d" % len(self.forms))
+        return sexp.show(ast)
+
+    # (form, text, sorted names called, name defined, whether it nests a
+    # define) for every form of prog.  Lines are grouped into chunks that
+    # start and end outside any form, and the forms read from a chunk are
+    # kept by its text, so an unchanged chunk is not read again.
+    def read(self, prog, chunks):
+        pending = []
+        depth = 0
+        for line in sexp.lines_of(prog):
+            if not pending and line in self.chunks:
+                chunks[line] = self.chunks[line]
+                for entry in chunks[line]:
+                    yield entry
+                continue
+            pending.append(line)
+            depth = nesting(line, depth)
+            if depth == 0:
+                text = "".join(pending)
+                pending = []
+                entries = chunks[text] = self.chunks.get(text) or \
+                    [(form, repr(form), sorted(called(form)), defined(form), nests_define(form))
+                     for form, l, c in sexp.read(text)]
+                for entry in entries:
+                    yield entry
+        if pending:
+            for form, l, c in sexp.read("".join(pending)):
+                yield form, repr(form), sorted(called(form)), defined(form), nests_define(form)
+
+    # show() of every form of prog, which replaces whatever was loaded
+    # before; results no form uses any more are dropped
+    def load(self, prog):
+        if self.in_order:
+            self.funcstack.pop()
+            self.in_order = False
+        self.env = {}
+        self.forms = []
+        chunks = {}
+        shown = [self.run(*entry) for entry in self.read(prog, chunks)]
+        self.chunks = chunks
+        used = set(self.forms)
+        self.results = dict((ident, result) for ident, result in self.results.iteritems() if ident in used)
+        self.ids = dict((key, ident) for key, ident in self.ids.iteritems() if ident in used)
+        return shown
+
+# Read forms from stdin and print their results as they are read.  A line
+# starting with ":load FILE" reloads the session from a file, printing its
+# results and how many forms had to be compiled, and ":quit" ends the
+# session.
+def repl(session, stdin=sys.stdin, stdout=sys.stdout, prompt="> "):
+    def lines():
+        while True:
+            stdout.write(prompt)
+            stdout.flush()
+            line = stdin.readline()
+            if not line or line.strip() == ":quit":
+                return
+            if line.startswith(":load"):
+                path = line[len(":load"):].strip()
+                misses = session.misses
+                try:
+                    with open(path) as f:
+                        shown = session.load(f.read())
+                except (IOError, OSError) as e:
+                    stdout.write("error: %s\n" % e)
+                    continue
+                for result in shown:
+                    if result is not None:
+                        stdout.write(result + "\n")
+                stdout.write("; %d forms, %d compiled\n" % (len(shown), session.misses - misses))
+                continue
+            yield line
+    for form, line, col in sexp.read(lines()):
+        try:
+            shown = session.run(form)
+        except Exception as e:
+            shown = "error: %s" % e
+        if shown is not None:
+            stdout.write(shown + "\n")
+    stdout.write("\n")
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import tempfile
+import subprocess
+import unittest
+from cStringIO import StringIO
+import sexp
+import session
+
+PROGRAM = """
+(define (scale x) (mul x 10))
+(define (low v) (lt v (scale 2)))
+(define (high v) (gt v (scale 5)))
+(define (grade v)
+  (if (low v) 0 (if (high v) 2 1)))
+(grade 5) (grade 30) (grade 70)
+(high 70)
+(cons (scale 1) (nil))
+"""
+
+class TestSession(unittest.TestCase):
+
+    def expected(self, prog):
+        return [sexp.show(res) for res, _ in sexp.execute(prog)]
+
+    def test_reload(self):
+        s = session.Session()
+        self.assertEqual(self.expected(PROGRAM), s.load(PROGRAM))
+        self.assertEqual(9, s.misses)
+        # nothing changed, so nothing is compiled again
+        self.assertEqual(self.expected(PROGRAM), s.load(PROGRAM))
+        self.assertEqual(9, s.misses)
+        # low and the forms that depend on it, grade and its three calls
+        edited = PROGRAM.replace("(lt v (scale 2))", "(lt v (scale 3))")
+        self.assertEqual(self.expected(edited), s.load(edited))
+        self.assertEqual(14, s.misses)
+        # every form uses scale
+        edited = edited.replace("(mul x 10)", "(mul x 20)")
+        self.assertEqual(self.expected(edited), s.load(edited))
+        self.assertEqual(23, s.misses)
+        # back to the first version, which was dropped from the cache
+        self.assertEqual(self.expected(PROGRAM), s.load(PROGRAM))
+
+    def test_backends(self):
+        for backend in ['stack', 'vm', 'interpret']:
+            s = session.Session(backend)
+            self.assertEqual(self.expected(PROGRAM), s.load(PROGRAM), backend)
+            edited = PROGRAM.replace("(mul x 10)", "(mul x 2)")
+            self.assertEqual(self.expected(edited), s.load(edited), backend)
+
+    def test_run(self):
+        s = session.Session()
+        s.load("(define (f x) (add x 1))")
+        self.assertEqual("3", s.run(["f", "2"]))
+        self.assertEqual(None, s.run(["define", ["f", "x"], ["mul", "x", "2"]]))
+        self.assertEqual("4", s.run(["f", "2"]))
+
+    def test_nested_define(self):
+        prog = "(define (g x) (mul x 10)) (let ((x 1)) (define (f y) (add x y))) (f 2) (g (f 3))"
+        for backend in ['closure', 'vm']:
+            s = session.Session(backend)
+            self.assertEqual([None, None, "3", "40"], s.load(prog), backend)
+            self.assertEqual("5", s.run(["f", "4"]))
+            # the next load starts over, without the nested define
+            self.assertEqual([None, "error: unknown func"], s.load("(define (g x) (mul x 10)) (f 2)"), backend)
+            self.assertEqual([None, None, "3", "40"], s.load(prog), backend)
+        s = session.Session()
+        self.assertEqual([None, "3"], s.load("(let ((x 1)) (define (f y) (add x y))) (f 2)"))
+
+    def test_repl(self):
+        out = StringIO()
+        session.repl(session.Session(), StringIO("(define (f x) (add x 1))\n(f\n 2) (g 1)\n:quit\n(f 3)\n"), out, "")
+        self.assertEqual("3\nerror: unknown func\n\n", out.getvalue())
+
+    def test_cli(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, "(define (f x) (mul x 2)) (f 1)")
+            os.close(fd)
+            run = subprocess.Popen([sys.executable, "sexp.py", "-i", "-f", path], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(sexp.__file__)))
+            self.assertEqual("2\n> 8\n> \n", run.communicate("(f 4)\n")[0])
+        finally:
+            os.unlink(path)
+        # stdin is the session's, so it cannot also be the program
+        run = subprocess.Popen([sys.executable, "sexp.py", "-i", "-f", "-"], stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.abspath(sexp.__file__)))
+        run.communicate("")
+        self.assertEqual(2, run.returncode)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,169 +1,213 @@
 #!/usr/bin/env python
 
-from pprint import pprint, pformat
+from cStringIO import StringIO
+import re
+from timeit import default_timer as timer
 from stypes import *
-import matcher
+from typeterms import BOOL, INVALID
+from infer import vtype
+import operator
+import lists
+import compiler
+import machine
+import vm
+from resolve import resolve_ast
+from specialize import specialize_ast
+from compiler import raw_id
+from limits import LimitExceeded, exceeded
+from fold import fold_ast
 
 def is_open(c): return c in '(['
 def is_close(c): return c in ')]'
 
+# a token is a bracket or a run of anything else up to whitespace, a bracket
+# or a comment, which runs to the end of the line
+TOKEN = re.compile(r";|[()\[\]]|[^\s()\[\];]+")
+
+def lines_of(stream):
+    if isinstance(stream, basestring):
+        stream = StringIO(stream)
+    if hasattr(stream, 'readline'):
+        # unlike iterating a file, readline does not read ahead, so forms
+        # piped to stdin are seen as soon as their line arrives
+        return iter(stream.readline, '')
+    return stream
+
+# yield (token, line, column) for a program string or any iterable of lines,
+# like a file or stdin, reading it one buffered line at a time
+def scan(stream):
+    lineno = 0
+    for line in lines_of(stream):
+        lineno += 1
+        for m in TOKEN.finditer(line):
+            token = m.group()
+            if token == ";":
+                break
+            yield token, lineno, m.start() + 1
+
 def tokenize(stream):
-    in_comment = False
-    last = []
-    for c in stream:
-        if in_comment:
-            if c == "\n":
-                in_comment = False
-                if len(last) > 0:
-                    yield "".join(last)
-                    last = []
-        elif c == ";":
-            in_comment = True
-        elif c == " " or c == "\t" or c == "\n":
-            if len(last) > 0:
-                yield "".join(last)
-                last = []
-        elif is_open(c) or is_close(c):
-            if len(last) > 0: 
-                yield "".join(last)
-                last = []
-            yield c
-        else:
-            last.append(c)
-    if len(last) > 0:
-        yield "".join(last)
-
-def nest_inner(tokens):
-    tokens = iter(tokens)
-    cur = []
-    while True:
-        try:
-            next = tokens.next()
-            #print "TOKEN", next
-            if is_open(next):
-                child, tokens, more = nest_inner(tokens)
-                cur.append(child)
-            elif is_close(next):
-                return cur, tokens, True
+    for token, line, col in scan(stream):
+        yield token
+
+# yield (form, line, column) for each top-level form as soon as it is closed,
+# with the position of its first token.  This scans lines itself rather than
+# consuming scan(), which keeps the per-token cost down.
+def read(stream):
+    stack = []
+    lineno = 0
+    finditer = TOKEN.finditer
+    for line in lines_of(stream):
+        lineno += 1
+        for m in finditer(line):
+            token = m.group()
+            if token == "(" or token == "[":
+                stack.append(([], lineno, m.start() + 1))
+            elif token == ")" or token == "]":
+                # an unmatched close is ignored
+                if stack:
+                    done = stack.pop()
+                    if stack:
+                        stack[-1][0].append(done[0])
+                    else:
+                        yield done
+            elif token == ";":
+                break
+            elif stack:
+                stack[-1][0].append(token)
             else:
-                cur.append(next)
-        except StopIteration:
-            return cur, tokens, False
-            
+                yield token, lineno, m.start() + 1
+    # forms still open at the end are closed implicitly
+    while stack:
+        done = stack.pop()
+        if stack:
+            stack[-1][0].append(done[0])
+        else:
+            yield done
+
 def nest(tokens):
-    while True:
-        try:
-            cur, tokens, more = nest_inner(tokens)
-            for c in cur:
-                yield c
-            if not more:
-                break
-        except StopIteration:
-            break
-
-def op_add(args): 
-    return num_node(args[0]['value'] + args[1]['value'])
-def op_sub(args): 
-    return num_node(args[0]['value'] - args[1]['value'])
-def op_mul(args): 
-    return num_node(args[0]['value'] * args[1]['value'])
-def op_div(args): 
-    return num_node(args[0]['value'] / args[1]['value'])
-def op_mod(args): 
-    return num_node(args[0]['value'] % args[1]['value'])
-def op_neg(args):    
-    return num_node(-args[0]['value'])
-def op_not(args):    
-    return bool_node(not args[0]['value'])
-def op_and(args): 
-    return bool_node(args[0]['value'] and args[1]['value'])
-def op_or(args):  
-    return bool_node(args[0]['value'] or args[1]['value'])
-def op_xor(args):  
-    return bool_node(args[0]['value'] ^ args[1]['value'])
-def op_gt(args):  
-    return bool_node(args[0]['value'] > args[1]['value'])
-def op_lt(args):  
-    return bool_node(args[0]['value'] < args[1]['value'])
-def op_eq(args):  
-    return bool_node(args[0]['value'] == args[1]['value'])
-def op_gte(args): 
-    return bool_node(args[0]['value'] >= args[1]['value'])
-def op_lte(args): 
-    return bool_node(args[0]['value'] <= args[1]['value'])
-def op_neq(args): 
-    return bool_node(args[0]['value'] != args[1]['value'])
-def op_idnum(args):
-    return num_node(args[0]['value'])
-def op_idbool(args):
-    return bool_node(args[0]['value'])
-def op_id(args):
-    vtype = args[0]['vtype']
-    if vtype == type_node(Types.BOOL):
-        return bool_node(args[0]['value'])
-    else:
-        return num_node(args[0]['value'])
-def op_nil(args):
-    return list_node(None, None)
-def op_cons(args):
-    return list_node(args[0], args[1])
-def op_sum(args):
-    s = 0
-    a = args[0]
-    while a['current'] is not None:
-        s += a['current']['value']
-        a = a['next']
-    return num_node(s)
-
-def nary(op, n, intype, outtype = None):
+    # every token reads as a line of its own
+    for form, line, col in read(tokens):
+        yield form
+
+# raw ops work on plain python values, as every backend does
+def raw_and(a, b): return a and b
+def raw_or(a, b): return a or b
+# variadic raw ops take every argument of a call at once
+def raw_add(*args): return sum(args)
+def raw_mul(*args): return reduce(operator.mul, args)
+def raw_all(*args): return all(args)
+def raw_any(*args): return any(args)
+def raw_nil(): return lists.NIL
+
+# a builtin of n arguments of intype, implemented by raw; a variadic builtin
+# also takes any number more, all of intype, which its variadic raw folds over
+def nary(raw, n, intype, outtype = None, variadic = None):
     if outtype is None: outtype = intype
-    return { 'intypes': [type_node(intype) for i in xrange(n)], 'outtype': type_node(outtype), 'op': op }
-
-BUILTINS = {
-    'add' : nary(op_add, 2, Types.NUM),
-    'sub' : nary(op_sub, 2, Types.NUM),
-    'mul' : nary(op_mul, 2, Types.NUM),
-    'div' : nary(op_div, 2, Types.NUM),
-    'mod' : nary(op_mod, 2, Types.NUM),
-    'neg' : nary(op_neg, 1, Types.NUM),
-    'not' : nary(op_not, 1, Types.BOOL),
-    'and' : nary(op_and, 2, Types.BOOL),
-    'or'  : nary(op_or,  2, Types.BOOL),
-    'xor' : nary(op_xor, 2, Types.BOOL),
-    'gt'  : nary(op_gt,  2, Types.NUM, Types.BOOL),
-    'lt'  : nary(op_lt,  2, Types.NUM, Types.BOOL),
-    'eq'  : nary(op_eq,  2, Types.NUM, Types.BOOL),
-    'gte' : nary(op_gte, 2, Types.NUM, Types.BOOL),
-    'lte' : nary(op_lte, 2, Types.NUM, Types.BOOL),
-    'neq' : nary(op_neq, 2, Types.NUM, Types.BOOL),
-    'idnum': nary(op_idnum, 1, Types.NUM),
-    'idbool': nary(op_idbool, 1, Types.BOOL),
-    'id': nary(op_id, 1, Types.T(1)),
-    'nil': nary(op_nil, 0, Types.T(1)),
-    'cons': { 'op': op_cons, 'outtype': type_node(Types.LIST, Types.T(1)),
-              'intypes': [type_node(Types.T(1)), type_node(Types.LIST, Types.T(1))] },
-    'sum': { 'op': op_sum, 'outtype': type_node(Types.NUM),
-             'intypes': [type_node(Types.LIST, Types.NUM)] }
+    funcdef = { 'intypes': [type_node(intype) for i in xrange(n)], 'outtype': type_node(outtype), 'raw': raw }
+    if variadic is not None:
+        funcdef['variadic'] = variadic
+    return funcdef
+
+# Builtins are built the first time they are looked up, from a table of
+# functions that build them, so startup does not grow with the library.
+BUILTIN_SPECS = {
+    'add': lambda: nary(operator.add, 2, Types.NUM, variadic=raw_add),
+    'sub': lambda: nary(operator.sub, 2, Types.NUM),
+    'mul': lambda: nary(operator.mul, 2, Types.NUM, variadic=raw_mul),
+    'div': lambda: nary(operator.floordiv, 2, Types.NUM),
+    'mod': lambda: nary(operator.mod, 2, Types.NUM),
+    'neg': lambda: nary(operator.neg, 1, Types.NUM),
+    'not': lambda: nary(operator.not_, 1, Types.BOOL),
+    'and': lambda: nary(raw_and, 2, Types.BOOL, variadic=raw_all),
+    'or': lambda: nary(raw_or, 2, Types.BOOL, variadic=raw_any),
+    'min': lambda: nary(min, 2, Types.NUM, variadic=min),
+    'max': lambda: nary(max, 2, Types.NUM, variadic=max),
+    'xor': lambda: nary(operator.xor, 2, Types.BOOL),
+    'gt': lambda: nary(operator.gt, 2, Types.NUM, Types.BOOL),
+    'lt': lambda: nary(operator.lt, 2, Types.NUM, Types.BOOL),
+    'eq': lambda: nary(operator.eq, 2, Types.NUM, Types.BOOL),
+    'gte': lambda: nary(operator.ge, 2, Types.NUM, Types.BOOL),
+    'lte': lambda: nary(operator.le, 2, Types.NUM, Types.BOOL),
+    'neq': lambda: nary(operator.ne, 2, Types.NUM, Types.BOOL),
+    'idnum': lambda: nary(raw_id, 1, Types.NUM),
+    'idbool': lambda: nary(raw_id, 1, Types.BOOL),
+    'id': lambda: nary(raw_id, 1, Types.T(1)),
+    'nil': lambda: { 'raw': raw_nil, 'outtype': type_node(Types.LIST, Types.T(1)), 'intypes': [] },
+    'cons': lambda: { 'raw': lists.cons, 'outtype': type_node(Types.LIST, Types.T(1)),
+                      'intypes': [type_node(Types.T(1)), type_node(Types.LIST, Types.T(1))] },
+    'sum': lambda: { 'raw': lists.total, 'outtype': type_node(Types.NUM),
+                     'intypes': [type_node(Types.LIST, Types.NUM)] },
+    'length': lambda: { 'raw': lists.length, 'outtype': type_node(Types.NUM),
+                        'intypes': [type_node(Types.LIST, Types.T(1))] },
+    'range': lambda: { 'raw': lists.numbers, 'outtype': type_node(Types.LIST, Types.NUM),
+                       'intypes': [type_node(Types.NUM)] },
+    'map-add': lambda: { 'raw': lists.map_add, 'outtype': type_node(Types.LIST, Types.NUM),
+                         'intypes': [type_node(Types.NUM), type_node(Types.LIST, Types.NUM)] },
+    'map-mul': lambda: { 'raw': lists.map_mul, 'outtype': type_node(Types.LIST, Types.NUM),
+                         'intypes': [type_node(Types.NUM), type_node(Types.LIST, Types.NUM)] },
 }
 
-def alias_builtin(a, b):
-    BUILTINS[a] = BUILTINS[b]
-
-alias_builtin('+', 'add')
-alias_builtin('-', 'sub')
-alias_builtin('*', 'mul')
-alias_builtin('/', 'div')
-alias_builtin('%', 'mod')
-alias_builtin('!', 'not')
-alias_builtin('&&', 'and')
-alias_builtin('||', 'or')
-alias_builtin('^', 'xor')
-alias_builtin('>', 'gt')
-alias_builtin('<', 'lt')
-alias_builtin('==', 'eq')
-alias_builtin('>=', 'gte')
-alias_builtin('<=', 'lte')
-alias_builtin('!=', 'neq')
+# other names of builtins, which look up the same funcdef
+ALIASES = {
+    '+': 'add', '-': 'sub', '*': 'mul', '/': 'div', '%': 'mod', '!': 'not', '&&': 'and', '||': 'or',
+    '^': 'xor', '>': 'gt', '<': 'lt', '==': 'eq', '>=': 'gte', '<=': 'lte', '!=': 'neq',
+}
+
+# The table of builtins by name and alias.  It is lazy rather than frozen:
+# looking a name up adds its funcdef, but nothing else can change it, and
+# get, keys, items, len and iteration see every builtin, built or not.
+class Builtins(dict):
+    def __init__(self, specs, aliases):
+        dict.__init__(self)
+        self.specs = specs
+        self.aliases = aliases
+
+    def __missing__(self, name):
+        target = self.aliases.get(name, name)
+        if target not in self.specs:
+            raise KeyError(name)
+        funcdef = dict.get(self, target)
+        if funcdef is None:
+            funcdef = self.specs[target]()
+            # builtins the bytecode vm runs as opcodes of their own
+            if target in vm.BUILTIN_OPCODES:
+                funcdef['opcode'] = vm.BUILTIN_OPCODES[target]
+            dict.__setitem__(self, target, funcdef)
+        dict.__setitem__(self, name, funcdef)
+        return funcdef
+
+    def __contains__(self, name):
+        return name in self.specs or name in self.aliases
+
+    # every name, built or not
+    def names(self):
+        return sorted(self.specs.keys() + self.aliases.keys())
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+    def __len__(self):
+        return len(self.specs) + len(self.aliases)
+    def __iter__(self):
+        return iter(self.names())
+    def keys(self):
+        return self.names()
+    def values(self):
+        return [self[name] for name in self.names()]
+    def items(self):
+        return [(name, self[name]) for name in self.names()]
+    def copy(self):
+        return dict(self.items())
+    iterkeys = __iter__
+    def itervalues(self):
+        return iter(self.values())
+    def iteritems(self):
+        return iter(self.items())
+
+    def read_only(self, *args, **kwargs):
+        raise TypeError("builtins cannot be changed")
+    __setitem__ = __delitem__ = update = setdefault = pop = popitem = clear = read_only
+
+BUILTINS = Builtins(BUILTIN_SPECS, ALIASES)
 
 def is_blah(x, blah):
     try:
@@ -212,196 +256,115 @@ def astify(nested):
             return ident_node(nested)
     return invalid_node(nested, 'cannot type')
 
-def dappend(din, dout):
-    for a, b in din.iteritems():
-        if a not in dout:
-            dout[a] = b
-    return dout
-
+# Functions defined so far.  Scopes nest like the funcstack the type checker
+# walks, but every name maps straight to the stack of its definitions, and
+# each scope keeps a set of the names it defined so pop() can undo them, so
+# lookups and defines cost the same however deep the scopes are.
 class FuncStack(object):
-    def __init__(self, builtins):
+    # memo, if given, is the memo.Memo that backends wrap user functions with,
+    # profile the profiler.Profile that times calls and limits the
+    # limits.Limits that bound evaluation; program is the vm.Program the vm
+    # backend compiles forms into
+    def __init__(self, builtins, memo=None, profile=None, limits=None):
         self.builtins = builtins
-        self.scoped = [{}]
+        self.memo = memo
+        self.profile = profile
+        self.limits = limits
+        self.program = None
+        self.table = {}
+        self.scoped = [set()]
     def push(self):
-        self.scoped.append({})
+        self.scoped.append(set())
     def pop(self):
-        self.scoped.pop()
+        table = self.table
+        for name in self.scoped.pop():
+            defs = table[name]
+            defs.pop()
+            if not defs:
+                del table[name]
     def define(self, x, y):
-        self.scoped[-1][x] = y
+        defs = self.table.get(x)
+        if defs is None:
+            defs = self.table[x] = []
+        if x in self.scoped[-1]:
+            defs[-1] = y
+        else:
+            self.scoped[-1].add(x)
+            defs.append(y)
     def depth(self):
         return len(self.scoped)
     def __getitem__(self, item):
-        for i in reversed(xrange(len(self.scoped))):
-            if item in self.scoped[i]:
-                return self.scoped[i][item]
+        defs = self.table.get(item)
+        if defs:
+            return defs[-1]
         return self.builtins[item]
     def __contains__(self, item):
-        if item in self.builtins:
-            return True
-        for i in xrange(len(self.scoped)):
-            if item in self.scoped[i]:
-                return True
-        return False
+        return item in self.table or item in self.builtins
     def __repr__(self):
         return self.__str__()
     def __str__(self):
-        return pformat({'builtins': '...', 'scoped': self.scoped})
-
-# return ast typed with 'vtype' (a new copy of it - use dappend)
-# btypes are the types of bound symbols in lets
-# funcstack may be modified with top-level defs
-def vtype(ast, funcstack, btypes=None, propagated_btypes=None, propagated_template_assignment=None):
-    if btypes is None: btypes = {}
-    #print "BTYPES", pformat(btypes)
-    if ast['ntype'] == Nodes.NUM:
-        return dappend(ast, {'vtype': type_node(Types.NUM)})
-    elif ast['ntype'] == Nodes.BOOL:
-        return dappend(ast, {'vtype': type_node(Types.BOOL)})
-    elif ast['ntype'] == Nodes.FUNC:
-        if ast['func']['value'] not in funcstack:
-            return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'unknown func' })
-        funcdef = funcstack[ast['func']['value']]
-        if len(ast['args']) != len(funcdef['intypes']):
-            return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'arity mismatch' })
-
-        # allow same-level defines in func args to allow for seq
-        funcstack.push()
-        args = []
-        template_assignment = {}
-        for arg in ast['args']:
-            dvt = funcdef['intypes'][len(args)]
-            if propagated_btypes != None and arg['ntype'] == Nodes.IDENT and arg['value'] not in btypes:
-                arg = dappend(arg, {'vtype': dvt})
-                assert arg['value'] not in propagated_btypes or propagated_btypes[arg['value']] == dvt
-                propagated_btypes[arg['value']] = dvt
-            else:
-                is_t = Types.node_is_T(dvt)
-                prop_ta = None
-                if is_t:
-                    et = dvt['etypes']
-                    parts = [[x, x] for x in Types.split_T(et)]
-                    for i in xrange(len(parts)):
-                        if parts[i][0] in template_assignment:
-                            parts[i][1] = template_assignment[parts[i][0]]['etypes']
-                    prop_ta = type_node(Types.join_T((x[1] for x in parts)))
-                arg = vtype(arg, funcstack, btypes, propagated_template_assignment=prop_ta)
-                if is_t:
-                    et = dvt['etypes']
-                    if et not in template_assignment:
-                        template_assignment[et] = arg['vtype']
-                    if arg['vtype'] != template_assignment[et]:
-                        return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 't type mismatch' })
-                    # Check template assignment parts for contradictions
-                    for k, v in template_assignment.iteritems():
-                        k_parts = Types.split_T(k)
-                        v_parts = Types.split_T(v['etypes'])
-                        assert len(k_parts) == len(v_parts)
-                        for i in xrange(len(k_parts)):
-                            if Types.is_T(k_parts[i]):
-                                if k_parts[i] in template_assignment and v_parts[i] != template_assignment[k_parts[i]]['etypes']:
-                                    return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'sub t type mismatch' })
-                elif arg['vtype'] != dvt:
-                    return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'non-t type mismatch' })
-            args.append(arg)
-        funcstack.pop()
-
-        if Types.node_is_T(funcdef['outtype']):
-            ot = funcdef['outtype']['etypes']
-            parts = [[x, x] for x in Types.split_T(ot)]
-            for i in xrange(len(parts)):
-                if parts[i][0] in template_assignment:
-                    parts[i][1] = template_assignment[parts[i][0]]['etypes']
-                elif Types.is_T(parts[i][0]):
-                    # Got an unassigned template part.  Use the propagated assignment if present, otherwise error
-                    if propagated_template_assignment is not None:
-                        return dappend(ast, {'vtype': propagated_template_assignment, 'args': args})                        
-                    else:
-                        return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'unassignable template: '+parts[i][0] })
-            ta = type_node(Types.join_T((x[1] for x in parts)))
-            return dappend(ast, {'vtype': ta, 'args': args})                
-        else:
-            return dappend(ast, {'vtype': funcdef['outtype'], 'args': args})                
-    elif ast['ntype'] == Nodes.IDENT:
-        if ast['value'] not in btypes:
-            return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'unknown identifier'})
+        from pprint import pformat
+        visible = dict((name, defs[-1]) for name, defs in self.table.iteritems())
+        return pformat({'builtins': '...', 'defined': as_dict(visible)})
+
+# The reference tree walker, over a tree addressed by the RESOLVE pass and
+# bound to raw builtins by the SPECIALIZE pass.  frame is the list of values
+# for the enclosing form or call, see resolve.  Values are raw, as in
+# compiler, and only the value of a whole form is boxed into a node.
+def interpret(ast, funcstack, frame):
+    ntype = ast['ntype']
+    if ntype == Nodes.FUNC:
+        args = [interpret(arg, funcstack, frame) for arg in ast['args']]
+        fn = ast['raw']
+        if fn is None:
+            # a user function, which its define may not have reached yet
+            fn = ast['target']['call']
+        return fn(*args)
+    elif ntype == Nodes.IDENT:
+        depth, index = ast['address']
+        while depth:
+            frame = frame[0]
+            depth -= 1
+        return frame[index]
+    elif ntype == Nodes.NUM or ntype == Nodes.BOOL:
+        return ast['value']
+    elif ntype == Nodes.IF:
+        if interpret(ast['testexpr'], funcstack, frame):
+            return interpret(ast['trueexpr'], funcstack, frame)
         else:
-            return dappend(ast, {'vtype': btypes[ast['value']]})
-    elif ast['ntype'] == Nodes.LET:
-        newbtypes = dappend(btypes, {})
-        for binding in ast['bindings']:
-            # do not allow effective defines in lets. create a new scope and pop it immediately
-            funcstack.push()
-            vtyped = vtype(binding[1], funcstack, newbtypes)
-            funcstack.pop()
-            newbtypes = dappend(newbtypes, {binding[0]['value']: vtyped['vtype']})
-        expr = vtype(ast['expr'], funcstack, newbtypes)
-        return dappend(ast, {'vtype': expr['vtype'], 'expr': expr})
-    elif ast['ntype'] == Nodes.DEFINE:
-        vt = Types.VOID
-        if not propagated_btypes:
-            propagated_btypes = {}
-        typedexpr = vtype(ast['expr'], funcstack, btypes, propagated_btypes)
-        intypes = []
-        for param in ast['params']:
-            if param['value'] in propagated_btypes:
-                intypes.append(propagated_btypes[param['value']])
-            else:
-                intypes.append(Types.INVALID)
-                vt = Types.INVALID
-        outtype = typedexpr['vtype']
-        op = None
-        newast = dappend(ast, {'intypes': intypes, 'outtype': outtype, 'op': op, 'expr': typedexpr, 'vtype': type_node(vt)})
-        funcstack.define(ast['func']['value'], newast) 
-        return newast
-    elif ast['ntype'] == Nodes.IF:
-        typedtest  = vtype(ast['testexpr'], funcstack, btypes)
-        typedtrue  = vtype(ast['trueexpr'], funcstack, btypes)
-        typedfalse = vtype(ast['falseexpr'], funcstack, btypes)
-        if typedtest['vtype'] != type_node(Types.BOOL):
-            return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'test not boolean', 'testexpr': typedtest, 'trueexpr': typedtrue, 'falseexpr': typedfalse})
-        elif typedtrue['vtype'] != typedfalse['vtype']:
-            return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'test not boolean', 'testexpr': typedtest, 'trueexpr': typedtrue, 'falseexpr': typedfalse})
+            return interpret(ast['falseexpr'], funcstack, frame)
+    elif ntype == Nodes.LET:
+        for ident, expr in ast['bindings']:
+            frame[ident['address'][1]] = interpret(expr, funcstack, frame)
+        return interpret(ast['expr'], funcstack, frame)
+    elif ntype == Nodes.DEFINE:
+        pad = [None] * (ast['size'] - len(ast['params']) - 1)
+        body = ast['expr']
+        limits = funcstack.limits
+        if limits is None:
+            def call(*args):
+                return interpret(body, funcstack, [frame] + list(args) + pad)
         else:
-            return dappend(ast, {'vtype': typedtrue['vtype'], 'testexpr': typedtest, 'trueexpr': typedtrue, 'falseexpr': typedfalse})
-    return dappend(ast, {'vtype': type_node(Types.INVALID), 'error': 'unknown node type'})
+            def call(*args):
+                limits.steps += 1
+                if limits.steps >= limits.next_check:
+                    limits.check()
+                return interpret(body, funcstack, [frame] + list(args) + pad)
+        memo = funcstack.memo
+        if memo is not None and memo.wanted(ast['func']['value']):
+            call = memo.wrap_call(ast, call)
+        if funcstack.profile is not None:
+            call = funcstack.profile.wrap(ast['func']['value'], call)
+        ast['call'] = call
+        return None
+    raise Exception("Should handle all node types")
 
-def interpret(ast, funcstack, bindings={}):
-    #print "ASTB", ast, bindings
-    if ast['ntype'] == Nodes.INVALID or ast['vtype'] == type_node(Types.INVALID):
-        return ast
-    elif ast['ntype'] in [Nodes.NUM, Nodes.BOOL]:
+# INTERPRET pass: walk the resolved tree in a fresh frame for the form and
+# box its value; a form with no value, such as a define, is its own node
+def interpret_ast(ast, funcstack):
+    if compiler.is_invalid(ast):
         return ast
-    elif ast['ntype'] == Nodes.IDENT:
-        return bindings[ast['value']]
-    elif ast['ntype'] == Nodes.LET:
-        newbindings = dappend(bindings, {})
-        for bpair in ast['bindings']:
-            newbindings[bpair[0]['value']] = bpair[1]
-        return interpret(ast['expr'], funcstack, newbindings)
-    elif ast['ntype'] == Nodes.FUNC:
-        newargs = [interpret(arg, funcstack, bindings) for arg in ast['args']]
-        funcdef = funcstack[ast['func']['value']]
-        newast = funcdef['op'](newargs)
-        newast['vtype'] = ast['vtype']
-        return newast
-    elif ast['ntype'] == Nodes.DEFINE:
-        funcdef = funcstack[ast['func']['value']]
-        def op(args):
-            newbindings = dappend(bindings, {})
-            for i in xrange(len(ast['params'])):
-                pname = ast['params'][i]['value']
-                arg = args[i]
-                newbindings[pname] = interpret(arg, funcstack, newbindings)
-            return interpret(ast['expr'], funcstack, newbindings)
-        funcdef['op'] = op
-        return ast
-    elif ast['ntype'] == Nodes.IF:
-        tested = interpret(ast['testexpr'], funcstack, bindings)
-        if tested['value']:
-            return interpret(ast['trueexpr'], funcstack, bindings)
-        else:
-            return interpret(ast['falseexpr'], funcstack, bindings)
-    raise Exception("Should handle all node types")
+    return compiler.result(interpret(ast, funcstack, [None] * ast.get('code', 1)), ast)
 
 def condexpand(ast, _):
     if ast['ntype'] != Nodes.FUNC or ast['func']['value'] != 'cond':
@@ -417,58 +380,280 @@ def condexpand(ast, _):
             newast = if_node(astify(test_expr), astify(true_expr), newast)
         return newast
 
-PASSES = [
+# Every pass is [name, function, matcher], where matcher names the attribute
+# of matcher.ASTMatchers its output must match.  The matchers are only
+# built, by importing matcher, when a pipeline first checks a form.
+FRONTEND = [
     # passes on the untyped tree
     # expand cond to ifs
-    ["COND", condexpand, matcher.ASTMatchers.astified],
+    ["COND", condexpand, 'astified'],
     # type the tree
-    ["VTYPE", vtype, matcher.ASTMatchers.vtyped],
-    # passes on the typed tree
-    # final pass
-    ["INTERPRET", interpret, matcher.ASTMatchers.interpreted],
+    ["VTYPE", vtype, 'vtyped'],
 ]
 
+# optional passes on the typed tree, between the front end and the backend
+OPTIMIZE = [
+    # fold constants and inline small functions
+    ["FOLD", fold_ast, 'folded'],
+]
 
-def execute(prog_str):
-    tokens = tokenize(prog_str)
-    nested = list(nest(tokens))
-    funcstack = FuncStack(BUILTINS)
-    for sexp in nested:
+# passes on the typed tree, ending with a final pass that evaluates it
+BACKENDS = {
+    # compile to closures and run them
+    'closure': [
+        ["COMPILE", compiler.compile_ast, 'compiled'],
+        ["RUN", compiler.run, 'interpreted'],
+    ],
+    # lower to instructions for the explicit-stack machine, which has proper
+    # tail calls and no python recursion at run time
+    'stack': [
+        ["LOWER", machine.lower_ast, 'compiled'],
+        ["MACHINE", machine.run, 'interpreted'],
+    ],
+    # compile to bytecode for the vm, which also has proper tail calls
+    'vm': [
+        ["BYTECODE", vm.compile_ast, 'compiled'],
+        ["VM", vm.run, 'interpreted'],
+    ],
+    # the original tree walker, kept as a reference
+    'interpret': [
+        ["RESOLVE", resolve_ast, 'compiled'],
+        ["SPECIALIZE", specialize_ast, 'compiled'],
+        ["INTERPRET", interpret_ast, 'interpreted'],
+    ],
+}
+
+PASSES = FRONTEND + OPTIMIZE + BACKENDS['closure']
+
+
+# How much checking and printing execute does around each pass:
+#   production: none at all
+#   debug: check every matcher on one form in every `sample`
+#   trace: check and pretty-print every form after every pass
+MODES = ['production', 'debug', 'trace']
+
+class Pipeline(object):
+    # profile, a profiler.Profile, times the passes of every form that is not
+    # checked.  With limits on the funcstack, a form that goes over them
+    # becomes an invalid node saying which one.
+    def __init__(self, passes, mode='production', sample=10, profile=None):
+        assert mode in MODES
+        self.passes = passes
+        self.mode = mode
+        self.sample = sample
+        self.profile = profile
+        self.forms = 0
+
+    def run(self, sexp, funcstack, where):
+        if funcstack.limits is None:
+            return self.evaluate(sexp, funcstack, where)
+        try:
+            return self.evaluate(sexp, funcstack, where)
+        except (LimitExceeded, RuntimeError) as e:
+            error = exceeded(e)
+            if error is None:
+                raise
+            return invalid_node(sexp, error)
+
+    def evaluate(self, sexp, funcstack, where):
+        index = self.forms
+        self.forms += 1
+        if self.mode == 'trace':
+            return self.checked(sexp, funcstack, where, True)
+        elif self.mode == 'debug' and index % self.sample == 0:
+            return self.checked(sexp, funcstack, where, False)
+        elif self.profile is not None:
+            return self.profiled(sexp, funcstack, where)
         ast = astify(sexp)
-        print "INITIAL", pformat(ast)
-        matched = matcher.ASTMatchers.astified.matches(ast, 0)
-        print "MATCHED?", matched
-        assert matched
-        for p in PASSES:
+        for name, func, m in self.passes:
+            ast = func(ast, funcstack)
+        return ast
+
+    def profiled(self, sexp, funcstack, where):
+        profile = self.profile
+        start = timer()
+        ast = profile.run_pass("ASTIFY", lambda sexp, funcstack: astify(sexp), sexp, funcstack)
+        for name, func, m in self.passes:
+            ast = profile.run_pass(name, func, ast, funcstack)
+        profile.form(where, timer() - start)
+        return ast
+
+    def checked(self, sexp, funcstack, where, verbose):
+        # trace mode runs the combinators so VERBOSE can show each step;
+        # otherwise the compiled predicates are cheap enough to run per form
+        import matcher
+        from pprint import pformat
+        matchers = matcher.ASTMatchers
+        check = (lambda m, ast: m.matches(ast, 0)) if verbose else (lambda m, ast: m.compile()(ast))
+        ast = astify(sexp)
+        if verbose: print "INITIAL", where, pformat(as_dict(ast))
+        matched = check(matchers.astified, ast)
+        if verbose: print "MATCHED?", matched
+        assert matched, where
+        for p in self.passes:
             name, func, m = p
-            print "STARTING", name
+            if verbose: print "STARTING", name
             ast = func(ast, funcstack)
-            print "FINISHED", name, pformat(ast)
-            matched = m.matches(ast, 0)
-            print "MATCHED?", matched
-            assert matched
-        yield ast, funcstack
+            if verbose: print "FINISHED", name, pformat(as_dict(ast))
+            matched = check(getattr(matchers, m), ast)
+            if verbose: print "MATCHED?", matched
+            assert matched, name+" failed on "+where
+        return ast
+
+# prog may be a string or an iterable of lines such as an open file; each
+# form is evaluated as soon as it has been read.  memo is a memo.Memo to
+# cache the results of user functions in, which the closure and interpret
+# backends honour.  optimize runs the OPTIMIZE passes.  profile is a
+# profiler.Profile to record timings in, and limits a limits.Limits to bound
+# the whole run by.
+def execute(prog, backend='closure', mode='production', sample=10, memo=None, optimize=True, profile=None,
+            limits=None):
+    pipeline = Pipeline(FRONTEND + (OPTIMIZE if optimize else []) + BACKENDS[backend], mode, sample, profile)
+    funcstack = FuncStack(BUILTINS, memo, profile, limits)
+    if limits is not None:
+        limits.start()
+    for sexp, line, col in read(prog):
+        where = "form at line %d, column %d" % (line, col)
+        yield pipeline.run(sexp, funcstack, where), funcstack
+
+# compile every form of prog to bytecode without running any of it; run()
+# on the vm.Program gives the results, as often as needed
+def compile_program(prog, optimize=True):
+    passes = FRONTEND + (OPTIMIZE if optimize else []) + BACKENDS['vm'][:1]
+    pipeline = Pipeline(passes)
+    funcstack = FuncStack(BUILTINS)
+    funcstack.program = vm.Program(record=True)
+    for sexp, line, col in read(prog):
+        pipeline.run(sexp, funcstack, "form at line %d, column %d" % (line, col))
+    return funcstack.program
+
+# printable result of a form, or None for defines
+def show(ast):
+    if ast['ntype'] == Nodes.INVALID or ast['vtype'] is INVALID:
+        return "error: " + ast['error']
+    elif ast['ntype'] == Nodes.NUM:
+        return str(ast['value'])
+    elif ast['ntype'] == Nodes.BOOL:
+        return "#t" if ast['value'] else "#f"
+    elif ast['ntype'] == Nodes.LIST:
+        arg = ast['vtype'].arg
+        return "(" + " ".join(show(box(item, arg)) for item in lists.items(ast['items'])) + ")"
+    return None
 
 if __name__ == "__main__":
     import sys
-    use_string = "USE: sexp.py (-f file | -c string)" 
-    if len(sys.argv) < 3:
-        print use_string
-        sys.exit(-1)
-    flag = sys.argv[1]
-    arg = sys.argv[2]
-    program = ""
-
-    if flag == "-f":
-        with open(arg, "r") as f:
-            program = f.read()
-    elif flag == "-c":
-        program = arg
+    import argparse
+    parser = argparse.ArgumentParser(description="Evaluate a scheme program.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("-f", dest="file", help="program file, or - for stdin")
+    source.add_argument("-c", dest="string", help="program string")
+    parser.add_argument("-b", dest="backend", default="closure", choices=sorted(BACKENDS.keys()),
+                        help="evaluation backend (default: closure)")
+    parser.add_argument("-m", dest="mode", default="production", choices=MODES,
+                        help="checking and tracing around passes (default: production)")
+    parser.add_argument("--no-optimize", dest="optimize", action="store_false",
+                        help="skip constant folding and inlining")
+    parser.add_argument("--memo", dest="memo", type=int, metavar="SIZE",
+                        help="memoize user functions in LRU caches of SIZE entries")
+    parser.add_argument("--memo-only", dest="memo_only", metavar="NAMES",
+                        help="comma-separated functions to memoize (default: all)")
+    parser.add_argument("--profile", dest="profile", metavar="FILE",
+                        help="write a json report of pass, form and function timings to FILE")
+    parser.add_argument("--folded", dest="folded", metavar="FILE",
+                        help="write folded stacks of the profile, for flamegraph.pl, to FILE")
+    parser.add_argument("--fuel", dest="fuel", type=int, metavar="STEPS",
+                        help="stop evaluating after STEPS calls of user functions")
+    parser.add_argument("--timeout", dest="timeout", type=float, metavar="SECONDS",
+                        help="stop evaluating after SECONDS of wall time")
+    parser.add_argument("--max-cells", dest="cells", type=int, metavar="CELLS",
+                        help="stop evaluating after allocating CELLS list cells")
+    parser.add_argument("-i", dest="interactive", action="store_true",
+                        help="start a session reading forms from stdin, after the program if one is given")
+    parser.add_argument("-j", dest="processes", type=int, metavar="N",
+                        help="evaluate independent forms on N processes")
+    parser.add_argument("--cache", dest="cache", metavar="DIR",
+                        help="run on the vm, with compiled programs cached in DIR")
+    args = parser.parse_args()
+    if args.file is None and args.string is None and not args.interactive:
+        parser.error("one of -f, -c or -i is required")
+    if args.interactive:
+        if args.file == "-":
+            parser.error("-i reads forms from stdin, so it cannot be combined with -f -")
+        import session
+        s = session.Session(args.backend, args.optimize)
+        source = args.string
+        if args.file is not None:
+            with open(args.file) as f:
+                source = f.read()
+        if source is not None:
+            for shown in s.load(source):
+                if shown is not None:
+                    print shown
+        session.repl(s)
+        sys.exit(0)
+    if args.memo is not None and (args.backend in ('stack', 'vm') or args.cache):
+        parser.error("--memo needs the closure or interpret backend, and cannot be combined with --cache")
+    limited = args.fuel is not None or args.timeout is not None or args.cells is not None
+    if args.processes is not None and (args.memo or args.profile or args.folded or args.cache or args.mode != 'production'):
+        parser.error("-j cannot be combined with --memo, --profile, --folded, --cache or -m")
+    if limited and (args.processes is not None or args.cache):
+        parser.error("--fuel, --timeout and --max-cells cannot be combined with -j or --cache")
+
+    memo = None
+    if args.memo is not None:
+        from memo import Memo
+        names = args.memo_only.split(",") if args.memo_only else None
+        memo = Memo(names, args.memo)
+
+    profile = None
+    if args.profile is not None or args.folded is not None:
+        from profiler import Profile
+        profile = Profile()
+
+    limits = None
+    if limited:
+        from limits import Limits
+        limits = Limits(args.fuel, args.timeout, args.cells)
+
+    # print the results of program, a string or a file read as it runs
+    def evaluate(program):
+        if args.cache is not None:
+            # through the sexp module rather than __main__, so the pickled
+            # builtins can be found again by any later run
+            import cache
+            if not isinstance(program, basestring):
+                program = program.read()
+            results = cache.Cache(args.cache).program(program, args.optimize).run()
+        elif args.processes is not None:
+            import parallel
+            results = None
+            for shown in parallel.execute(program, args.processes, args.backend, args.optimize):
+                if shown is not None:
+                    print shown
+        else:
+            results = (res for res, _ in execute(program, args.backend, args.mode, memo=memo,
+                                                optimize=args.optimize, profile=profile, limits=limits))
+
+        for interpreted in results or []:
+            if args.mode != 'trace':
+                shown = show(interpreted)
+                if shown is not None:
+                    print shown
+
+    if args.file == "-":
+        evaluate(sys.stdin)
+    elif args.file is not None:
+        with open(args.file, "r") as program:
+            evaluate(program)
     else:
-        print use_string
-        sys.exit(-1)
+        evaluate(args.string)
 
-    program = program.strip()
-    for interpreted, funcstack in execute(program):
-        pass
+    if memo is not None:
+        for name, stats in sorted(memo.stats().items()):
+            print >>sys.stderr, "memo %s: %d hits, %d misses, %d evictions" % (name, stats['hits'], stats['misses'], stats['evictions'])
 
+    if profile is not None:
+        for path, text in [(args.profile, profile.json()), (args.folded, profile.folded())]:
+            if path is not None:
+                with open(path, "w") as f:
+                    f.write(text + "\n")
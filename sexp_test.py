@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import sys
+import subprocess
 import unittest
 import sexp
 import matcher
@@ -19,7 +21,13 @@ class TestSexp(unittest.TestCase):
         ["(+ (* 1 2) (/ 12 4))", [mnum(5)]],
         ["(+ 1 2)(+ 3 4)", [mnum(3), mnum(7)]],
         ["(let ((n 8)) (add 3 n))", [mnum(11)]],
+        ["(let ((n (add 1 2))) (mul n n))", [mnum(9)]],
+        ["(let ((n 2)) (let ((n (mul n 5))) (let ((m n)) (add m n))))", [mnum(20)]],
+        ["(define (shadow n) (let ((n (add n 1))) (mul n n))) (shadow 2) (shadow 3)", [M.void, mnum(9), mnum(16)]],
         ["(define (double n) (mul 2 n)) (double 3)", [M.void, mnum(6)]],
+        ["(define (fib n) (if (lt n 2) n (add (fib (sub n 1)) (fib (sub n 2))))) (fib 10)", [M.void, mnum(55)]],
+        ["(define (same x) x) (same 3) (same #f)", [M.void, mnum(3), mbool(False)]],
+        ["(define (bad x) (add x #t))", [M.invalid]],
         ["(idnum 3)", [mnum(3)]],
         ["(idbool #t)", [mbool(True)]],
         ["(idbool #f)", [mbool(False)]],
@@ -30,18 +38,166 @@ class TestSexp(unittest.TestCase):
         ["(cond (#f 1) 2)", [mnum(2)]],
         ["(id 3)", [mnum(3)]],
         ["(+ (id 3) 4)", [mnum(7)]],
-        ["(nil)", [M.invalid & matcher.equals_('error', 'unassignable template: T_1')]],
+        ["(nil)", [~M.invalid & M.mlist]],
         ["(cons 1 (nil))", [~M.invalid & M.mlist]],
         ["(sum (cons 1 (cons 2 (nil))))", [mnum(3)]],
         ["(cons #t (cons #f (nil)))", [~M.invalid & M.mlist]],
-        ["(cons #t (cons 1 (nil)))", [M.invalid]]
+        ["(cons #t (cons 1 (nil)))", [M.invalid]],
+        ["(length (cons #t (cons #f (nil))))", [mnum(2)]],
+        ["(length (nil))", [mnum(0)]],
+        ["(sum (range 5))", [mnum(10)]],
+        ["(sum (map-add 1 (map-mul 2 (range 4))))", [mnum(16)]],
+        ["(let ((xs (cons 1 (nil)))) (let ((ys (cons 2 xs))) (add (sum (cons 3 xs)) (sum ys))))", [mnum(7)]],
+        ["(map-add 1 (cons #t (nil)))", [M.invalid]],
+        ["(+ 1 2 3 4 5)", [mnum(15)]],
+        ["(define (p a b c) (mul a b c 2)) (p 1 2 3)", [M.void, mnum(12)]],
+        ["(and #t #t #f)", [mbool(False)]],
+        ["(or #f #f #t #f)", [mbool(True)]],
+        ["(min 4 2 7)", [mnum(2)]],
+        ["(max 4 (neg 2) 9 1)", [mnum(9)]],
+        ["(add 1)", [M.invalid]],
+        ["(add 1 2 #t)", [M.invalid]],
+        ["(sub 1 2 3)", [M.invalid]]
     ]
 
     def test_cases(self):
-        for case in self.CASES:
-            program, expected = case
-            actual = [res for res, _ in sexp.execute(program)]
-            self.assertEqual(expected, actual)
+        for backend in sexp.BACKENDS:
+            for optimize in [True, False]:
+                for case in self.CASES:
+                    program, expected = case
+                    actual = [res for res, _ in sexp.execute(program, backend, 'debug', 1, optimize=optimize)]
+                    self.assertEqual(expected, actual, program+" on "+backend)
+
+    # defines in a let or a function body see its variables, and bind their
+    # function each time they are run
+    NESTED = [
+        ["(let ((x 1)) (define (f y) (add x y))) (f 2)", [None, "3"]],
+        ["(define (fact n) (if (eq n 0) 1 (mul n (fact (sub n 1))))) (let ((x (fact 3))) (define (f y) (add x y))) (f 2)",
+         [None, None, "8"]],
+        ["(define (h a) (let ((x a)) (define (f y) (add x y)))) (h 1) (f 2) (h 10) (f 2)", [None, None, "3", None, "12"]],
+        ["(let ((k 2)) (define (p n) (if (eq n 0) 1 (mul k (p (sub n 1)))))) (p 10)", [None, "1024"]],
+        ["(let ((k 2)) (let ((j 3)) (define (g a) (let ((z (add a j))) (define (q b) (add (mul k z) b)))))) (g 1) (q 5)",
+         [None, None, "13"]],
+    ]
+
+    def test_nested_defines(self):
+        for backend in sorted(sexp.BACKENDS):
+            for optimize in [True, False]:
+                for program, expected in self.NESTED:
+                    actual = [sexp.show(res) for res, _ in sexp.execute(program, backend, 'debug', 1, optimize=optimize)]
+                    self.assertEqual(expected, actual, program+" on "+backend)
+                program = "(define (h a) (let ((x a)) (define (f y) (add x y)))) (f 2)"
+                with self.assertRaisesRegexp(Exception, "f called before its define was reached"):
+                    list(sexp.execute(program, backend, optimize=optimize))
+
+    FOLDS = [
+        ["(add (mul 1 2) (div 12 4))", "5"],
+        ["(if (lt 1 2) (add 1 2) (sub 3 4))", "3"],
+        ["(div 1 0)", "(div 1 0)"],
+        ["(define (sq n) (mul n n)) (define (f x y) (add (sq x) (let ((z (sub x 1))) (mul z y))))",
+         "(define (f x y) (add (mul x x) (mul (sub x 1) y)))"],
+        ["(define (h a) (let ((b (mul a 2))) (let ((a 7)) (add a b))))", "(define (h a) (let ((b (mul a 2))) (add 7 b)))"],
+        ["(define (k a) (let ((b (mul a a))) (add b b)))", "(define (k a) (let ((b (mul a a))) (add b b)))"],
+        ["(define (fib n) (if (lt n 2) n (add (fib (sub n 1)) (fib (sub n 2))))) (fib 3)", "(fib 3)"],
+        ["(let ((a (add 1 2))) (let ((b a)) (let ((a 10)) (add a b))))", "13"],
+        ["(define (p x) (lt x 3)) (define (q x) (if (p x) x 3)) (q 1)", "1"],
+        ["(define (s a b c) (add (add a (add b 1)) (mul c 2) 3))", "(define (s a b c) (add a b 1 (mul c 2) 3))"],
+        ["(add (add 1 2) 3 (add 4 5))", "15"],
+    ]
+
+    def unparse(self, ast):
+        ntype = ast['ntype']
+        if ntype == stypes.Nodes.IDENT or ntype == stypes.Nodes.NUM:
+            return str(ast['value'])
+        elif ntype == stypes.Nodes.FUNC:
+            return "(%s)" % " ".join([ast['func']['value']] + [self.unparse(arg) for arg in ast['args']])
+        elif ntype == stypes.Nodes.LET:
+            bindings = " ".join("(%s %s)" % (ident['value'], self.unparse(expr)) for ident, expr in ast['bindings'])
+            return "(let (%s) %s)" % (bindings, self.unparse(ast['expr']))
+        elif ntype == stypes.Nodes.DEFINE:
+            names = " ".join(ident['value'] for ident in [ast['func']] + ast['params'])
+            return "(define (%s) %s)" % (names, self.unparse(ast['expr']))
+        return sexp.show(ast)
+
+    def test_fold(self):
+        for program, expected in self.FOLDS:
+            funcstack = sexp.FuncStack(sexp.BUILTINS)
+            for form, line, col in sexp.read(program):
+                ast = sexp.vtype(sexp.astify(form), funcstack)
+                folded = sexp.fold_ast(ast, funcstack)
+            self.assertEqual(expected, self.unparse(folded), program)
+            self.assertTrue(M.folded.compile()(folded), program)
+
+    def test_read(self):
+        program = "(add 1 ; comment\n  [mul 2 3])\n  x (neg"
+        actual = list(sexp.read(program))
+        self.assertEqual([(['add', '1', ['mul', '2', '3']], 1, 1), ('x', 3, 3), (['neg'], 3, 5)], actual)
+
+    def test_funcstack(self):
+        funcstack = sexp.FuncStack(sexp.BUILTINS)
+        funcstack.define('f', 1)
+        funcstack.push()
+        funcstack.define('f', 2)
+        funcstack.define('g', 3)
+        funcstack.define('g', 4)
+        self.assertEqual((2, 4), (funcstack['f'], funcstack['g']))
+        funcstack.pop()
+        self.assertEqual(1, funcstack['f'])
+        self.assertFalse('g' in funcstack)
+        self.assertTrue('add' in funcstack)
+
+    def test_specialize(self):
+        funcstack = sexp.FuncStack(sexp.BUILTINS)
+        passes = sexp.FRONTEND + sexp.BACKENDS['interpret'][:2]
+        define, form = [sexp.Pipeline(passes).run(f, funcstack, "test") for f, l, c in
+                        sexp.read("(define (f x) (add (idnum x) 1 2)) (id (f (neg 3)))")]
+        # the variadic add is bound to its variadic raw, and the identity calls are gone
+        body = define['expr']
+        self.assertTrue(body['raw'] is sexp.BUILTINS['add']['variadic'])
+        self.assertEqual(stypes.Nodes.IDENT, body['args'][0]['ntype'])
+        self.assertEqual('f', form['func']['value'])
+        self.assertTrue(form['raw'] is None)
+        self.assertEqual(stypes.Nodes.FUNC, form['args'][0]['ntype'])
+        sexp.interpret_ast(define, funcstack)
+        self.assertEqual(0, sexp.interpret_ast(form, funcstack)['value'])
+
+    def test_builtins(self):
+        builtins = sexp.Builtins(sexp.BUILTIN_SPECS, sexp.ALIASES)
+        self.assertTrue('+' in builtins and 'map-add' in builtins)
+        self.assertFalse('plus' in builtins)
+        self.assertEqual(0, dict.__len__(builtins))
+        # reads see builtins that have not been built yet
+        self.assertEqual(sexp.vm.SUB, builtins.get('sub')['opcode'])
+        self.assertEqual(None, builtins.get('plus'))
+        self.assertTrue(builtins['+'] is builtins['add'])
+        self.assertEqual(sexp.vm.ADD, builtins['add']['opcode'])
+        self.assertEqual(3, dict.__len__(builtins))
+        self.assertRaises(KeyError, lambda: builtins['plus'])
+        names = builtins.names()
+        self.assertEqual(len(sexp.BUILTIN_SPECS) + len(sexp.ALIASES), len(names))
+        self.assertEqual((names, names, len(names)), (builtins.keys(), list(builtins), len(builtins)))
+        self.assertEqual(names, sorted(dict(builtins.items())))
+        def assign():
+            builtins['plus'] = builtins['add']
+        self.assertRaises(TypeError, assign)
+        self.assertRaises(TypeError, builtins.update, {'plus': None})
+        self.assertFalse('plus' in builtins)
+
+    def test_startup(self):
+        # modules only checking, profiling and memoizing need
+        code = "import sys, sexp; print [m for m in ['matcher', 'pprint', 'memo', 'profiler', 'json'] if m in sys.modules]"
+        self.assertEqual("[]", subprocess.check_output([sys.executable, "-c", code]).strip())
+
+    def test_deep_recursion(self):
+        program = """
+            (define (count n acc) (if (eq n 0) acc (count (sub n 1) (add acc 1))))
+            (define (fact n) (if (eq n 0) 1 (mul n (fact (sub n 1)))))
+            (count 100000 0)
+            (gt (fact 3000) 0)
+        """
+        actual = [res for res, _ in sexp.execute(program, 'stack')]
+        expected = [M.void, M.void, M.num & matcher.equals_('value', 100000), M.mbool & matcher.equals_('value', True)]
+        self.assertEqual(expected, actual)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,57 @@
+from stypes import *
+from compiler import is_invalid, raw_for, raw_id
+
+# Binds every call in a resolved tree to what the tree walker runs for it, so
+# the walker never looks a builtin up or dispatches on its arguments.
+#
+# VTYPE has already checked every call, so a builtin call gets the raw
+# implementation for its number of arguments, as compiled code does: the
+# fixed arity one, or the variadic one that folds a longer argument list in
+# one call.  Calls to the identity builtins are replaced by their argument.
+# A call to a user function gets no raw function, and the walker calls the
+# 'call' its define leaves on the funcdef.  Builtins are wrapped here for
+# limits and profiling, so the walker has nothing to check per call.
+#
+# Defines are specialized in place, like the resolver does, since calls were
+# resolved to the nodes in the tree.
+
+class Specializer(object):
+    def __init__(self, funcstack):
+        self.funcstack = funcstack
+
+    def specialize(self, ast):
+        ntype = ast['ntype']
+        if ntype == Nodes.FUNC:
+            args = [self.specialize(arg) for arg in ast['args']]
+            target = ast['target']
+            if 'raw' not in target:
+                return ast.replace(args=args, raw=None)
+            fn = raw_for(target, len(args))
+            if fn is raw_id:
+                return args[0]
+            name = ast['func']['value']
+            if self.funcstack.limits is not None:
+                fn = self.funcstack.limits.builtin(name, fn)
+            if self.funcstack.profile is not None:
+                fn = self.funcstack.profile.wrap(name, fn)
+            return ast.replace(args=args, raw=fn)
+        elif ntype == Nodes.LET:
+            bindings = [(ident, self.specialize(expr)) for ident, expr in ast['bindings']]
+            return ast.replace(bindings=bindings, expr=self.specialize(ast['expr']))
+        elif ntype == Nodes.IF:
+            return ast.replace(testexpr=self.specialize(ast['testexpr']),
+                               trueexpr=self.specialize(ast['trueexpr']),
+                               falseexpr=self.specialize(ast['falseexpr']))
+        elif ntype == Nodes.DEFINE:
+            ast['expr'] = self.specialize(ast['expr'])
+        return ast
+
+# SPECIALIZE pass: bind the calls of valid expressions; a form that was an
+# identity call keeps its own frame size and type
+def specialize_ast(ast, funcstack):
+    if is_invalid(ast):
+        return ast
+    specialized = Specializer(funcstack).specialize(ast)
+    if ast['ntype'] != Nodes.DEFINE and 'code' not in specialized:
+        specialized = specialized.replace(code=ast['code'], vtype=ast['vtype'])
+    return specialized
@@ -1,3 +1,6 @@
+import typeterms
+import lists
+
 class Nodes:
     NUM = 'NumNode'
     BOOL = 'BoolNode'
@@ -7,7 +10,7 @@ class Nodes:
     IF = 'IfNode'
     FUNC = 'FuncNode'
     INVALID = 'InvalidNode'
-    TYPE = 'TypeNode'
+    TYPE = typeterms.Type.ntype
     LIST = 'ListNode'
 
 class Types:
@@ -19,35 +22,206 @@ class Types:
     @classmethod
     def T(cls, x): return 'T_'+str(x)
     @classmethod
-    def node_is_T(cls, tx):
-        return 'etypes' in tx and 'T_' in tx['etypes']
-    @classmethod
     def is_T(cls, x):
         return 'T_' in x
-    @classmethod
-    def split_T(cls, et):
-        return et.split("-")
-    @classmethod
-    def join_T(cls, ets):
-        return "-".join(ets)
 
+# Nodes are small slotted objects with a dict-like view, so matchers and
+# passes can keep indexing them by key.  Passes build new trees with
+# replace(), which copies one node and shares all of its unchanged children.
+class Node(object):
+    __slots__ = ('vtype', 'error', 'code')
+    ntype = None
+
+    # plain slot access; a key that was never set raises AttributeError
+    __getitem__ = object.__getattribute__
+    __setitem__ = object.__setattr__
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+    def keys(self):
+        return ['ntype'] + [k for k in self.__slots__ + Node.__slots__ if hasattr(self, k)]
+    def iteritems(self):
+        for k in self.keys():
+            yield k, getattr(self, k)
+    def items(self):
+        return list(self.iteritems())
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+    def replace(self, **changes):
+        new = object.__new__(type(self))
+        for k in self.__slots__ + Node.__slots__:
+            if hasattr(self, k):
+                setattr(new, k, getattr(self, k))
+        for k, v in changes.iteritems():
+            setattr(new, k, v)
+        return new
+    def as_dict(self):
+        return dict((k, '...' if k in BACKEND_KEYS and v is not None else as_dict(v)) for k, v in self.iteritems())
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return False
+        for k in self.__slots__ + Node.__slots__:
+            if getattr(self, k, None) != getattr(other, k, None):
+                return False
+        return True
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __repr__(self):
+        return repr(self.as_dict())
+
+# keys holding compiled code, which may refer back to the nodes
+BACKEND_KEYS = ('code', 'call', 'machine', 'target', 'raw')
+
+# plain dict copy of a tree of nodes, for pretty printing
+def as_dict(x):
+    if isinstance(x, Node):
+        return x.as_dict()
+    elif type(x) in (list, tuple):
+        return type(x)(as_dict(y) for y in x)
+    elif type(x) is dict:
+        return dict((k, as_dict(v)) for k, v in x.iteritems())
+    return x
+
+class NumNode(Node):
+    __slots__ = ('value',)
+    ntype = Nodes.NUM
+    def __init__(self, value):
+        self.value = value
+
+class BoolNode(Node):
+    __slots__ = ('value',)
+    ntype = Nodes.BOOL
+    def __init__(self, value):
+        self.value = value
+
+class FuncNode(Node):
+    # target is the funcdef, filled in by the resolver, and raw the function
+    # the tree walker calls, filled in by the SPECIALIZE pass
+    __slots__ = ('func', 'args', 'target', 'raw')
+    ntype = Nodes.FUNC
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+class IdentNode(Node):
+    # address is the (depth, index) of the variable, filled in by the resolver
+    __slots__ = ('value', 'address')
+    ntype = Nodes.IDENT
+    def __init__(self, value):
+        self.value = value
+
+class LetNode(Node):
+    __slots__ = ('bindings', 'expr')
+    ntype = Nodes.LET
+    def __init__(self, bindings, expr):
+        self.bindings = bindings
+        self.expr = expr
+
+class InvalidNode(Node):
+    __slots__ = ('children',)
+    ntype = Nodes.INVALID
+    def __init__(self, children, error):
+        self.children = children
+        self.error = error
+
+class DefineNode(Node):
+    # intypes, outtype, size, call, machine and bytecode are filled in by
+    # later passes
+    __slots__ = ('func', 'params', 'expr', 'intypes', 'outtype', 'size', 'call', 'machine', 'bytecode')
+    ntype = Nodes.DEFINE
+    def __init__(self, func, params, expr):
+        self.func = func
+        self.params = params
+        self.expr = expr
+
+class IfNode(Node):
+    __slots__ = ('testexpr', 'trueexpr', 'falseexpr')
+    ntype = Nodes.IF
+    def __init__(self, testexpr, trueexpr, falseexpr):
+        self.testexpr = testexpr
+        self.trueexpr = trueexpr
+        self.falseexpr = falseexpr
+
+class ListNode(Node):
+    # items is the raw list, see lists; current and next are views of its
+    # head and tail for code that walks a list node by node
+    __slots__ = ('items',)
+    ntype = Nodes.LIST
+    def __init__(self, items):
+        self.items = items
+    @property
+    def current(self):
+        if self.items[1] == 0:
+            return None
+        vtype = getattr(self, 'vtype', None)
+        return box(lists.head(self.items), vtype and vtype.arg)
+    @property
+    def next(self):
+        if self.items[1] == 0:
+            return None
+        node = ListNode(lists.tail(self.items))
+        if hasattr(self, 'vtype'):
+            node.vtype = self.vtype
+        return node
+    def __eq__(self, other):
+        if type(self) is not type(other) or getattr(self, 'vtype', None) is not getattr(other, 'vtype', None):
+            return False
+        return lists.freeze(self.items) == lists.freeze(other.items)
+
+# interned type term for a sequence of type names, see typeterms
+_type_nodes = {}
 def type_node(*etypes):
-    return {'ntype': Nodes.TYPE, 'etypes': Types.join_T(etypes) }
+    t = _type_nodes.get(etypes)
+    if t is None:
+        t = _type_nodes[etypes] = typeterms.parse(etypes)
+    return t
 def num_node(value):
-    return {'ntype': Nodes.NUM, 'value': int(value)}
+    return NumNode(int(value))
 def bool_node(value):
-    return {'ntype': Nodes.BOOL, 'value': value == "#t" or value == True}
+    return BoolNode(value == "#t" or value == True)
 def func_node(func, args):
-    return {'ntype': Nodes.FUNC, 'func': func, 'args': args}
+    return FuncNode(func, args)
 def ident_node(value):
-    return {'ntype': Nodes.IDENT, 'value': value}
+    return IdentNode(value)
 def let_node(bindings, expr):
-    return {'ntype': Nodes.LET, 'bindings': bindings, 'expr': expr}
+    return LetNode(bindings, expr)
 def invalid_node(children, error):
-    return {'ntype': Nodes.INVALID, 'children': children, 'error': error}
+    return InvalidNode(children, error)
 def define_node(func, params, expr):
-    return {'ntype': Nodes.DEFINE, 'func': func, 'params': params, 'expr': expr}
+    return DefineNode(func, params, expr)
 def if_node(testexpr, trueexpr, falseexpr):
-    return {'ntype': Nodes.IF, 'testexpr': testexpr, 'trueexpr': trueexpr, 'falseexpr': falseexpr}
+    return IfNode(testexpr, trueexpr, falseexpr)
 def list_node(current, next):
-    return {'ntype': Nodes.LIST, 'current':current, 'next':next}
+    if current is None:
+        return ListNode(lists.NIL)
+    return ListNode(lists.cons(unbox(current), next['items']))
+
+# raw value of a value node, as compiled code has it
+def unbox(node):
+    if node.ntype == Nodes.LIST:
+        return node['items']
+    return node['value']
+
+# value node of a raw value of type vtype, which is guessed from the value
+# if it is None
+def box(value, vtype):
+    if vtype is None:
+        node = box_untyped(value)
+    elif vtype is typeterms.NUM:
+        node = num_node(value)
+    elif vtype is typeterms.BOOL:
+        node = bool_node(value)
+    elif vtype.name == Types.LIST:
+        node = ListNode(value)
+    else:
+        raise Exception("Cannot box value of type "+vtype['etypes'])
+    if vtype is not None:
+        node['vtype'] = vtype
+    return node
+
+def box_untyped(value):
+    if type(value) is bool:
+        return bool_node(value)
+    elif type(value) is tuple:
+        return ListNode(value)
+    return num_node(value)
@@ -0,0 +1,75 @@
+# Interned, hash-consed type terms.  There is exactly one object for every
+# distinct type, so types compare with 'is' and building a type that already
+# exists is a dict lookup.  Terms keep the dict-like view of the old type
+# nodes ('ntype' and the "-"-joined 'etypes' string) for the matchers.
+
+class Type(object):
+    __slots__ = ('name', 'arg', 'etypes', 'has_vars')
+    ntype = 'TypeNode'
+
+    __getitem__ = object.__getattribute__
+
+    def __init__(self, name, arg=None):
+        self.name = name
+        self.arg = arg
+        if arg is None:
+            self.etypes = name
+            self.has_vars = is_var_name(name)
+        else:
+            self.etypes = name + "-" + arg.etypes
+            self.has_vars = arg.has_vars
+    def __contains__(self, key):
+        return key == 'ntype' or key == 'etypes'
+    def is_var(self):
+        return self.arg is None and self.has_vars
+    def __reduce__(self):
+        # unpickle through the constructors so terms stay interned
+        if self.arg is not None:
+            return (List, (self.arg,))
+        elif self.has_vars:
+            return (Var, (int(self.name[2:]),))
+        return (base, (self.name,))
+    def __repr__(self):
+        return "<%s>" % self.etypes
+
+def is_var_name(name):
+    return name.startswith('T_')
+
+_bases = {}
+_lists = {}
+_vars = {}
+
+def base(name):
+    t = _bases.get(name)
+    if t is None:
+        t = _bases[name] = Type(name)
+    return t
+
+def List(elem):
+    t = _lists.get(elem)
+    if t is None:
+        t = _lists[elem] = Type('ListType', elem)
+    return t
+
+def Var(n):
+    t = _vars.get(n)
+    if t is None:
+        t = _vars[n] = Type('T_'+str(n))
+    return t
+
+NUM = base('NumType')
+BOOL = base('BoolType')
+VOID = base('VoidType')
+INVALID = base('InvalidType')
+
+# term for a sequence of type names like ('ListType', 'T_1')
+def parse(names):
+    t = None
+    for name in reversed(names):
+        if name == 'ListType':
+            t = List(t)
+        elif is_var_name(name):
+            t = Var(int(name[2:]))
+        else:
+            t = base(name)
+    return t
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+import unittest
+import pickle
+import stypes
+from typeterms import *
+
+class TestTypeTerms(unittest.TestCase):
+
+    def test_interned(self):
+        self.assertIs(List(NUM), List(NUM))
+        self.assertIs(Var(1), Var(1))
+        self.assertIsNot(List(NUM), List(BOOL))
+        self.assertIs(stypes.type_node(stypes.Types.LIST, stypes.Types.T(1)), List(Var(1)))
+        self.assertIs(pickle.loads(pickle.dumps(List(List(BOOL)), 2)), List(List(BOOL)))
+
+    def test_etypes(self):
+        self.assertEqual(List(Var(2))['etypes'], 'ListType-T_2')
+        self.assertEqual(NUM['ntype'], stypes.Nodes.TYPE)
+
+if __name__ == '__main__':
+    unittest.main()
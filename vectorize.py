@@ -0,0 +1,192 @@
+from operator import itemgetter
+import sexp
+from stypes import *
+from compiler import Slots
+from typeterms import NUM, BOOL, INVALID
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Vectorized evaluation of a define over whole columns with numpy.
+#
+#   score = Vectorized("(define (score a b) (add (mul a 10) b))", 'score')
+#   score(numpy.arange(10**6), numpy.ones(10**6, dtype=int))
+#
+# The typed body of the function is compiled into closures like compiler's,
+# except that every value is either a python scalar (literals) or a numpy
+# array with one element per row, and builtins are the matching ufuncs.  So
+# the tree runs once per batch instead of once per row.
+#
+# div and mod floor like python's // and %, and raise ZeroDivisionError for
+# a zero divisor like the scalar backends do.  An if whose branches cannot
+# raise is a numpy.where of both; otherwise each branch runs only on the rows
+# that take it, so a guarded division does not raise for rows the guard
+# excludes.  Numbers are int64, so results match the scalar backends as long
+# as they stay within its range.
+#
+# Only functions of NumType and BoolType values can be vectorized, and calls
+# to other defines are compiled in, so recursion is not supported.
+
+UFUNCS = {
+    'add': 'add', 'sub': 'subtract', 'mul': 'multiply', 'div': 'floor_divide', 'mod': 'remainder',
+    'neg': 'negative', 'not': 'logical_not', 'and': 'logical_and', 'or': 'logical_or', 'xor': 'logical_xor',
+    'gt': 'greater', 'lt': 'less', 'eq': 'equal', 'gte': 'greater_equal', 'lte': 'less_equal', 'neq': 'not_equal',
+    'min': 'minimum', 'max': 'maximum',
+}
+IDENTITIES = ['idnum', 'idbool', 'id']
+DIVISIONS = ['div', 'mod']
+
+def dtype(vtype):
+    if vtype is NUM:
+        return numpy.int64
+    elif vtype is BOOL:
+        return numpy.bool_
+    raise ValueError("Cannot vectorize values of type "+vtype.etypes)
+
+def checked_division(ufunc):
+    def divide(a, b):
+        if not numpy.all(b):
+            raise ZeroDivisionError("integer division or modulo by zero")
+        return ufunc(a, b)
+    return divide
+
+def subset(frame, mask):
+    return [v[mask] if numpy.ndim(v) else v for v in frame]
+
+class Vectorizer(object):
+    def __init__(self, funcstack):
+        self.funcstack = funcstack
+        # builtins by the identity of their funcdef, so aliases work too
+        self.builtins = {}
+        for name, ufunc in UFUNCS.iteritems():
+            f = getattr(numpy, ufunc)
+            self.builtins[id(sexp.BUILTINS[name])] = checked_division(f) if name in DIVISIONS else f
+        for name in IDENTITIES:
+            self.builtins[id(sexp.BUILTINS[name])] = None
+        self.compiling = set()
+        self.functions = {}
+
+    # whether evaluating ast on rows that do not need it is harmless
+    def safe(self, ast):
+        ntype = ast['ntype']
+        if ntype == Nodes.FUNC:
+            funcdef = self.funcstack[ast['func']['value']]
+            if funcdef is sexp.BUILTINS['div'] or funcdef is sexp.BUILTINS['mod'] or funcdef.get('ntype') == Nodes.DEFINE:
+                return False
+            return all(self.safe(arg) for arg in ast['args'])
+        elif ntype == Nodes.LET:
+            return all(self.safe(expr) for ident, expr in ast['bindings']) and self.safe(ast['expr'])
+        elif ntype == Nodes.IF:
+            return self.safe(ast['testexpr']) and self.safe(ast['trueexpr']) and self.safe(ast['falseexpr'])
+        return True
+
+    def compile(self, ast, scope, slots):
+        ntype = ast['ntype']
+        dtype(ast['vtype'])
+        if ntype == Nodes.NUM or ntype == Nodes.BOOL:
+            value = ast['value']
+            return lambda frame: value
+        elif ntype == Nodes.IDENT:
+            return itemgetter(scope[ast['value']])
+        elif ntype == Nodes.LET:
+            scope = dict(scope)
+            stores = []
+            for ident, expr in ast['bindings']:
+                code = self.compile(expr, scope, slots)
+                scope[ident['value']] = slot = slots.alloc()
+                stores.append((slot, code))
+            expr = self.compile(ast['expr'], scope, slots)
+            def let(frame):
+                for slot, code in stores:
+                    frame[slot] = code(frame)
+                return expr(frame)
+            return let
+        elif ntype == Nodes.IF:
+            test = self.compile(ast['testexpr'], scope, slots)
+            true = self.compile(ast['trueexpr'], scope, slots)
+            false = self.compile(ast['falseexpr'], scope, slots)
+            if self.safe(ast['trueexpr']) and self.safe(ast['falseexpr']):
+                return lambda frame: numpy.where(test(frame), true(frame), false(frame))
+            out_dtype = dtype(ast['vtype'])
+            def branch(frame):
+                mask = test(frame)
+                if not numpy.ndim(mask):
+                    return true(frame) if mask else false(frame)
+                out = numpy.empty(len(mask), out_dtype)
+                other = ~mask
+                if mask.any():
+                    out[mask] = true(subset(frame, mask))
+                if other.any():
+                    out[other] = false(subset(frame, other))
+                return out
+            return branch
+        elif ntype == Nodes.FUNC:
+            funcdef = self.funcstack[ast['func']['value']]
+            args = [self.compile(arg, scope, slots) for arg in ast['args']]
+            if funcdef.get('ntype') == Nodes.DEFINE:
+                fn = self.function(funcdef)
+            elif id(funcdef) in self.builtins:
+                fn = self.builtins[id(funcdef)]
+                if fn is None:
+                    return args[0]
+                elif len(args) > 2:
+                    # a variadic builtin, one ufunc call per further argument
+                    return lambda frame: reduce(fn, [arg(frame) for arg in args])
+            else:
+                raise ValueError("Cannot vectorize builtin "+ast['func']['value'])
+            if len(args) == 1:
+                a, = args
+                return lambda frame: fn(a(frame))
+            elif len(args) == 2:
+                a, b = args
+                return lambda frame: fn(a(frame), b(frame))
+            return lambda frame: fn(*[arg(frame) for arg in args])
+        raise ValueError("Cannot vectorize node type "+ntype)
+
+    # the define as a function of one value per parameter
+    def function(self, funcdef):
+        name = funcdef['func']['value']
+        if funcdef['vtype'] is INVALID:
+            raise ValueError("Function %s is invalid: %s" % (name, funcdef['error']))
+        if id(funcdef) in self.functions:
+            return self.functions[id(funcdef)]
+        if name in self.compiling:
+            raise ValueError("Cannot vectorize recursive function "+name)
+        self.compiling.add(name)
+        params = funcdef['params']
+        scope = dict((params[i]['value'], i) for i in xrange(len(params)))
+        slots = Slots(len(params))
+        body = self.compile(funcdef['expr'], scope, slots)
+        self.compiling.discard(name)
+        pad = [None] * (slots.size - len(params))
+        fn = self.functions[id(funcdef)] = lambda *args: body(list(args) + pad)
+        return fn
+
+class Vectorized(object):
+    def __init__(self, source, name):
+        if numpy is None:
+            raise ImportError("vectorized evaluation needs numpy")
+        funcstack = None
+        for ast, funcstack in sexp.execute(source):
+            pass
+        if funcstack is None or name not in funcstack.table:
+            raise KeyError("No function named "+name)
+        funcdef = funcstack[name]
+        self.name = name
+        self.function = Vectorizer(funcstack).function(funcdef)
+        self.intypes = [dtype(t) for t in funcdef['intypes']]
+        self.outtype = dtype(funcdef['outtype'])
+
+    # the function applied row by row to one column per parameter
+    def __call__(self, *columns):
+        if len(columns) != len(self.intypes):
+            raise TypeError("%s takes %d columns, got %d" % (self.name, len(self.intypes), len(columns)))
+        arrays = [numpy.asarray(c, t) for c, t in zip(columns, self.intypes)]
+        result = self.function(*arrays)
+        if not numpy.ndim(result):
+            # a constant function, or one whose result only used literals
+            n = len(arrays[0]) if arrays else 1
+            return numpy.full(n, result, self.outtype)
+        return numpy.asarray(result, self.outtype)
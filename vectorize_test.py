@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import unittest
+import batch
+import vectorize
+from vectorize import numpy
+
+PROGRAM = """
+(define (clamp x lo hi) (if (lt x lo) lo (if (gt x hi) hi x)))
+(define (score a b) (if (gt a b) (add (mul a 10) (clamp b 0 5)) (sub b (div a 3))))
+(define (safe a b) (if (eq b 0) 0 (add (div a b) (mod a b))))
+(define (flags a b) (xor (and (gte a 0) (not (eq b 1))) (or (lt a b) (neq a 2))))
+(define (spread a b) (add a b (max a b 0) (mul a b 2) (min a (neg b) 1)))
+(define (seven) 7)
+(define (same a) a)
+(define (count n) (if (eq n 0) 0 (count (sub n 1))))
+"""
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestVectorize(unittest.TestCase):
+
+    def rows(self):
+        return [(a, b) for a in xrange(-7, 8) for b in xrange(-4, 5)]
+
+    def check(self, name, rows):
+        expected = list(batch.Batch(PROGRAM).map(name, rows))
+        actual = vectorize.Vectorized(PROGRAM, name)(*zip(*rows))
+        self.assertEqual(expected, actual.tolist(), name)
+
+    def test_scalar_match(self):
+        rows = self.rows()
+        self.check('score', rows)
+        self.check('safe', rows)
+        self.check('flags', rows)
+        self.check('spread', rows)
+        self.check('clamp', [(a, b, b + 3) for a, b in rows])
+        self.assertEqual([7], vectorize.Vectorized(PROGRAM, 'seven')().tolist())
+
+    def test_errors(self):
+        self.assertRaises(ZeroDivisionError, vectorize.Vectorized("(define (d a b) (div a b))", 'd'), [1, 2], [1, 0])
+        self.assertRaises(ValueError, vectorize.Vectorized, PROGRAM, 'count')
+        self.assertRaises(ValueError, vectorize.Vectorized, PROGRAM, 'same')
+        self.assertRaises(ValueError, vectorize.Vectorized, "(define (s xs) (sum xs))", 's')
+        self.assertRaises(KeyError, vectorize.Vectorized, PROGRAM, 'nope')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,423 @@
+from array import array
+from stypes import *
+from typeterms import VOID
+from lists import NIL as EMPTY, cons
+from compiler import Slots, box, is_invalid, nested_scope, raw_for, result
+
+# A bytecode compiler and virtual machine.
+#
+# Each user function and each top-level expression compiles to a Function:
+# a flat array('i') of opcodes and their integer operands.  Constants,
+# including the raw implementations of builtins without an opcode of their
+# own, live in the Program's constant table and function names in its name
+# table; CALL and TAILCALL take an index into the Program's functions.
+#
+# The machine runs one loop over a single value stack.  A call leaves its
+# arguments on the stack as the first locals of the new frame, after which
+# come the let slots, so LOAD and STORE index from the frame's base.  CALL
+# saves the caller's code, pc and base; TAILCALL moves the arguments down
+# over the current frame instead, so tail recursion runs in constant space.
+#
+# Values are raw python values, as in compiler.  A recording Program, as
+# compile_program() makes, holds everything needed to run its forms again,
+# see Program.run(); any other only keeps its functions, and the constants
+# of a top-level expression only until the next form is compiled, so
+# streaming through the vm takes no more memory the more forms it runs.
+#
+# With limits, every function starts with a STEP that takes a step of the
+# limits.Limits in its constant, and cons goes through PRIM so its cells are
+# counted; without them neither is emitted.
+#
+# A define nested in a form compiles to a function of its own that starts
+# with an ENV, which copies the values it captured into the locals after its
+# arguments, and to a BIND where the define is, which puts the values of
+# those variables in the cell both take as their constant.
+
+(LOAD, CONST, STORE, JUMP, JUMP_IF_FALSE, CALL, TAILCALL, RETURN, PRIM,
+ ADD, SUB, MUL, DIV, MOD, NEG, NOT, AND, OR, XOR,
+ GT, LT, EQ, GTE, LTE, NEQ, ID, NIL, CONS, STEP, ENV, BIND) = range(31)
+
+NAMES = ['LOAD', 'CONST', 'STORE', 'JUMP', 'JUMP_IF_FALSE', 'CALL', 'TAILCALL', 'RETURN', 'PRIM',
+         'ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'NEG', 'NOT', 'AND', 'OR', 'XOR',
+         'GT', 'LT', 'EQ', 'GTE', 'LTE', 'NEQ', 'ID', 'NIL', 'CONS', 'STEP', 'ENV', 'BIND']
+
+# operand count of every opcode, for walking the code
+OPERANDS = dict((op, 0) for op in xrange(len(NAMES)))
+OPERANDS.update({LOAD: 1, CONST: 1, STORE: 1, JUMP: 1, JUMP_IF_FALSE: 1, CALL: 1, TAILCALL: 1, PRIM: 2, STEP: 1,
+                 ENV: 2, BIND: 2})
+
+# opcodes of the builtins the machine implements inline, by builtin name
+BUILTIN_OPCODES = {
+    'add': ADD, 'sub': SUB, 'mul': MUL, 'div': DIV, 'mod': MOD, 'neg': NEG,
+    'not': NOT, 'and': AND, 'or': OR, 'xor': XOR,
+    'gt': GT, 'lt': LT, 'eq': EQ, 'gte': GTE, 'lte': LTE, 'neq': NEQ,
+    'idnum': ID, 'idbool': ID, 'id': ID, 'nil': NIL, 'cons': CONS,
+}
+
+class Function(object):
+    __slots__ = ('name', 'nparams', 'nlocals', 'code')
+    def __init__(self, name, nparams):
+        self.name = name
+        self.nparams = nparams
+        self.nlocals = nparams
+        self.code = array('i')
+
+class Program(object):
+    def __init__(self, record=False):
+        self.consts = []
+        self.names = []
+        self.functions = []
+        # the result of every form if recording: a Function and the type to
+        # box its value with, or the node itself for a form with no value,
+        # or the node for an invalid form or a define (without its body)
+        self.record = record
+        self.forms = []
+        self.const_index = {}
+        # the size of the constant table before the last expression, which
+        # when not recording, or None
+        self.scratch = None
+
+    def const(self, value):
+        # bools compare equal to ints, so they are keyed apart
+        key = (type(value) is bool, value)
+        if key not in self.const_index:
+            self.const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return self.const_index[key]
+
+    # a new constant for the values a nested define captured, which are
+    # None until it is run
+    def cell(self, name):
+        self.consts.append([None, name])
+        return len(self.consts) - 1
+
+    # how much has been compiled so far, for truncate()
+    def mark(self):
+        return len(self.consts), len(self.functions), len(self.forms)
+
+    # forget everything compiled since mark was taken
+    def truncate(self, mark):
+        nconsts, nfunctions, nforms = mark
+        if len(self.consts) > nconsts:
+            del self.consts[nconsts:]
+            self.const_index = dict((key, i) for key, i in self.const_index.iteritems() if i < nconsts)
+        if self.scratch is not None and self.scratch > nconsts:
+            self.scratch = None
+        del self.functions[nfunctions:]
+        del self.names[nfunctions:]
+        del self.forms[nforms:]
+
+    # forget the constants of the last expression, if not recorded
+    def release(self):
+        if self.scratch is not None:
+            self.truncate((self.scratch, len(self.functions), len(self.forms)))
+            self.scratch = None
+
+    def emit(self, func, *words):
+        func.code.extend(words)
+
+    def compile(self, ast, funcstack, func, scope, slots, tail):
+        ntype = ast['ntype']
+        if ntype == Nodes.NUM or ntype == Nodes.BOOL:
+            self.emit(func, CONST, self.const(ast['value']))
+        elif ntype == Nodes.IDENT:
+            self.emit(func, LOAD, scope[ast['value']])
+        elif ntype == Nodes.LET:
+            scope = dict(scope)
+            for ident, expr in ast['bindings']:
+                self.compile(expr, funcstack, func, scope, slots, False)
+                scope[ident['value']] = slot = slots.alloc()
+                self.emit(func, STORE, slot)
+            self.compile(ast['expr'], funcstack, func, scope, slots, tail)
+            return
+        elif ntype == Nodes.IF:
+            self.compile(ast['testexpr'], funcstack, func, scope, slots, False)
+            self.emit(func, JUMP_IF_FALSE, 0)
+            to_false = len(func.code) - 1
+            self.compile(ast['trueexpr'], funcstack, func, scope, slots, tail)
+            if not tail:
+                self.emit(func, JUMP, 0)
+                to_end = len(func.code) - 1
+            func.code[to_false] = len(func.code)
+            self.compile(ast['falseexpr'], funcstack, func, scope, slots, tail)
+            if not tail:
+                func.code[to_end] = len(func.code)
+            # both branches returned already in tail position
+            return
+        elif ntype == Nodes.FUNC:
+            name = ast['func']['value']
+            if name not in funcstack:
+                raise Exception("Cannot compile call to unknown func "+name)
+            funcdef = funcstack[name]
+            for arg in ast['args']:
+                self.compile(arg, funcstack, func, scope, slots, False)
+            nargs = len(ast['args'])
+            limits = funcstack.limits
+            counted = limits is not None and limits.counts(name)
+            if 'opcode' in funcdef and nargs == len(funcdef['intypes']) and not counted:
+                self.emit(func, funcdef['opcode'])
+            elif 'raw' in funcdef:
+                fn = raw_for(funcdef, nargs)
+                if limits is not None:
+                    fn = limits.builtin(name, fn)
+                self.emit(func, PRIM, self.const(fn), nargs)
+            else:
+                self.emit(func, TAILCALL if tail else CALL, funcdef['bytecode'])
+                return
+        elif ntype == Nodes.DEFINE:
+            captured, inner = nested_scope(ast, scope)
+            cell = self.cell(ast['func']['value'])
+            self.compile_define(ast, funcstack, inner, cell)
+            for slot, name in captured:
+                self.emit(func, LOAD, slot)
+            self.emit(func, BIND, cell, len(captured))
+        else:
+            raise Exception("Cannot compile node type "+ntype)
+        if tail:
+            self.emit(func, RETURN)
+
+    # compile a define; a nested one has the scope of its body, see
+    # nested_scope, and the cell it is bound with
+    def compile_define(self, ast, funcstack, scope=None, cell=None):
+        funcdef = funcstack[ast['func']['value']] if cell is None else ast
+        params = ast['params']
+        func = Function(ast['func']['value'], len(params))
+        # the index is taken before compiling the body, for recursive calls
+        funcdef['bytecode'] = len(self.functions)
+        self.functions.append(func)
+        self.names.append(func.name)
+        if scope is None:
+            scope = dict((params[i]['value'], i) for i in xrange(len(params)))
+        slots = Slots(len(scope))
+        if funcstack.limits is not None:
+            self.emit(func, STEP, self.const(funcstack.limits))
+        if cell is not None:
+            self.emit(func, ENV, cell, len(params))
+        self.compile(ast['expr'], funcstack, func, scope, slots, True)
+        func.nlocals = slots.size
+
+    # compile one typed form, returning the Function for an expression
+    def compile_form(self, ast, funcstack):
+        # the last expression has been run by now
+        self.release()
+        if is_invalid(ast):
+            if self.record:
+                self.forms.append(ast)
+            return None
+        elif ast['ntype'] == Nodes.DEFINE:
+            self.compile_define(ast, funcstack)
+            # the body is in the bytecode now, so keep programs small
+            if self.record:
+                self.forms.append(ast.replace(expr=None))
+            return None
+        func = Function(None, 0)
+        slots = Slots()
+        if self.record:
+            self.forms.append((func, ast if ast['vtype'] is VOID else ast['vtype']))
+        else:
+            self.scratch = len(self.consts)
+        nfunctions = len(self.functions)
+        self.compile(ast, funcstack, func, {}, slots, True)
+        func.nlocals = slots.size
+        if len(self.functions) > nfunctions:
+            # the functions of nested defines keep their constants
+            self.scratch = None
+        return func
+
+    # run func on a list of argument values
+    def execute(self, func, args=()):
+        consts = self.consts
+        functions = self.functions
+        stack = list(args) + [None] * (func.nlocals - len(args))
+        push = stack.append
+        pop = stack.pop
+        frames = []
+        code = func.code
+        pc = 0
+        bp = 0
+        while True:
+            op = code[pc]
+            if op == LOAD:
+                push(stack[bp + code[pc+1]])
+                pc += 2
+            elif op == CONST:
+                push(consts[code[pc+1]])
+                pc += 2
+            elif op == JUMP_IF_FALSE:
+                if pop():
+                    pc += 2
+                else:
+                    pc = code[pc+1]
+            elif op == ADD:
+                b = pop()
+                stack[-1] += b
+                pc += 1
+            elif op == SUB:
+                b = pop()
+                stack[-1] -= b
+                pc += 1
+            elif op == LT:
+                b = pop()
+                stack[-1] = stack[-1] < b
+                pc += 1
+            elif op == EQ:
+                b = pop()
+                stack[-1] = stack[-1] == b
+                pc += 1
+            elif op == MUL:
+                b = pop()
+                stack[-1] *= b
+                pc += 1
+            elif op == RETURN:
+                value = pop()
+                del stack[bp:]
+                if not frames:
+                    return value
+                code, pc, bp = frames.pop()
+                push(value)
+            elif op == CALL:
+                f = functions[code[pc+1]]
+                frames.append((code, pc + 2, bp))
+                bp = len(stack) - f.nparams
+                if f.nlocals > f.nparams:
+                    stack.extend([None] * (f.nlocals - f.nparams))
+                code = f.code
+                pc = 0
+            elif op == TAILCALL:
+                f = functions[code[pc+1]]
+                n = f.nparams
+                # the arguments replace the current frame
+                stack[bp:] = stack[len(stack) - n:]
+                if f.nlocals > n:
+                    stack.extend([None] * (f.nlocals - n))
+                code = f.code
+                pc = 0
+            elif op == STEP:
+                limits = consts[code[pc+1]]
+                limits.steps += 1
+                if limits.steps >= limits.next_check:
+                    limits.check()
+                pc += 2
+            elif op == STORE:
+                stack[bp + code[pc+1]] = pop()
+                pc += 2
+            elif op == JUMP:
+                pc = code[pc+1]
+            elif op == GT:
+                b = pop()
+                stack[-1] = stack[-1] > b
+                pc += 1
+            elif op == GTE:
+                b = pop()
+                stack[-1] = stack[-1] >= b
+                pc += 1
+            elif op == LTE:
+                b = pop()
+                stack[-1] = stack[-1] <= b
+                pc += 1
+            elif op == NEQ:
+                b = pop()
+                stack[-1] = stack[-1] != b
+                pc += 1
+            elif op == DIV:
+                b = pop()
+                stack[-1] //= b
+                pc += 1
+            elif op == MOD:
+                b = pop()
+                stack[-1] %= b
+                pc += 1
+            elif op == NEG:
+                stack[-1] = -stack[-1]
+                pc += 1
+            elif op == NOT:
+                stack[-1] = not stack[-1]
+                pc += 1
+            elif op == AND:
+                b = pop()
+                stack[-1] = stack[-1] and b
+                pc += 1
+            elif op == OR:
+                b = pop()
+                stack[-1] = stack[-1] or b
+                pc += 1
+            elif op == XOR:
+                b = pop()
+                stack[-1] = stack[-1] ^ b
+                pc += 1
+            elif op == ID:
+                pc += 1
+            elif op == NIL:
+                push(EMPTY)
+                pc += 1
+            elif op == CONS:
+                b = pop()
+                stack[-1] = cons(stack[-1], b)
+                pc += 1
+            elif op == PRIM:
+                fn = consts[code[pc+1]]
+                n = code[pc+2]
+                start = len(stack) - n
+                args = stack[start:]
+                del stack[start:]
+                push(fn(*args))
+                pc += 3
+            elif op == ENV:
+                values = consts[code[pc+1]][0]
+                if values is None:
+                    raise Exception(consts[code[pc+1]][1] + " called before its define was reached")
+                start = bp + code[pc+2]
+                stack[start:start + len(values)] = values
+                pc += 3
+            elif op == BIND:
+                n = code[pc+2]
+                start = len(stack) - n
+                consts[code[pc+1]][0] = stack[start:]
+                del stack[start:]
+                push(None)
+                pc += 3
+            else:
+                raise Exception("Bad opcode %d" % op)
+
+    # results of every form again, without reading or compiling anything
+    def run(self):
+        for form in self.forms:
+            if type(form) is tuple:
+                func, vtype = form
+                value = self.execute(func)
+                yield vtype if isinstance(vtype, Node) else box(value, vtype)
+            else:
+                yield form
+
+def disassemble(program, func):
+    lines = []
+    code = func.code
+    pc = 0
+    while pc < len(code):
+        op = code[pc]
+        operands = list(code[pc+1:pc+1+OPERANDS[op]])
+        if op == CONST:
+            operands.append(repr(program.consts[operands[0]]))
+        elif op == CALL or op == TAILCALL:
+            operands.append(program.names[operands[0]])
+        lines.append("%4d %-14s %s" % (pc, NAMES[op], " ".join(str(x) for x in operands)))
+        pc += 1 + OPERANDS[op]
+    return "\n".join(lines)
+
+def program_of(funcstack):
+    if funcstack.program is None:
+        funcstack.program = Program()
+    return funcstack.program
+
+# BYTECODE pass: compile valid expressions into the funcstack's program
+def compile_ast(ast, funcstack):
+    func = program_of(funcstack).compile_form(ast, funcstack)
+    if func is None:
+        return ast
+    return ast.replace(code=func)
+
+# VM pass: run the bytecode and box the result
+def run(ast, funcstack):
+    if 'code' not in ast:
+        return ast
+    return result(program_of(funcstack).execute(ast['code']), ast)
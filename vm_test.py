@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import unittest
+import pickle
+import sexp
+import vm
+
+class TestVM(unittest.TestCase):
+
+    def test_reuse(self):
+        program = sexp.compile_program("(define (fib n) (if (lt n 2) n (add (fib (sub n 1)) (fib (sub n 2))))) (fib 15) (cons #t (nil))")
+        for i in xrange(2):
+            results = [sexp.show(res) for res in program.run()]
+            self.assertEqual([None, "610", "(#t)"], results)
+
+    def test_code(self):
+        program = sexp.compile_program("(define (count n) (if (eq n 0) 0 (count (sub n 1))))", optimize=False)
+        func = program.functions[0]
+        self.assertEqual('i', func.code.typecode)
+        ops = vm.disassemble(program, func).split("\n")
+        self.assertEqual(["LOAD", "CONST", "EQ", "JUMP_IF_FALSE", "CONST", "RETURN", "LOAD", "CONST", "SUB", "TAILCALL"],
+                         [line.split()[1] for line in ops])
+
+    def test_tail_calls(self):
+        program = sexp.compile_program("(define (count n acc) (if (eq n 0) acc (count (sub n 1) (add acc 1)))) (count 100000 0)")
+        self.assertEqual(100000, list(program.run())[-1]['value'])
+
+    def test_pickle(self):
+        program = sexp.compile_program("(define (sq n) (mul n n)) (sq 7) (sum (cons 1 (cons 2 (nil))))", optimize=False)
+        program = pickle.loads(pickle.dumps(program, 2))
+        self.assertEqual(["49", "3"], [sexp.show(res) for res in program.run()][1:])
+
+    def test_nested_define(self):
+        source = "(define (h a) (let ((x a)) (define (f y) (add x y)))) (let ((x 1)) (define (g y) (mul x y))) " \
+                 "(h 1) (f 2) (h 10) (f (g 2))"
+        program = pickle.loads(pickle.dumps(sexp.compile_program(source, optimize=False), 2))
+        ops = [line.split()[1] for line in vm.disassemble(program, program.functions[1]).split("\n")]
+        self.assertEqual("ENV", ops[0])
+        for i in xrange(2):
+            self.assertEqual([None, None, None, "3", None, "12"], [sexp.show(res) for res in program.run()])
+
+    def test_stream(self):
+        source = "(define (f x) (add x 1000)) " + " ".join("(f %d) (mul %d 3)" % (i, i + 5000) for i in xrange(200))
+        for ast, funcstack in sexp.execute(source, 'vm'):
+            pass
+        self.assertEqual(15597, ast['value'])
+        program = funcstack.program
+        self.assertEqual(([], 1), (program.forms, len(program.functions)))
+        self.assertTrue(len(program.consts) < 5)
+
+if __name__ == '__main__':
+    unittest.main()